@@ -29,6 +29,9 @@ CREATE TABLE IF NOT EXISTS wifi
     channel_width LowCardinality(String),
     longitude Float64,
     latitude Float64,
+    h3_r4 LowCardinality(String),
+    h3_r6 String,
+    h3_r8 String,
     state LowCardinality(String),
     region LowCardinality(String),
     band LowCardinality(String),
@@ -41,10 +44,14 @@ CREATE TABLE IF NOT EXISTS wifi
     INDEX state_set state TYPE set(0) GRANULARITY 4,
     INDEX region_set region TYPE set(0) GRANULARITY 4,
     INDEX band_set band TYPE set(0) GRANULARITY 4,
-    INDEX channel_set channel TYPE set(0) GRANULARITY 4
+    INDEX channel_set channel TYPE set(0) GRANULARITY 4,
+    INDEX h3_r4_bloom h3_r4 TYPE bloom_filter(0.01) GRANULARITY 4,
+    INDEX h3_r6_bloom h3_r6 TYPE bloom_filter(0.01) GRANULARITY 4,
+    INDEX h3_r8_bloom h3_r8 TYPE bloom_filter(0.01) GRANULARITY 4
 )
 ENGINE = MergeTree()
 PARTITION BY toYYYYMMDD(timestamp)
 ORDER BY toStartOfHour(timestamp)
 SETTINGS index_granularity = 8192,
-         index_granularity_bytes = 10485760;
\ No newline at end of file
+         index_granularity_bytes = 10485760,
+         non_replicated_deduplication_window = 1000;
\ No newline at end of file
@@ -28,6 +28,9 @@ CREATE TABLE IF NOT EXISTS 'wifi' (
 	channel_width SYMBOL CAPACITY 256 CACHE,
 	longitude DOUBLE,
 	latitude DOUBLE,
+	h3_r4 SYMBOL CAPACITY 65536 CACHE,
+	h3_r6 SYMBOL CAPACITY 1048576 CACHE,
+	h3_r8 SYMBOL CAPACITY 33554432 CACHE,
 	state SYMBOL CAPACITY 256 CACHE,
 	region SYMBOL CAPACITY 256 CACHE,
 	band SYMBOL CAPACITY 256 CACHE,
@@ -1,26 +1,76 @@
+import contextlib
+import io
 import logging
+import time
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Literal, Tuple
 
-from fastapi import FastAPI, Query, HTTPException
-from pydantic import BaseModel, Field, model_validator
+import orjson
+import pyarrow as pa
+from fastapi import FastAPI, Header, Query, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, PrivateAttr, field_validator, model_validator
 from sqlalchemy import create_engine, and_
 from sqlalchemy.orm import sessionmaker
 
+from src import geo, instrumentation, queries, rollups
+from src.cache import cache_key, get_result_cache
+from src.engines import QueryEngine, check_engine, get_engine
 from src.models import WiFi
-from src.utils import load_config
+from src.utils import get_watermark, load_config
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Refuse to start on a configuration whose engine ingestion never loads."""
+    check_engine(load_config())
+    yield
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="WiFi Data Search API",
-    description="API for querying WiFi access point data from QuestDB",
-    version="1.0.0"
+    description="API for querying WiFi access point data from QuestDB or ClickHouse",
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """
+    Record the latency of every request, up to the first byte for streamed
+    responses. With api.profile.enabled, requests slower than
+    api.profile.slow_request_ms also leave a sampled profile behind.
+    """
+    paths = {route.path for route in app.routes}
+    endpoint = request.url.path if request.url.path in paths else "other"
+    profile = load_config().api.profile
+    profiler = instrumentation.SamplingProfiler(interval=profile.interval_ms / 1000).start() if profile.enabled else None
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        seconds = time.perf_counter() - start
+        instrumentation.REQUEST_SECONDS.observe(seconds, endpoint=endpoint, status=status)
+        if profiler is not None:
+            profiler.stop()
+            if seconds * 1000 >= profile.slow_request_ms and profiler.stacks:
+                name = f"{datetime.now():%Y%m%dT%H%M%S}-{endpoint.strip('/') or 'root'}-{seconds * 1000:.0f}ms.folded"
+                profiler.dump(f"{profile.output_dir}/{name}")
+                logger.info(f"Slow request to {endpoint} ({seconds:.2f}s), profile written to {profile.output_dir}/{name}")
+
+
+# media types of the streaming variants of /search
+NDJSON = "application/x-ndjson"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
 # Database connection - will be initialized lazily
 engine = None
 SessionLocal = None
@@ -46,8 +96,8 @@ def get_db_session():
     return SessionLocal()
 
 
-class SearchRequest(BaseModel):
-    """Request model for the search endpoint"""
+class QueryFilters(BaseModel):
+    """Time window and indexed filters shared by the query endpoints"""
     from_ts: datetime = Field(None, description="Start timestamp for the query time window", alias="from")
     to_ts: datetime = Field(None, description="End timestamp for the query time window", alias="to")
     ap_id: Optional[str] = Field(None, description="Filter by access point ID")
@@ -55,6 +105,14 @@ class SearchRequest(BaseModel):
     band: Optional[str] = Field(None, description="Filter by band")
     state: Optional[str] = Field(None, description="Filter by state")
     region: Optional[str] = Field(None, description="Filter by region")
+    bbox: Optional[Tuple[float, float, float, float]] = Field(
+        None, description="Filter by bounding box: [min_lon, min_lat, max_lon, max_lat]"
+    )
+    point: Optional[Tuple[float, float]] = Field(None, description="Centre of a radius filter: [lon, lat]")
+    radius_km: Optional[float] = Field(None, gt=0, description="Radius around point, in kilometres")
+
+    # resolution, H3 cells and bounding box of the area filter, if any
+    _area: Optional[tuple] = PrivateAttr(None)
 
     class Config:
         populate_by_name = True
@@ -70,6 +128,59 @@ class SearchRequest(BaseModel):
             if values.get("to") is None:
                 values["to"] = now.isoformat()
         return values
+
+    @model_validator(mode="after")
+    def check_area(self):
+        if self.bbox is not None and self.point is not None:
+            raise ValueError("Pass either bbox or point and radius_km, not both")
+        if (self.point is None) != (self.radius_km is None):
+            raise ValueError("point and radius_km go together")
+        if self.bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = self.bbox
+            if not (-180 <= min_lon < max_lon <= 180 and -90 <= min_lat < max_lat <= 90):
+                raise ValueError("bbox must be [min_lon, min_lat, max_lon, max_lat] with min < max")
+        if self.point is not None:
+            lon, lat = self.point
+            if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+                raise ValueError("point must be [lon, lat]")
+        if self.bbox is not None or self.point is not None:
+            cfg = load_config().geo
+            self._area = geo.cover(self.bbox, self.point, self.radius_km, cfg.h3_resolutions, cfg.max_cells)
+        return self
+
+    @property
+    def area(self) -> Optional[tuple]:
+        return self._area
+
+
+class SearchRequest(QueryFilters):
+    """Request model for the search endpoint"""
+    limit: Optional[int] = Field(None, ge=1, le=100_000, description="Maximum number of rows; pages by (timestamp, ap_id)")
+    cursor: Optional[str] = Field(None, description="next_cursor of the previous page")
+    fields: Optional[List[str]] = Field(None, description="Columns to return; timestamp and ap_id are always included")
+
+    @field_validator("fields")
+    @classmethod
+    def check_fields(cls, value):
+        if value is not None:
+            unknown = sorted(set(value) - set(queries.COLUMNS))
+            if unknown:
+                raise ValueError(f"Unknown fields {unknown}; valid fields are {queries.COLUMNS}")
+        return value
+
+    @field_validator("cursor")
+    @classmethod
+    def check_cursor(cls, value):
+        if value is not None:
+            queries.decode_cursor(value)
+        return value
+
+    @model_validator(mode="after")
+    def default_page_size(self):
+        # a cursor always continues a paged listing
+        if self.cursor is not None and self.limit is None:
+            self.limit = load_config().api.default_page_size
+        return self
         
 
 
@@ -77,6 +188,32 @@ class SearchResponse(BaseModel):
     """Response model for the search endpoint"""
     count: int
     data: List[Dict[str, Any]]
+    next_cursor: Optional[str] = Field(None, description="Present only when more rows remain")
+
+
+class AggregateRequest(QueryFilters):
+    """Request model for the aggregate endpoint"""
+    group_by: List[Literal[queries.GROUP_KEYS]] = Field([], description="Keys to group by within each bucket")
+    bucket: str = Field("1h", pattern=queries.BUCKET_PATTERN, description="Bucket width: minutes (m), hours (h) or days (d), e.g. 15m, 1d")
+    metrics: Dict[str, List[Literal[queries.AGGREGATE_FUNCTIONS]]] = Field(
+        ..., description="Aggregate functions per metric column, e.g. {\"avg_rssi\": [\"avg\", \"min\"]}"
+    )
+
+    @field_validator("metrics")
+    @classmethod
+    def check_metrics(cls, value):
+        unknown = sorted(set(value) - set(queries.METRIC_COLUMNS))
+        if unknown:
+            raise ValueError(f"Unknown metrics {unknown}; valid metrics are {queries.METRIC_COLUMNS}")
+        if not any(value.values()):
+            raise ValueError("At least one aggregate function is required")
+        return value
+
+
+class AggregateResponse(BaseModel):
+    """Response model for the aggregate endpoint"""
+    count: int
+    data: List[Dict[str, Any]]
 
 
 @app.get("/")
@@ -85,13 +222,85 @@ def root():
     return {
         "message": "WiFi Data Search API",
         "endpoints": {
-            "/search": "POST - Search WiFi data with time range and filters"
+            "/search": "POST - Search WiFi data with time range and filters",
+            "/aggregate": "POST - Aggregate WiFi metrics into time buckets and groups",
+            "/cache": "GET - Result cache hit/miss counters and the ingestion watermark",
+            "/metrics": "GET - Request, database and serialization timings in the Prometheus format"
         }
     }
 
 
+def encode_ndjson(rows: list) -> bytes:
+    return b"".join(orjson.dumps(dict(row), option=orjson.OPT_APPEND_NEWLINE) for row in rows)
+
+
+class ArrowStreamEncoder:
+    """Encode row chunks as consecutive messages of one Arrow IPC stream."""
+
+    def __init__(self, columns: List[str]):
+        self.schema = queries.arrow_schema(columns)
+        self._sink = io.BytesIO()
+        self._writer = pa.ipc.new_stream(self._sink, self.schema)
+
+    def _flush(self) -> bytes:
+        data = self._sink.getvalue()
+        self._sink.seek(0)
+        self._sink.truncate()
+        return data
+
+    def encode(self, rows: list) -> bytes:
+        batch = pa.RecordBatch.from_pylist([dict(row) for row in rows], schema=self.schema)
+        self._writer.write_batch(batch)
+        return self._flush()
+
+    def close(self) -> bytes:
+        self._writer.close()
+        return self._flush()
+
+
+async def streaming_search(
+    engine: QueryEngine,
+    sql: str,
+    params,
+    media_type: str,
+    columns: List[str],
+    limit: Optional[int] = None,
+) -> StreamingResponse:
+    """
+    Stream a search as NDJSON or an Arrow IPC stream. The first chunk is
+    fetched before responding, so query errors still surface as a 500.
+    """
+    chunks = engine.stream(sql, params, load_config().api.stream_chunk_rows, max_rows=limit)
+
+    async def fetch():
+        with instrumentation.DB_SECONDS.time(endpoint="/search"):
+            return await chunks.__anext__()
+
+    try:
+        first = await fetch()
+    except StopAsyncIteration:
+        first = []
+
+    async def body():
+        encoder = ArrowStreamEncoder(columns) if media_type == ARROW_STREAM else None
+        encode = encoder.encode if encoder is not None else encode_ndjson
+        rows = first
+        while rows:
+            with instrumentation.SERIALIZE_SECONDS.time(endpoint="/search"):
+                data = encode(rows)
+            yield data
+            try:
+                rows = await fetch()
+            except StopAsyncIteration:
+                break
+        if encoder is not None:
+            yield encoder.close()
+
+    return StreamingResponse(body(), media_type=media_type)
+
+
 @app.post("/search", response_model=SearchResponse)
-def search(request: SearchRequest):
+async def search(request: SearchRequest, accept: Optional[str] = Header(None)):
     """
     Search WiFi data with time range and optional filters.
     
@@ -103,66 +312,174 @@ def search(request: SearchRequest):
     - region: Geographic region
     
     All filters are optional and can be combined in any way.
+
+    The response is a single JSON document by default. Clients sending
+    `Accept: application/x-ndjson` or `Accept: application/vnd.apache.arrow.stream`
+    get the rows streamed from a server-side cursor instead, one JSON object
+    per line or as an Arrow IPC stream, without a `count`.
+
+    With a `limit`, rows are ordered by (timestamp, ap_id) and the JSON
+    response carries a `next_cursor` when more rows remain; pass it back as
+    `cursor` to get the next page. Streaming responses honour `limit` but do
+    not return a cursor.
+
+    JSON responses are cached in-process; see src/cache.py.
     """
     try:
-        session = get_db_session()
-        
-        # Start building the query using SQLAlchemy ORM
-        query = session.query(WiFi)
-        
-        # Apply time range filter (required)
-        query = query.filter(
-            and_(
-                WiFi.timestamp >= request.from_ts,
-                WiFi.timestamp < request.to_ts
-            )
-        )
-        
-        # Apply optional indexed filters
-        if request.ap_id is not None:
-            query = query.filter(WiFi.ap_id == request.ap_id)
-        
-        if request.channel is not None:
-            query = query.filter(WiFi.channel == request.channel)
-        
-        if request.band is not None:
-            query = query.filter(WiFi.band == request.band)
-        
-        if request.state is not None:
-            query = query.filter(WiFi.state == request.state)
-        
-        if request.region is not None:
-            query = query.filter(WiFi.region == request.region)
-        
-        # Log the query for debugging
-        logger.info(f"Executing query: {query}")
-        
-        # Execute query
-        results = query.all()
-        
-        # Convert results to dictionaries
-        data = []
-        for row in results:
-            row_dict = {
-                column.name: getattr(row, column.name)
-                for column in WiFi.__table__.columns
-            }
-            # Convert datetime to ISO format string
-            if row_dict['timestamp']:
-                row_dict['timestamp'] = row_dict['timestamp'].isoformat()
-            data.append(row_dict)
-        
-        session.close()
-        
-        logger.info(f"Query returned {len(data)} results")
-        
-        return SearchResponse(count=len(data), data=data)
-    
+        engine = get_engine()
+        sql, params = queries.search_query(request, engine.table_name, engine.dialect)
+
+        for media_type in (NDJSON, ARROW_STREAM):
+            if accept is not None and media_type in accept:
+                logger.info(f"Executing query: {sql} with {params}")
+                return await streaming_search(
+                    engine, sql, params, media_type, queries.projection(request.fields), limit=request.limit,
+                )
+
+        cache = get_result_cache()
+        key = cache_key("search", engine.name, request)
+        body = cache.get(key)
+        if body is not None:
+            return Response(content=body, media_type="application/json")
+
+        logger.info(f"Executing query: {sql} with {params}")
+        watermark = get_watermark()
+        with instrumentation.DB_SECONDS.time(endpoint="/search"):
+            rows = await engine.fetch(sql, params)
+        rows, next_cursor = queries.next_page(rows, request.limit)
+
+        logger.info(f"Query returned {len(rows)} results")
+
+        # encode records straight to JSON, skipping response model validation
+        with instrumentation.SERIALIZE_SECONDS.time(endpoint="/search"):
+            result = {"count": len(rows), "data": [dict(row) for row in rows]}
+            if next_cursor is not None:
+                result["next_cursor"] = next_cursor
+            body = orjson.dumps(result)
+        cache.put(key, body, request.to_ts, watermark)
+        return Response(content=body, media_type="application/json")
+
+    except Exception as e:
+        logger.error(f"Error executing query: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error executing query: {str(e)}")
+
+
+def compile_aggregate(request: AggregateRequest, engine: QueryEngine, use_rollups: Optional[bool] = None):
+    """SQL of an aggregate request, on the coarsest rollup that answers it exactly if rollups are used."""
+    cfg = load_config()
+    if use_rollups is None:
+        use_rollups = cfg.api.use_rollups
+    rollup = rollups.route(request, cfg) if use_rollups else None
+    if rollup is not None:
+        return queries.aggregate_query(request, rollup.name, engine.dialect, rollup=True)
+    return queries.aggregate_query(request, engine.table_name, engine.dialect)
+
+
+@app.post("/aggregate", response_model=AggregateResponse)
+async def aggregate(request: AggregateRequest):
+    """
+    Aggregate WiFi metrics into time buckets, optionally grouped by region,
+    state, band, channel, vendor_name or model, with the same filters as
+    /search. The database does the work (SAMPLE BY on QuestDB,
+    toStartOfInterval on ClickHouse), so only one row per bucket and group
+    is returned. Responses are cached like those of /search.
+
+    Requests that a rollup table answers exactly (whole days or hours, and
+    keys and filters the rollup keeps) read from the coarsest such rollup
+    instead of the hourly table.
+    """
+    try:
+        engine = get_engine()
+        cache = get_result_cache()
+        key = cache_key("aggregate", engine.name, request)
+        body = cache.get(key)
+        if body is not None:
+            return Response(content=body, media_type="application/json")
+
+        sql, params = compile_aggregate(request, engine)
+        logger.info(f"Executing query: {sql} with {params}")
+
+        watermark = get_watermark()
+        with instrumentation.DB_SECONDS.time(endpoint="/aggregate"):
+            rows = await engine.fetch(sql, params)
+        with instrumentation.SERIALIZE_SECONDS.time(endpoint="/aggregate"):
+            data = queries.aggregate_rows(rows)
+            body = orjson.dumps({"count": len(data), "data": data})
+
+        logger.info(f"Aggregation returned {len(data)} results")
+        cache.put(key, body, request.to_ts, watermark)
+        return Response(content=body, media_type="application/json")
+
     except Exception as e:
         logger.error(f"Error executing query: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error executing query: {str(e)}")
 
 
+def search_orm(request: SearchRequest) -> SearchResponse:
+    """
+    Original ORM implementation of /search, kept as the baseline for
+    src/bench_search.py.
+    """
+    session = get_db_session()
+    
+    # Start building the query using SQLAlchemy ORM
+    query = session.query(WiFi)
+    
+    # Apply time range filter (required)
+    query = query.filter(
+        and_(
+            WiFi.timestamp >= request.from_ts,
+            WiFi.timestamp < request.to_ts
+        )
+    )
+    
+    # Apply optional indexed filters
+    if request.ap_id is not None:
+        query = query.filter(WiFi.ap_id == request.ap_id)
+    
+    if request.channel is not None:
+        query = query.filter(WiFi.channel == request.channel)
+    
+    if request.band is not None:
+        query = query.filter(WiFi.band == request.band)
+    
+    if request.state is not None:
+        query = query.filter(WiFi.state == request.state)
+    
+    if request.region is not None:
+        query = query.filter(WiFi.region == request.region)
+    
+    # Execute query
+    results = query.all()
+    
+    # Convert results to dictionaries
+    data = []
+    for row in results:
+        row_dict = {
+            column.name: getattr(row, column.name)
+            for column in WiFi.__table__.columns
+        }
+        # Convert datetime to ISO format string
+        if row_dict['timestamp']:
+            row_dict['timestamp'] = row_dict['timestamp'].isoformat()
+        data.append(row_dict)
+    
+    session.close()
+    return SearchResponse(count=len(data), data=data)
+
+
+@app.get("/cache")
+def cache_stats():
+    """Result cache counters and the ingestion watermark"""
+    return get_result_cache().stats()
+
+
+@app.get("/metrics")
+def metrics():
+    """Request latency, database time and serialization time histograms, in the Prometheus text format"""
+    return Response(content=instrumentation.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/health")
 def health():
     """Health check endpoint"""
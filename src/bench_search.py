@@ -0,0 +1,165 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import orjson
+
+from src import queries
+from src.backend import AggregateRequest, SearchRequest, SearchResponse, compile_aggregate, search, search_orm
+from src.engines import ENGINES, get_engine
+from src.models import WiFi
+from src.utils import set_logging
+
+
+def synthetic_rows(n_rows: int) -> list:
+    """Rows shaped like the wifi table, as returned by asyncpg (mapping per row)."""
+    rng = np.random.default_rng(0)
+    base = datetime(2025, 11, 17)
+    rows = []
+    for i in range(n_rows):
+        row = {}
+        for column in WiFi.__table__.columns:
+            kind = column.type.python_type
+            if column.name == "timestamp":
+                row[column.name] = base + timedelta(hours=int(i % 24))
+            elif kind is float:
+                row[column.name] = float(rng.normal())
+            elif kind is int:
+                row[column.name] = int(rng.integers(0, 1_000_000))
+            else:
+                row[column.name] = f"{column.name}-{i % 97}"
+        rows.append(row)
+    return rows
+
+
+def encode_orm(rows: list) -> bytes:
+    """Serialization done by the ORM path: objects to dicts, model validation, stdlib JSON."""
+    objects = [WiFi(**row) for row in rows]
+    data = []
+    for obj in objects:
+        row_dict = {
+            column.name: getattr(obj, column.name)
+            for column in WiFi.__table__.columns
+        }
+        row_dict['timestamp'] = row_dict['timestamp'].isoformat()
+        data.append(row_dict)
+    response = SearchResponse(count=len(data), data=data)
+    return json.dumps(response.model_dump(mode="json")).encode()
+
+
+def encode_direct(rows: list) -> bytes:
+    """Serialization done by the asyncpg path: records straight to orjson."""
+    return orjson.dumps({"count": len(rows), "data": [dict(row) for row in rows]})
+
+
+def rate(fn, *args, repeat: int) -> float:
+    """Best-of-repeat wall time of fn(*args), in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_offline(n_rows: int, repeat: int) -> None:
+    rows = synthetic_rows(n_rows)
+    for name, fn in [("orm", encode_orm), ("asyncpg+orjson", encode_direct)]:
+        seconds = rate(fn, rows, repeat=repeat)
+        logging.info(f"{name}: {n_rows / seconds:,.0f} rows/s ({seconds * 1000:.1f} ms for {n_rows} rows)")
+
+
+def run_online(request: SearchRequest, repeat: int) -> None:
+    loop = asyncio.new_event_loop()
+    try:
+        count = search_orm(request).count
+        loop.run_until_complete(search(request, accept=None))  # warm the pool
+        seconds = rate(search_orm, request, repeat=repeat)
+        logging.info(f"orm: {count / seconds:,.0f} rows/s ({seconds * 1000:.1f} ms for {count} rows)")
+        seconds = rate(lambda: loop.run_until_complete(search(request, accept=None)), repeat=repeat)
+        logging.info(f"asyncpg+orjson: {count / seconds:,.0f} rows/s ({seconds * 1000:.1f} ms for {count} rows)")
+    finally:
+        loop.close()
+
+
+def request_set(to_ts: datetime, hours: int) -> list:
+    """
+    Named requests timed against every engine: full scans, filtered, paged,
+    projected and aggregated, and a week-long trend over whole days, which
+    rollups can answer.
+    """
+    window = {"from": (to_ts - timedelta(hours=hours)).isoformat(), "to": to_ts.isoformat()}
+    day = to_ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    week = {"from": (day - timedelta(days=7)).isoformat(), "to": day.isoformat()}
+    return [
+        ("search", SearchRequest(**window)),
+        ("search band=5GHz", SearchRequest(**window, band="5GHz")),
+        ("search page of 1000", SearchRequest(**window, limit=1000)),
+        ("search 2 fields", SearchRequest(**window, fields=["avg_rssi", "total_bytes_in"])),
+        ("aggregate 1h by region", AggregateRequest(
+            **window, group_by=["region"], bucket="1h", metrics={"avg_rssi": ["avg"], "total_bytes_in": ["sum"]},
+        )),
+        ("aggregate 7d region trend", AggregateRequest(
+            **week, group_by=["region"], bucket="1d", metrics={"avg_rssi": ["avg"], "total_bytes_in": ["sum"]},
+        )),
+    ]
+
+
+def run_engines(names: list, requests: list, repeat: int, use_rollups: bool) -> None:
+    """Time the same requests against each engine, from SQL execution to rows in Python."""
+    loop = asyncio.new_event_loop()
+    try:
+        for label, request in requests:
+            for name in names:
+                engine = get_engine(name)
+                if isinstance(request, AggregateRequest):
+                    sql, params = compile_aggregate(request, engine, use_rollups=use_rollups)
+                else:
+                    sql, params = queries.search_query(request, engine.table_name, engine.dialect)
+                count = len(loop.run_until_complete(engine.fetch(sql, params)))  # also warms the pool
+                seconds = rate(lambda: loop.run_until_complete(engine.fetch(sql, params)), repeat=repeat)
+                logging.info(
+                    f"{label} [{name}]: {count / seconds:,.0f} rows/s ({seconds * 1000:.1f} ms for {count} rows)"
+                )
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    set_logging()
+    parser = argparse.ArgumentParser(description="Compare /search implementations in rows/sec.")
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only time serialization of synthetic rows; no database needed.",
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=sorted(ENGINES),
+        help="Run the same request set against each of these query engines instead.",
+    )
+    parser.add_argument(
+        "--no_rollups",
+        action="store_true",
+        help="With --engines, answer aggregations from the hourly table even when a rollup could.",
+    )
+    parser.add_argument("--rows", type=int, default=100_000, help="Synthetic rows in offline mode.")
+    parser.add_argument("--hours", type=int, default=1, help="Query window, ending now, in online mode.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per implementation; the best is reported.")
+    args = parser.parse_args()
+
+    if args.offline:
+        run_offline(args.rows, args.repeat)
+    elif args.engines:
+        run_engines(args.engines, request_set(datetime.utcnow(), args.hours), args.repeat, not args.no_rollups)
+    else:
+        to_ts = datetime.utcnow()
+        run_online(
+            SearchRequest(**{"from": (to_ts - timedelta(hours=args.hours)).isoformat(), "to": to_ts.isoformat()}),
+            args.repeat,
+        )
@@ -0,0 +1,198 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from src.benchmarks.stand_ins import FakeClickHouse, FakeILP
+from src.utils import set_logging
+
+
+def reset_peak_rss() -> None:
+    """Restart the peak RSS count of this process (Linux), so setup is left out of it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process, in MiB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def use_stand_ins(clickhouse: tuple, ilp: tuple) -> None:
+    """
+    Point the sinks of this process at the stand-ins, and skip schema creation
+    and the QuestDB visibility wait, which need the PG wire port.
+    """
+    from src import utils
+    utils.override_config({
+        "db": {
+            "clickhouse": {"auth": {"host": clickhouse[0], "port": clickhouse[1]}},
+            "questdb": {
+                "auth": {"host": ilp[0]},
+                "params": {
+                    "ingestion_port": ilp[1],
+                    "ingestion_protocol": "http",
+                    "visibility_timeout_seconds": None,
+                },
+            },
+        },
+    })
+    utils.ensure_once("clickhouse", lambda: None)
+    utils.ensure_once("questdb", lambda: None)
+
+
+def run_stage(name: str, sizes: dict, repeat: int, clickhouse: tuple, ilp: tuple) -> dict:
+    """
+    Measure one stage, in a fresh process so its peak RSS is its own: set up
+    the inputs, then time repeat runs, sampling a latency per unit of work.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    use_stand_ins(clickhouse, ilp)
+    from src.benchmarks.stages import STAGES
+    setup, run = STAGES[name]
+    with tempfile.TemporaryDirectory(prefix=f"bench-{name}-") as workdir:
+        state = setup(sizes, Path(workdir))
+        reset_peak_rss()
+        latencies, rows = [], 0
+        start = time.perf_counter()
+        for _ in range(repeat):
+            last = time.perf_counter()
+            for n in run(state):
+                now = time.perf_counter()
+                latencies.append(now - last)
+                rows += n
+                last = now
+        seconds = time.perf_counter() - start
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+    return {
+        "rows": rows,
+        "seconds": round(seconds, 4),
+        "rows_per_sec": round(rows / seconds, 1),
+        "latency_ms": {
+            "p50": round(p50, 3),
+            "p90": round(p90, 3),
+            "p99": round(p99, 3),
+            "max": round(max(latencies) * 1000, 3),
+            "samples": len(latencies),
+        },
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout
+        return commit + ("-dirty" if dirty.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(stages: list, sizes: dict, repeat: int) -> dict:
+    results = {
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "sizes": sizes,
+        "repeat": repeat,
+        "stages": {},
+    }
+    spawn = multiprocessing.get_context("spawn")
+    with FakeClickHouse() as clickhouse, FakeILP() as ilp:
+        for name in stages:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                result = pool.submit(
+                    run_stage, name, sizes, repeat, (clickhouse.host, clickhouse.port), (ilp.host, ilp.port),
+                ).result()
+            results["stages"][name] = result
+            logging.info(
+                f"{name}: {result['rows_per_sec']:,.0f} rows/s, p50 {result['latency_ms']['p50']:.1f} ms, "
+                f"p99 {result['latency_ms']['p99']:.1f} ms, peak RSS {result['peak_rss_mb']:.0f} MiB"
+            )
+        results["stand_ins"] = {"clickhouse": clickhouse.stats(), "questdb": ilp.stats()}
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Log throughput and memory against a baseline run; return the stages that regressed."""
+    regressed = []
+    for name, result in results["stages"].items():
+        if name not in baseline.get("stages", {}):
+            continue
+        before = baseline["stages"][name]
+        speed = result["rows_per_sec"] / before["rows_per_sec"]
+        memory = result["peak_rss_mb"] / before["peak_rss_mb"]
+        slower = speed < 1 - tolerance
+        if slower:
+            regressed.append(name)
+        logging.info(
+            f"{name}: {speed:.2f}x rows/s, {memory:.2f}x peak RSS vs {baseline.get('commit')}"
+            + (" (regression)" if slower else "")
+        )
+    return regressed
+
+
+if __name__ == "__main__":
+    set_logging()
+    from src.benchmarks.stages import STAGES
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark of the generation, ingestion and serving stages, with local "
+                    "stand-ins for ClickHouse and QuestDB.",
+    )
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES), help="Stages to run.")
+    parser.add_argument("--n_aps", type=int, default=100_000, help="Number of access points.")
+    parser.add_argument("--n_sessions_per_ap", type=int, default=2, help="Sessions per access point.")
+    parser.add_argument("--n_records_per_session", type=int, default=3, help="Records per session.")
+    parser.add_argument("--batch_size", type=int, default=1_000_000, help="Records per generated batch.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated data.")
+    parser.add_argument("--repeat", type=int, default=3, help="Measured runs per stage.")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="JSON results file; data/benchmarks/<commit>.json by default.",
+    )
+    parser.add_argument("--baseline", type=str, default=None, help="Results file of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Throughput loss flagged as a regression.")
+    args = parser.parse_args()
+
+    sizes = {
+        "n_aps": args.n_aps,
+        "n_sessions_per_ap": args.n_sessions_per_ap,
+        "n_records_per_session": args.n_records_per_session,
+        "batch_size": args.batch_size,
+        "seed": args.seed,
+    }
+    results = run_suite(args.stages, sizes, args.repeat)
+    output = Path(args.output or f"data/benchmarks/{results['commit'] or 'unknown'}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    logging.info(f"Results written to {output}")
+    if args.baseline is not None:
+        regressed = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        if regressed:
+            raise SystemExit(f"Throughput regressed in {regressed}")
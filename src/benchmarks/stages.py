@@ -0,0 +1,182 @@
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+import src.data.access_point_generator as ap_gen
+import src.data.data_generator as data_gen
+import src.data.record_generator as rec_gen
+from src import ingestion
+from src.backend import ArrowStreamEncoder, encode_ndjson
+from src.bench_search import encode_direct, synthetic_rows
+from src.data import parameters
+from src.queries import COLUMNS
+from src.utils import load_config
+
+# every stage simulates the same hour
+BASE_TIME = datetime(2025, 11, 17)
+TIMESTAMP = BASE_TIME.isoformat()
+
+# Each stage is a pair of functions. setup(sizes, workdir) prepares the inputs
+# and returns a state, outside the measurement. run(state) does the work being
+# measured and yields the rows it processed after each unit of work, e.g. one
+# batch, so the time between yields is a latency sample.
+
+
+def write_access_points(n_aps: int, path: Path, seed: int) -> None:
+    """
+    Synthetic access point table in place of the OpenStreetMap-based one, so
+    benchmarks run offline and on identical data everywhere.
+    """
+    rng = np.random.default_rng(seed)
+    regions = rng.choice(parameters.regions, size=n_aps)
+    states = [rng.choice(parameters.region_to_states_map[region]) for region in regions]
+    all_states = [state for states in parameters.region_to_states_map.values() for state in states]
+    pd.DataFrame({
+        "longitude": rng.uniform(-124.0, -67.0, size=n_aps),
+        "latitude": rng.uniform(25.0, 49.0, size=n_aps),
+        "state": pd.Categorical(states, categories=all_states),
+        "region": pd.Categorical(regions, categories=parameters.regions),
+        "ap_id": np.arange(n_aps, dtype=np.int64),
+        "band": ap_gen.categorical_choice(rng, parameters.bands, n_aps),
+        "vendor_source": ap_gen.categorical_choice(rng, parameters.vendor_sources, n_aps),
+        "vendor_name": ap_gen.categorical_choice(rng, parameters.vendor_names, n_aps),
+        "model": ap_gen.categorical_choice(rng, parameters.models, n_aps),
+        "ssid": ap_gen.categorical_choice(rng, parameters.ssid_types, n_aps),
+    }).to_parquet(path, index=False)
+
+
+def _merged_batches(sizes: dict, workdir: Path):
+    data_gen.AP_FILE_PATH = workdir / "access_points.parquet"
+    if not data_gen.AP_FILE_PATH.exists():
+        write_access_points(sizes["n_aps"], data_gen.AP_FILE_PATH, sizes["seed"])
+        data_gen.ensure_ap_store()
+    return data_gen.generate_data(
+        sizes["n_aps"],
+        n_sessions_per_ap=sizes["n_sessions_per_ap"],
+        n_records_per_session=sizes["n_records_per_session"],
+        seed=sizes["seed"],
+        ap_range=(0, sizes["n_aps"]),
+        base_time=BASE_TIME,
+    )
+
+
+def setup_records(sizes: dict, workdir: Path) -> dict:
+    return {"sizes": sizes}
+
+
+def run_records(state: dict):
+    sizes = state["sizes"]
+    for batch in rec_gen.generate_records(
+        sizes["n_aps"],
+        BASE_TIME,
+        n_sessions_per_ap=sizes["n_sessions_per_ap"],
+        n_records_per_session=sizes["n_records_per_session"],
+        batch_size=sizes["batch_size"],
+        rng=np.random.default_rng(sizes["seed"]),
+    ):
+        yield len(batch)
+
+
+def setup_generate_data(sizes: dict, workdir: Path) -> dict:
+    _merged_batches(sizes, workdir)  # writes the access point table
+    return {"sizes": sizes, "workdir": workdir}
+
+
+def run_generate_data(state: dict):
+    for batch in _merged_batches(state["sizes"], state["workdir"]):
+        yield len(batch)
+
+
+def setup_csv_to_parquet(sizes: dict, workdir: Path) -> dict:
+    input_path = workdir / "raw.csv"
+    data_gen.write_csv(_merged_batches(sizes, workdir), input_path)
+    rows = sum(1 for _ in open(input_path)) - 1
+    return {"input_path": input_path, "output_path": workdir / "raw.parquet", "rows": rows}
+
+
+def run_csv_to_parquet(state: dict):
+    ingestion.csv_to_parquet(str(state["input_path"]), str(state["output_path"]))
+    yield state["rows"]
+
+
+def setup_aggregate_parquet(sizes: dict, workdir: Path) -> dict:
+    input_path = workdir / "raw.parquet"
+    data_gen.write_parquet(_merged_batches(sizes, workdir), input_path)
+    return {
+        "input_path": input_path,
+        "output_path": workdir / "aggregated.parquet",
+        "rows": pq.ParquetFile(input_path).metadata.num_rows,
+    }
+
+
+def run_aggregate_parquet(state: dict):
+    ingestion.aggregate_parquet(str(state["input_path"]), str(state["output_path"]), load_config())
+    yield state["rows"]
+
+
+def setup_sink(sizes: dict, workdir: Path) -> dict:
+    state = setup_aggregate_parquet(sizes, workdir)
+    next(run_aggregate_parquet(state))
+    return {"input_path": state["output_path"]}
+
+
+def _run_sink(state: dict, name: str):
+    cfg = load_config()
+    batches = pq.ParquetFile(state["input_path"]).iter_batches(batch_size=cfg.ingestion.chunk_rows)
+    yield ingestion.SINKS[name](batches, TIMESTAMP, cfg)
+
+
+def run_clickhouse(state: dict):
+    return _run_sink(state, "clickhouse")
+
+
+def run_questdb(state: dict):
+    return _run_sink(state, "questdb")
+
+
+def setup_search(sizes: dict, workdir: Path) -> dict:
+    # one row per access point, as in an hour of the wifi table
+    return {"rows": synthetic_rows(sizes["n_aps"]), "chunk_rows": load_config().api.stream_chunk_rows}
+
+
+def _chunks(state: dict):
+    rows, chunk_rows = state["rows"], state["chunk_rows"]
+    for start in range(0, len(rows), chunk_rows):
+        yield rows[start:start + chunk_rows]
+
+
+def run_search_json(state: dict):
+    for chunk in _chunks(state):
+        encode_direct(chunk)
+        yield len(chunk)
+
+
+def run_search_ndjson(state: dict):
+    for chunk in _chunks(state):
+        encode_ndjson(chunk)
+        yield len(chunk)
+
+
+def run_search_arrow(state: dict):
+    encoder = ArrowStreamEncoder(COLUMNS)
+    for chunk in _chunks(state):
+        encoder.encode(chunk)
+        yield len(chunk)
+    encoder.close()
+
+
+# stage name -> (setup, run), in pipeline order
+STAGES = {
+    "records": (setup_records, run_records),
+    "generate_data": (setup_generate_data, run_generate_data),
+    "csv_to_parquet": (setup_csv_to_parquet, run_csv_to_parquet),
+    "aggregate_parquet": (setup_aggregate_parquet, run_aggregate_parquet),
+    "clickhouse": (setup_sink, run_clickhouse),
+    "questdb": (setup_sink, run_questdb),
+    "search_json": (setup_search, run_search_json),
+    "search_ndjson": (setup_search, run_search_ndjson),
+    "search_arrow": (setup_search, run_search_arrow),
+}
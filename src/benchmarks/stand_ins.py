@@ -0,0 +1,116 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _reply(self, code: int, body: bytes = b"") -> None:
+        self.send_response(code)
+        self.send_header("Content-Type", "text/tab-separated-values")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandIn:
+    """
+    Local HTTP server standing in for a database, run on a daemon thread.
+    Requests are counted and their bodies discarded; use as a context manager.
+    """
+
+    handler = None
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.requests = 0
+        self.bytes = 0
+        self.rows = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self.handler)
+        self._server.stand_in = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def host(self) -> str:
+        return self._server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def record(self, n_bytes: int, rows: int = 0) -> None:
+        with self._lock:
+            self.requests += 1
+            self.bytes += n_bytes
+            self.rows += rows
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "bytes": self.bytes, "rows": self.rows}
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _ClickHouseHandler(_Handler):
+    def do_GET(self):
+        self._reply(200, b"Ok.\n")
+
+    def do_POST(self):
+        body = self._read_body()
+        self.server.stand_in.record(len(body))
+        # statements arrive in the body, inserts in the query string with the data as body
+        statement = body[:256].decode(errors="ignore")
+        if "version()" in statement:
+            self._reply(200, b"24.8.1.1\tUTC\n")
+        elif statement.startswith("EXISTS"):
+            self._reply(200, b"1\n")
+        else:
+            # an empty body is an empty result for queries and success for DDL and inserts
+            self._reply(200)
+
+
+class FakeClickHouse(StandIn):
+    """
+    Enough of the ClickHouse HTTP interface for clickhouse_connect to connect,
+    run DDL and insert Arrow data. Queries return empty results.
+    """
+
+    handler = _ClickHouseHandler
+
+
+class _ILPHandler(_Handler):
+    def do_GET(self):
+        # no /settings: the client falls back to the text protocol, one line per row
+        self._reply(404)
+
+    def do_POST(self):
+        body = self._read_body()
+        self.server.stand_in.record(len(body), rows=body.count(b"\n"))
+        self._reply(204)
+
+
+class FakeILP(StandIn):
+    """QuestDB's ILP over HTTP endpoint; counts the rows written to /write."""
+
+    handler = _ILPHandler
@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+import orjson
+
+from src import queries
+from src.utils import get_watermark, load_config
+
+
+def cache_key(endpoint: str, engine: str, request) -> bytes:
+    """
+    Normalized identity of a request: the same window written with another
+    offset, or fields listed in another order, map to the same key.
+    """
+    values = request.model_dump()
+    values["from_ts"] = queries.naive_utc(request.from_ts)
+    values["to_ts"] = queries.naive_utc(request.to_ts)
+    if values.get("fields") is not None:
+        values["fields"] = sorted(set(values["fields"]))
+    return orjson.dumps([endpoint, engine, values], option=orjson.OPT_SORT_KEYS)
+
+
+class ResultCache:
+    """
+    In-process LRU cache of encoded responses, bounded by their total size.
+
+    Hours older than the ingestion watermark are loaded, visible and no
+    longer change, so an entry whose window ends at or before the watermark
+    never expires. An entry that reaches into later hours lives open_ttl
+    seconds, since the open hour may still be loading. The watermark that
+    counts is the one read before the query ran: a result computed before
+    an hour was loaded must not be kept as final once the hour is.
+    """
+
+    def __init__(self, max_bytes: int, open_ttl: float):
+        self.max_bytes = max_bytes
+        self.open_ttl = open_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (body, expires_at or None)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                self._evict(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: bytes, body: bytes, to_ts: datetime, watermark: Optional[datetime]) -> None:
+        """Store a response computed when the ingestion watermark was watermark."""
+        if len(body) > self.max_bytes:
+            return
+        closed = watermark is not None and queries.naive_utc(to_ts) <= watermark
+        expires_at = None if closed else time.monotonic() + self.open_ttl
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            self._entries[key] = (body, expires_at)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                self._evict(next(iter(self._entries)))
+
+    def _evict(self, key: bytes) -> None:
+        body, _ = self._entries.pop(key)
+        self._bytes -= len(body)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else None,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "watermark": get_watermark(),
+            }
+
+
+_cache = None
+
+
+def get_result_cache() -> ResultCache:
+    """Process-wide result cache sized from api.cache."""
+    global _cache
+    if _cache is None:
+        cfg = load_config().api.cache
+        _cache = ResultCache(cfg.max_bytes, cfg.open_ttl_seconds)
+    return _cache
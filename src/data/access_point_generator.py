@@ -1,25 +1,72 @@
-
 import argparse
-import os
-import geopandas as gpd
-import osmnx as ox
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Union
 
+import geopandas as gpd
 import numpy as np
+import osmnx as ox
 import pandas as pd
+import pyarrow as pa
+import shapely
 
 import src.data.parameters as parameters
-from src.utils import timed, set_logging
-
-def sample_points_in_polygon(polygon, n_points, batch_size=50000):
-    """Uniformly sample n_points inside a shapely Polygon."""
+from src.instrumentation import timed
+from src.utils import set_logging
+
+# low-cardinality attributes stay dictionary-encoded (pandas categoricals)
+# from generation until they reach SYMBOL and LowCardinality columns
+DICTIONARY = pa.dictionary(pa.int32(), pa.string())
+
+SCHEMA = pa.schema([
+    ("longitude", pa.float64()),
+    ("latitude", pa.float64()),
+    ("state", DICTIONARY),
+    ("region", DICTIONARY),
+    ("ap_id", pa.int64()),
+    ("band", DICTIONARY),
+    ("vendor_source", DICTIONARY),
+    ("vendor_name", DICTIONARY),
+    ("model", DICTIONARY),
+    ("ssid", DICTIONARY),
+])
+
+def categorical_choice(rng: np.random.Generator, values: list, size: int) -> pd.Categorical:
+    """Like rng.choice(values, size), as codes into values rather than strings."""
+    return pd.Categorical.from_codes(rng.integers(0, len(values), size=size), categories=values)
+
+# state boundaries fetched from OpenStreetMap, kept so later runs work offline
+POLYGON_CACHE_PATH = Path("data/.metadata/state_polygons.parquet")
+
+# most random points drawn at once for one state; bounds memory per thread
+MAX_DRAWS = 4_000_000
+
+def sample_points_in_polygon(
+    polygon,
+    n_points: int,
+    rng: Optional[np.random.Generator] = None,
+    max_draws: int = MAX_DRAWS,
+) -> np.ndarray:
+    """
+    Uniformly sample n_points inside a shapely (Multi)Polygon by rejection
+    from its bounding box. Each batch is sized from the share of the box the
+    polygon covers, so most states need a single vectorized
+    shapely.contains_xy pass against the prepared polygon.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    shapely.prepare(polygon)
     minx, miny, maxx, maxy = polygon.bounds
+    fill = polygon.area / ((maxx - minx) * (maxy - miny))
     x_sample, y_sample = [], []
     current = 0
     while current < n_points:
-        x = np.random.uniform(minx, maxx, size=batch_size)
-        y = np.random.uniform(miny, maxy, size=batch_size)
-        is_inside = gpd.points_from_xy(x, y).within(polygon)
+        # 10% margin so the expected yield covers what is left
+        draws = min(int((n_points - current) / fill * 1.1) + 64, max_draws)
+        x = rng.uniform(minx, maxx, size=draws)
+        y = rng.uniform(miny, maxy, size=draws)
+        is_inside = shapely.contains_xy(polygon, x, y)
         x_sample.append(x[is_inside])
         y_sample.append(y[is_inside])
         current += is_inside.sum()
@@ -28,20 +75,43 @@ def sample_points_in_polygon(polygon, n_points, batch_size=50000):
         axis=1,
     )[:n_points]
 
-def get_state_polygons():
+def get_state_polygons(cache_path: Path = POLYGON_CACHE_PATH, refresh: bool = False) -> gpd.GeoDataFrame:
+    """
+    Boundaries of every state in parameters.region_to_states_map. They are
+    read from the GeoParquet cache at cache_path; only states missing from
+    it, or all of them with refresh, are geocoded through OSMnx, which needs
+    network access.
+    """
     state_names = [val for key, vals in parameters.region_to_states_map.items() for val in vals]
-    state_gdfs = []
-    for state in state_names:
-        state_gdf = ox.geocode_to_gdf(f"{state}, USA", which_result=1)
-        state_gdfs.append(state_gdf)
-
-    all_states_gdf = gpd.GeoDataFrame(pd.concat(state_gdfs, ignore_index=True))
-    logging.info("fetched state polygons from OSMnx")
-    return all_states_gdf.assign(state=state_names)
-
-def sample_locations(n_locations: int):
+    cached = None
+    if cache_path.exists() and not refresh:
+        cached = gpd.read_parquet(cache_path).set_index("state")
+    missing = [state for state in state_names if cached is None or state not in cached.index]
+    if missing:
+        fetched = gpd.GeoDataFrame(pd.concat(
+            [ox.geocode_to_gdf(f"{state}, USA", which_result=1) for state in missing],
+            ignore_index=True,
+        ))[["geometry"]].assign(state=missing).set_index("state")
+        logging.info(f"fetched {len(missing)} state polygons from OSMnx")
+        cached = fetched if cached is None else pd.concat([cached, fetched])
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cached.reset_index().to_parquet(cache_path)
+    return cached.loc[state_names].reset_index()
+
+def sample_locations(
+    n_locations: int,
+    seed: Optional[Union[int, np.random.SeedSequence]] = None,
+    workers: Optional[int] = None,
+    polygons: Optional[gpd.GeoDataFrame] = None,
+) -> pd.DataFrame:
+    """
+    Sample n_locations points spread evenly over the states. States are
+    sampled concurrently, each from its own child of a common SeedSequence,
+    so a seeded run gives the same points whatever the number of workers.
+    Shapely releases the GIL in contains_xy, so threads are enough.
+    """
     logging.info("Sampling user locations...")
-    all_states_gdf = get_state_polygons()
+    all_states_gdf = polygons if polygons is not None else get_state_polygons()
     state_to_region_map = {
         state: region
         for region, states in parameters.region_to_states_map.items()
@@ -49,31 +119,43 @@ def sample_locations(n_locations: int):
     }
     n_states = len(all_states_gdf)
     locations_per_state = n_locations // n_states + 1
-
-    samples = []
-    for _, row in all_states_gdf.iterrows():
-        state_polygon = row.geometry
-        points = sample_points_in_polygon(state_polygon, locations_per_state)
-        points_df = (pd
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds = seed.spawn(n_states)
+
+    def sample_state(i: int) -> pd.DataFrame:
+        state = all_states_gdf["state"].iloc[i]
+        points = sample_points_in_polygon(
+            all_states_gdf.geometry.iloc[i],
+            locations_per_state,
+            rng=np.random.default_rng(seeds[i]),
+        )
+        return (pd
             .DataFrame(points, columns=["longitude", "latitude"])
             .assign(
-                state=row['state'],
-                region=state_to_region_map[row['state']],
+                state=state,
+                region=state_to_region_map[state],
             )
         )
-        samples.append(points_df)
-    all_samples_df = pd.concat(samples, ignore_index=True)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        samples = list(pool.map(sample_state, range(n_states)))
+    all_samples_df = pd.concat(samples, ignore_index=True).astype({
+        "state": pd.CategoricalDtype(list(state_to_region_map)),
+        "region": pd.CategoricalDtype(parameters.regions),
+    })
     return all_samples_df[:n_locations]
 
-def sample_access_points(n_devices: int):
+def sample_access_points(n_devices: int, rng: Optional[np.random.Generator] = None):
     logging.info("Sampling access point attributes...")
+    rng = rng if rng is not None else np.random.default_rng()
 
-    bands = np.random.choice(parameters.bands, size=n_devices)
-    vendor_sources = np.random.choice(parameters.vendor_sources, size=n_devices)
-    vendor_names = np.random.choice(parameters.vendor_names, size=n_devices)
-    models = np.random.choice(parameters.models, size=n_devices)
-    ssids = np.random.choice(parameters.ssid_types, size=n_devices)
-    ap_id = list(range(n_devices))
+    bands = categorical_choice(rng, parameters.bands, n_devices)
+    vendor_sources = categorical_choice(rng, parameters.vendor_sources, n_devices)
+    vendor_names = categorical_choice(rng, parameters.vendor_names, n_devices)
+    models = categorical_choice(rng, parameters.models, n_devices)
+    ssids = categorical_choice(rng, parameters.ssid_types, n_devices)
+    ap_id = np.arange(n_devices, dtype=np.int64)
 
     return pd.DataFrame({
         "ap_id": ap_id,
@@ -86,12 +168,13 @@ def sample_access_points(n_devices: int):
 
 
 @timed
-def generate_data(n_points: int):
+def generate_data(n_points: int, seed: Optional[int] = None, workers: Optional[int] = None):
+    locations_seed, devices_seed = np.random.SeedSequence(seed).spawn(2)
     # Sample user locations
-    user_locations = sample_locations(n_points)
+    user_locations = sample_locations(n_points, seed=locations_seed, workers=workers)
 
     # Sample devices
-    devices = sample_access_points(n_points)
+    devices = sample_access_points(n_points, rng=np.random.default_rng(devices_seed))
 
     # Combine data
     data = pd.concat([user_locations, devices], axis=1)
@@ -112,9 +195,28 @@ if __name__ == "__main__":
         default="userbase.parquet",
         help="Path to save the generated userbase data.",
     )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for locations and attributes; omit for a non-reproducible run.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Threads sampling states concurrently; all cores by default.",
+    )
+    parser.add_argument(
+        "--refresh_polygons",
+        action="store_true",
+        help=f"Geocode the state polygons again instead of reading {POLYGON_CACHE_PATH}.",
+    )
     args = parser.parse_args()
 
-    data = generate_data(args.n_points)
+    if args.refresh_polygons:
+        get_state_polygons(refresh=True)
+    data = generate_data(args.n_points, seed=args.seed, workers=args.workers)
     # create output directory if it doesn't exist
     os.makedirs(os.path.dirname(args.output_path), exist_ok=True)
     data.to_parquet(args.output_path, index=False)
\ No newline at end of file
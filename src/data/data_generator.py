@@ -1,62 +1,165 @@
-
-from datetime import datetime, timedelta
-from pathlib import Path
 import argparse
 import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, Tuple, Union
 
-import src.data.access_point_generator as ap_gen
-import src.data.record_generator as rec_gen
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 import toml
 
-from src.utils import timed, set_logging
+import src.data.access_point_generator as ap_gen
+import src.data.record_generator as rec_gen
+from src import geo
+from src.instrumentation import timed
+from src.utils import load_config, set_logging
 
-@timed
-def generate_data(
-    n_aps: int,
-    n_sessions_per_ap: int=2,
-    n_records_per_session: int=1,
-):
-    
-    ap_file_path = Path("data/.metadata/access_points/data.parquet")
-    base_time = get_current_time()
+# H3 cell of each access point at every valid resolution; the store holds
+# those of geo.h3_resolutions, computed once since access points never move
+CELL_FIELDS = [pa.field(geo.cell_column(resolution), ap_gen.DICTIONARY) for resolution in range(16)]
+
+# columns of a merged record/access point batch, keyed by name
+RAW_FIELDS = {
+    field.name: field
+    for field in list(rec_gen.SCHEMA) + list(ap_gen.SCHEMA) + CELL_FIELDS
+}
+
+AP_FILE_PATH = Path("data/.metadata/access_points/data.parquet")
+
+def ensure_access_points(n_aps: int) -> None:
+    """(Re)generate the access point table if it is missing or too small."""
     regenerate = False
-    if ap_file_path.exists():
-        _ = pd.read_parquet(
-            ap_file_path,
-            columns=["ap_id"],
-        )
-        if len(_) < n_aps:
+    if AP_FILE_PATH.exists():
+        if pq.ParquetFile(AP_FILE_PATH).metadata.num_rows < n_aps:
             regenerate = True
     else:
         regenerate = True
-    
+
     if regenerate:
         ap_data = ap_gen.sample_access_points(n_aps)
-        ap_data.to_parquet(ap_file_path, index=False)
-    else:
-        logging.info("Reading existing access point data...")
-        ap_data = pd.read_parquet(ap_file_path)
+        AP_FILE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        ap_data.to_parquet(AP_FILE_PATH, index=False)
+
+def ap_store_path() -> Path:
+    return AP_FILE_PATH.with_suffix(".arrow")
+
+def _store_is_current(path: Path, cell_columns: list) -> bool:
+    if not path.exists() or path.stat().st_mtime_ns < AP_FILE_PATH.stat().st_mtime_ns:
+        return False
+    with pa.memory_map(str(path)) as source:
+        names = pa.ipc.open_file(source).schema.names
+    # tables without locations have no cells to add
+    return "latitude" not in names or all(name in names for name in cell_columns)
+
+def ensure_ap_store() -> Path:
+    """
+    Build the access point store from the Parquet table if it is missing,
+    older, or lacks the H3 cell column of a resolution in geo.h3_resolutions:
+    an uncompressed Feather file, sorted by ap_id, in a single record batch
+    so it can be memory-mapped and gathered from without first concatenating
+    chunks. Row i holds ap_id i, which the build checks.
+    """
+    path = ap_store_path()
+    resolutions = list(load_config().geo.h3_resolutions)
+    if _store_is_current(path, [geo.cell_column(resolution) for resolution in resolutions]):
+        return path
+    logging.info(f"Building the access point store {path}...")
+    table = pq.read_table(AP_FILE_PATH).sort_by("ap_id")
+    # tables from ensure_access_points have no locations; keep what is there
+    schema = pa.schema([field for field in ap_gen.SCHEMA if field.name in table.column_names])
+    table = table.select(schema.names).cast(schema)
+    if not pc.all(pc.equal(table["ap_id"], pa.array(np.arange(len(table), dtype=np.int64)))).as_py():
+        raise ValueError(f"ap_id in {AP_FILE_PATH} is not the dense range 0..{len(table) - 1}.")
+    if "latitude" in table.column_names:
+        latitudes = table["latitude"].to_numpy()
+        longitudes = table["longitude"].to_numpy()
+        for resolution in resolutions:
+            cells = pa.array(geo.cells(latitudes, longitudes, resolution), type=pa.string())
+            table = table.append_column(RAW_FIELDS[geo.cell_column(resolution)], cells.dictionary_encode())
+    # sharded workers may race to build it; each writes its own file and renames
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    feather.write_feather(table, tmp_path, compression="uncompressed", chunksize=max(1, len(table)))
+    tmp_path.replace(path)
+    return path
+
+# (mtime_ns, table) of the store this process mapped, reused until it is rebuilt
+_mapped_store = (None, None)
+
+def open_access_points(columns: Optional[list] = None) -> pa.Table:
+    """
+    Memory-map the access point store; pages are only read as rows are
+    gathered. The mapping is kept for later calls in the same process, so a
+    long-lived worker keeps its pages warm across hours. Without columns,
+    every column but ap_id is returned.
+    """
+    global _mapped_store
+    path = ensure_ap_store()
+    mtime = path.stat().st_mtime_ns
+    if _mapped_store[0] != mtime:
+        with pa.memory_map(str(path)) as source:
+            _mapped_store = (mtime, pa.ipc.open_file(source).read_all())
+    table = _mapped_store[1]
+    if columns is None:
+        columns = [name for name in table.column_names if name != "ap_id"]
+    return table.select([name for name in columns if name in table.column_names])
+
+def join_access_points(records: pd.DataFrame, ap_table: pa.Table) -> pa.Table:
+    """
+    Append the access point columns to a record batch by gathering the rows
+    at each record's ap_id, which is also its row number in the store.
+    """
+    batch = pa.Table.from_pandas(records, schema=raw_schema(records.columns), preserve_index=False)
+    gathered = ap_table.take(pa.array(records["ap_id"].to_numpy()))
+    for name in gathered.column_names:
+        batch = batch.append_column(RAW_FIELDS[name], gathered[name])
+    return batch
+
+@timed
+def generate_data(
+    n_aps: int,
+    n_sessions_per_ap: int=2,
+    n_records_per_session: int=1,
+    seed: Optional[Union[int, np.random.SeedSequence]]=None,
+    ap_range: Optional[Tuple[int, int]]=None,
+    base_time: Optional[datetime]=None,
+    ap_columns: Optional[list]=None,
+):
+    """
+    Yield record batches joined with their access point, as Arrow tables,
+    for one hour. Only the ap_columns (every store column but ap_id by
+    default, H3 cells included) are joined.
 
-    ap_data['ap_id'] = ap_data['ap_id'].astype(int)
+    When ap_range is given only access points in [start, stop) are simulated;
+    the access point table is then expected to exist already.
+    """
+    if base_time is None:
+        base_time = get_current_time()
+    if ap_range is None:
+        ensure_access_points(n_aps)
+        ap_range = (0, n_aps)
+    ap_start, ap_stop = ap_range
+
+    ap_table = open_access_points(ap_columns)
     logging.info("Generating record data...")
     record_generator = rec_gen.generate_records(
-        n_aps=n_aps,
+        n_aps=ap_stop - ap_start,
         base_time=base_time,
         n_sessions_per_ap=n_sessions_per_ap,
         n_records_per_session=n_records_per_session,
+        rng=np.random.default_rng(seed),
+        ap_offset=ap_start,
     )
 
     for rec_data in record_generator:
-        rec_data['ap_id'] = rec_data['ap_id'].astype(int)
-
-        logging.info("Merging record and access point data...")
-        data_chunk = rec_data.merge(
-            ap_data,
-            on="ap_id",
-            how="left",
-        )
-        yield data_chunk
+        logging.info("Joining record and access point data...")
+        yield join_access_points(rec_data, ap_table)
 
 def get_current_time():
     with open("data/.metadata/config.toml", "r") as f:
@@ -64,8 +167,9 @@ def get_current_time():
     return datetime.fromisoformat(config["params"]["current_time"])
 
 def bump_current_time(hours: int = 1):
-    current_time = get_current_time()
-    new_time = current_time + timedelta(hours=hours)
+    set_current_time(get_current_time() + timedelta(hours=hours))
+
+def set_current_time(new_time: datetime):
     with open("data/.metadata/config.toml", "r") as f:
         config = toml.load(f)
     config["params"]["current_time"] = new_time.isoformat()
@@ -73,23 +177,188 @@ def bump_current_time(hours: int = 1):
         toml.dump(config, f)
 
 
+def raw_schema(columns) -> pa.Schema:
+    """Fixed Arrow schema of a raw batch with the given columns."""
+    return pa.schema([RAW_FIELDS[col] for col in columns])
+
+
+def write_csv(batches, output_path: Path) -> None:
+    for batch in batches:
+        logging.info(f"Persisting {len(batch)} records to {output_path}...")
+        # through pandas, so the text format of existing files is kept
+        batch.to_pandas().to_csv(output_path, index=False, mode='a', header=not output_path.exists())
+
+
+def write_parquet(
+    batches,
+    output_path: Path,
+    compression: str = "zstd",
+    compression_level: int = 1,
+) -> None:
+    """
+    Stream Arrow batches into a single Parquet file with a fixed schema.
+
+    The file is written under a temporary name and renamed once complete,
+    so ingestion never picks up a partially written hour.
+    """
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    writer = None
+    try:
+        for batch in batches:
+            if writer is None:
+                schema = raw_schema(batch.column_names)
+                writer = pq.ParquetWriter(
+                    tmp_path,
+                    schema,
+                    compression=compression,
+                    compression_level=compression_level,
+                )
+            logging.info(f"Persisting {len(batch)} records to {output_path}...")
+            writer.write_table(batch.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        tmp_path.rename(output_path)
+
+
+def _persist_shard(
+    ap_range: Tuple[int, int],
+    seed: np.random.SeedSequence,
+    base_time: datetime,
+    output_path: Path,
+    n_sessions_per_ap: int,
+    n_records_per_session: int,
+) -> Path:
+    """Generate the access points in ap_range and write them to one part file."""
+    set_logging()
+    data_generator = generate_data(
+        n_aps=ap_range[1] - ap_range[0],
+        n_sessions_per_ap=n_sessions_per_ap,
+        n_records_per_session=n_records_per_session,
+        seed=seed,
+        ap_range=ap_range,
+        base_time=base_time,
+    )
+    write_parquet(data_generator, output_path)
+    return output_path
+
+
+def persist_shards(
+    n_aps: int,
+    base_time: datetime,
+    workers: int,
+    n_sessions_per_ap: int=2,
+    n_records_per_session: int=1,
+    seed: Optional[Union[int, np.random.SeedSequence]]=None,
+) -> Path:
+    """
+    Generate one hour in parallel, one shard of the ap_id range per worker.
+
+    Each shard draws from its own child of a common SeedSequence, so a seeded
+    run is reproducible for a given number of workers. Shards write
+    data/raw/{base_time}/part-XXXX.parquet; the directory is only renamed into
+    place once every part is complete. Parts left by an interrupted run are
+    cleared first, and an existing directory for the hour is replaced, as the
+    single-file formats overwrite theirs.
+    """
+    ensure_access_points(n_aps)
+    ensure_ap_store()
+    output_dir = Path(f"data/raw/{base_time}")
+    tmp_dir = output_dir.with_name(output_dir.name + ".tmp")
+    if tmp_dir.exists():
+        # a run with more workers would leave parts this one does not overwrite
+        logging.info(f"Clearing {tmp_dir}, left by an interrupted run.")
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    bounds = np.linspace(0, n_aps, workers + 1).astype(int)
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds = seed.spawn(workers)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                _persist_shard,
+                (int(bounds[i]), int(bounds[i + 1])),
+                seeds[i],
+                base_time,
+                tmp_dir / f"part-{i:04d}.parquet",
+                n_sessions_per_ap,
+                n_records_per_session,
+            )
+            for i in range(workers)
+            if bounds[i] < bounds[i + 1]
+        ]
+        for future in futures:
+            logging.info(f"Shard written to {future.result()}")
+    if output_dir.exists():
+        logging.warning(f"{output_dir} already exists; replacing it with the hour just generated.")
+        shutil.rmtree(output_dir)
+    tmp_dir.rename(output_dir)
+    return output_dir
+
+
 @timed
 def persist_data(
     n_aps: int,
     n_sessions_per_ap: int=2,
     n_records_per_session: int=1,
+    seed: Optional[int]=None,
+    output_format: str="csv",
+    workers: int=1,
 ):
-    base_time = get_current_time()
-    output_path = Path(f"data/csv/{base_time}.csv")
-    data_generator = generate_data(
+    """Generate the hour at the clock in data/.metadata/config.toml, then advance the clock."""
+    persist_hour(
+        get_current_time(),
         n_aps=n_aps,
         n_sessions_per_ap=n_sessions_per_ap,
         n_records_per_session=n_records_per_session,
+        seed=seed,
+        output_format=output_format,
+        workers=workers,
     )
-    for batch in data_generator:
-        logging.info(f"Persisting {len(batch)} records to {output_path}...")
-        batch.to_csv(output_path, index=False, mode='a', header=not output_path.exists())
     bump_current_time(hours=1)
+
+def persist_hour(
+    base_time: datetime,
+    n_aps: int,
+    n_sessions_per_ap: int=2,
+    n_records_per_session: int=1,
+    seed: Optional[Union[int, np.random.SeedSequence]]=None,
+    output_format: str="csv",
+    workers: int=1,
+) -> Path:
+    """Generate the hour starting at base_time and write it where ingestion looks for it."""
+    if workers > 1:
+        if output_format != "parquet":
+            raise ValueError("Sharded generation writes Parquet part files; use output_format='parquet'.")
+        return persist_shards(
+            n_aps=n_aps,
+            base_time=base_time,
+            workers=workers,
+            n_sessions_per_ap=n_sessions_per_ap,
+            n_records_per_session=n_records_per_session,
+            seed=seed,
+        )
+
+    data_generator = generate_data(
+        n_aps=n_aps,
+        n_sessions_per_ap=n_sessions_per_ap,
+        n_records_per_session=n_records_per_session,
+        seed=seed,
+        base_time=base_time,
+    )
+    if output_format == "csv":
+        output_path = Path(f"data/csv/{base_time}.csv")
+        write_csv(data_generator, output_path)
+    elif output_format == "parquet":
+        output_path = Path(f"data/raw/{base_time}.parquet")
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        write_parquet(data_generator, output_path)
+    else:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    return output_path
     
 
 if __name__ == "__main__":
@@ -114,9 +383,31 @@ if __name__ == "__main__":
         default=1,
         help="Number of records per session.",
     )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for the record generator; omit for a non-reproducible run.",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="csv",
+        choices=["csv", "parquet"],
+        help="csv appends to data/csv/; parquet writes typed batches to data/raw/.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes; more than one shards the ap_id range into part files.",
+    )
     args = parser.parse_args()
     persist_data(
         n_aps=args.n_aps,
         n_sessions_per_ap=args.n_sessions_per_ap,
         n_records_per_session=args.n_records_per_session,
+        seed=args.seed,
+        output_format=args.output_format,
+        workers=args.workers,
     )
\ No newline at end of file
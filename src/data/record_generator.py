@@ -1,122 +1,196 @@
-import random
+from typing import Optional
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from src.data import parameters
 
+COLUMNS = [
+    "session_id", "user_mac", "timestamp", "rssi", "noise_floor", "snr",
+    "bytes_in", "bytes_out", "packets_in", "packets_out", "throughput_mbps",
+    "retries", "errors", "tx_power", "rx_power", "tx_rate", "rx_rate",
+    "mcs_tx", "mcs_rx", "assoc_clients", "roam_events", "ap_temperature",
+    "uptime_sec", "fw_version",  "channel", "channel_width", "ap_id",
+]
+
+SCHEMA = pa.schema([
+    ("session_id", pa.string()),
+    ("user_mac", pa.string()),
+    ("timestamp", pa.timestamp("us")),
+    ("rssi", pa.int64()),
+    ("noise_floor", pa.int64()),
+    ("snr", pa.int64()),
+    ("bytes_in", pa.int64()),
+    ("bytes_out", pa.int64()),
+    ("packets_in", pa.int64()),
+    ("packets_out", pa.int64()),
+    ("throughput_mbps", pa.float64()),
+    ("retries", pa.int64()),
+    ("errors", pa.int64()),
+    ("tx_power", pa.int64()),
+    ("rx_power", pa.int64()),
+    ("tx_rate", pa.int64()),
+    ("rx_rate", pa.int64()),
+    ("mcs_tx", pa.int64()),
+    ("mcs_rx", pa.int64()),
+    ("assoc_clients", pa.int64()),
+    ("roam_events", pa.int64()),
+    ("ap_temperature", pa.float64()),
+    ("uptime_sec", pa.int64()),
+    ("fw_version", pa.dictionary(pa.int32(), pa.string())),
+    ("channel", pa.int64()),
+    ("channel_width", pa.int64()),
+    ("ap_id", pa.int64()),
+])
+
+# two-digit lowercase hex strings, indexed by value
+_HEX = np.array([f"{v:02x}" for v in range(256)])
+# every "major.minor.patch" firmware string, indexed by major * 1000 + minor * 100 + patch
+_FW_VERSIONS = np.array([f"{v // 1000}.{v // 100 % 10}.{v % 100}" for v in range(4000)])
+
+
+def _join(*parts, sep: str = "") -> np.ndarray:
+    """Element-wise string concatenation of equally sized arrays."""
+    out = np.asarray(parts[0]).astype(str)
+    for part in parts[1:]:
+        if sep:
+            out = np.char.add(out, sep)
+        out = np.char.add(out, np.asarray(part).astype(str))
+    return out
+
+
+def _session_batch(
+    rng: np.random.Generator,
+    session_idx: np.ndarray,
+    base_time: datetime,
+    n_sessions_per_ap: int,
+    n_records_per_session: int,
+) -> pd.DataFrame:
+    """
+    Generate every record of the given sessions as typed column arrays.
+
+    Session-level values have shape (n_sessions,) and record-level values
+    have shape (n_sessions, n_records_per_session); the latter are flattened
+    row-major so records of a session stay contiguous and ordered.
+    """
+    n = len(session_idx)
+    shape = (n, n_records_per_session)
+    ap_id = session_idx // n_sessions_per_ap
+    j = session_idx % n_sessions_per_ap
+
+    # session-level attributes
+    session_id = _join(
+        "AP:", ap_id, ":", j, ":S", rng.integers(100000, 999999, size=n, endpoint=True),
+    )
+    octets = _HEX[rng.integers(10, 99, size=(5, n), endpoint=True)]
+    user_mac = _join("00", *octets, sep=":")
+    start_minutes = rng.integers(0, 60, size=n, endpoint=True)
+
+    # record-level attributes
+    k = np.arange(n_records_per_session)
+    minutes = start_minutes[:, None] + k[None, :] * rng.integers(1, 3, size=shape, endpoint=True)
+    timestamp = np.datetime64(base_time, "us") + minutes.astype("timedelta64[m]")
+
+    rssi = rng.integers(-85, -45, size=shape, endpoint=True)
+    noise_floor = rng.integers(-95, -75, size=shape, endpoint=True)
+    delta_bytes_in = rng.integers(20_000, 100_000, size=shape, endpoint=True)
+    delta_bytes_out = rng.integers(20_000, 100_000, size=shape, endpoint=True)
+    delta_pkts_in = delta_bytes_in // rng.integers(500, 1500, size=shape, endpoint=True)
+    delta_pkts_out = delta_bytes_out // rng.integers(500, 1500, size=shape, endpoint=True)
+    # codes into _FW_VERSIONS; the strings are never materialized per record
+    fw_version = pd.Categorical.from_codes(
+        rng.integers(1, 3, size=n * n_records_per_session, endpoint=True) * 1000
+        + rng.integers(0, 9, size=n * n_records_per_session, endpoint=True) * 100
+        + rng.integers(0, 99, size=n * n_records_per_session, endpoint=True),
+        categories=_FW_VERSIONS,
+    )
+
+    def flat(values: np.ndarray) -> np.ndarray:
+        return values.reshape(-1)
+
+    def per_record(values: np.ndarray) -> np.ndarray:
+        return np.repeat(values, n_records_per_session)
+
+    return pd.DataFrame({
+        "session_id": per_record(session_id),
+        "user_mac": per_record(user_mac),
+        "timestamp": flat(timestamp),
+        "rssi": flat(rssi),
+        "noise_floor": flat(noise_floor),
+        "snr": flat(rssi - noise_floor),
+        # cumulative counters restart with every session
+        "bytes_in": flat(np.cumsum(delta_bytes_in, axis=1)),
+        "bytes_out": flat(np.cumsum(delta_bytes_out, axis=1)),
+        "packets_in": flat(np.cumsum(delta_pkts_in, axis=1)),
+        "packets_out": flat(np.cumsum(delta_pkts_out, axis=1)),
+        "throughput_mbps": flat(np.round((delta_bytes_in + delta_bytes_out) * 8 / (60 * 1e6), 2)),
+        "retries": rng.integers(0, 50, size=n * n_records_per_session, endpoint=True),
+        "errors": rng.integers(0, 10, size=n * n_records_per_session, endpoint=True),
+        "tx_power": rng.integers(15, 30, size=n * n_records_per_session, endpoint=True),  # dBm
+        "rx_power": flat(rssi),
+        "tx_rate": rng.integers(6, 1200, size=n * n_records_per_session, endpoint=True),  # Mbps
+        "rx_rate": rng.integers(6, 1200, size=n * n_records_per_session, endpoint=True),  # Mbps
+        "mcs_tx": rng.integers(0, 11, size=n * n_records_per_session, endpoint=True),
+        "mcs_rx": rng.integers(0, 11, size=n * n_records_per_session, endpoint=True),
+        "assoc_clients": rng.integers(1, 50, size=n * n_records_per_session, endpoint=True),
+        "roam_events": rng.integers(0, 5, size=n * n_records_per_session, endpoint=True),
+        "ap_temperature": np.round(rng.uniform(25.0, 45.0, size=n * n_records_per_session), 1),
+        "uptime_sec": rng.integers(10_000, 500_000, size=n * n_records_per_session, endpoint=True),
+        "fw_version": fw_version,
+        "channel": rng.choice(np.asarray(parameters.channels, dtype=np.int64), size=n * n_records_per_session),
+        "channel_width": rng.choice(np.asarray(parameters.channel_widths, dtype=np.int64), size=n * n_records_per_session),
+        "ap_id": per_record(ap_id),
+    }, columns=COLUMNS)
+
+
 def generate_records(
     n_aps: int,
     base_time: datetime,
     n_sessions_per_ap: int=2,
     n_records_per_session: int=1,
     batch_size: int=1_000_000,
+    rng: Optional[np.random.Generator]=None,
+    ap_offset: int=0,
 ):
     """
     Generator that yields batches of records as DataFrames.
-    
+
+    Records are generated column-wise with NumPy, a whole batch of sessions
+    at a time. Batches always hold complete sessions, so cumulative counters
+    never straddle two batches; a batch_size smaller than one session is
+    rejected with a ValueError.
+
     Args:
         n_aps: Number of access points
         base_time: Base timestamp for record generation
         n_sessions_per_ap: Number of sessions per access point
         n_records_per_session: Number of records per session
         batch_size: Maximum number of records per batch (default: 1,000,000)
-        
+        rng: Random generator to draw from; pass a seeded one for reproducible runs
+        ap_offset: First access point ID, so shards can cover disjoint ap_id ranges
+
     Yields:
-        pd.DataFrame: Batches of records with size <= batch_size
+        pd.DataFrame: Batches of typed records with size <= batch_size
     """
-    records = []
-    columns = [
-        "session_id", "user_mac", "timestamp", "rssi", "noise_floor", "snr",
-        "bytes_in", "bytes_out", "packets_in", "packets_out", "throughput_mbps",
-        "retries", "errors", "tx_power", "rx_power", "tx_rate", "rx_rate",
-        "mcs_tx", "mcs_rx", "assoc_clients", "roam_events", "ap_temperature",
-        "uptime_sec", "fw_version",  "channel", "channel_width", "ap_id",
-    ]
-    
-    for i in range(n_aps):
-        for j in range(n_sessions_per_ap):
-            ap_id = i
-            session_id = f"AP:{i}:{j}:S{random.randint(100000, 999999)}"
-            user_mac = f"00:{random.randint(10,99):02x}:{random.randint(10,99):02x}:{random.randint(10,99):02x}:{random.randint(10,99):02x}:{random.randint(10,99):02x}" # 
-            start_time = base_time + timedelta(minutes=random.randint(0, 60))
-            
-            # Initialize cumulative counters
-            bytes_in = 0
-            bytes_out = 0
-            packets_in = 0
-            packets_out = 0
-            for k in range(n_records_per_session):
-
-                timestamp = start_time + timedelta(minutes=k * random.randint(1, 3))
-                # Signal & performance metrics
-                rssi = random.randint(-85, -45)
-                noise_floor = random.randint(-95, -75)
-                snr = rssi - noise_floor
-                delta_bytes_in = random.randint(20_000, 100_000)
-                delta_bytes_out = random.randint(20_000, 100_000)
-                bytes_in += delta_bytes_in
-                bytes_out += delta_bytes_out
-                delta_pkts_in = delta_bytes_in // random.randint(500, 1500)
-                delta_pkts_out = delta_bytes_out // random.randint(500, 1500)
-                packets_in += delta_pkts_in
-                packets_out += delta_pkts_out
-                throughput_mbps = round((delta_bytes_in + delta_bytes_out) * 8 / (60 * 1e6), 2)
-                retries = random.randint(0, 50)
-                errors = random.randint(0, 10)
-
-                # Additional AP / band metrics
-                tx_power = random.randint(15, 30)  # dBm
-                rx_power = rssi
-                tx_rate = random.randint(6, 1200)  # Mbps
-                rx_rate = random.randint(6, 1200)  # Mbps
-                mcs_tx = random.randint(0, 11)
-                mcs_rx = random.randint(0, 11)
-                assoc_clients = random.randint(1, 50)
-                roam_events = random.randint(0, 5)
-                ap_temperature = round(random.uniform(25.0, 45.0), 1)
-                uptime_sec = random.randint(10_000, 500_000)
-                fw_version = f"{random.randint(1,3)}.{random.randint(0,9)}.{random.randint(0,99)}"
-                channel = random.choice(parameters.channels)
-                channel_width = random.choice(parameters.channel_widths)
-                records.append(np.array(
-                    [
-                        session_id,
-                        user_mac,
-                        timestamp.isoformat(),
-                        rssi,
-                        noise_floor,
-                        snr,
-                        bytes_in,
-                        bytes_out,
-                        packets_in,
-                        packets_out,
-                        throughput_mbps,
-                        retries,
-                        errors,
-                        tx_power,
-                        rx_power,
-                        tx_rate,
-                        rx_rate,
-                        mcs_tx,
-                        mcs_rx,
-                        assoc_clients,
-                        roam_events,
-                        ap_temperature,
-                        uptime_sec,
-                        fw_version,
-                        channel,
-                        channel_width,
-                        ap_id,
-                    ]
-                ))
-                
-                # Yield batch when it reaches the specified size
-                if len(records) >= batch_size:
-                    yield pd.DataFrame(np.stack(records), columns=columns)
-                    records = []
-    
-    # Yield remaining records if any
-    if records:
-        yield pd.DataFrame(np.stack(records), columns=columns)
+    if n_records_per_session > batch_size:
+        raise ValueError(
+            f"batch_size {batch_size} is smaller than one session of {n_records_per_session} "
+            "records; batches hold whole sessions."
+        )
+    if rng is None:
+        rng = np.random.default_rng()
+
+    first_session = ap_offset * n_sessions_per_ap
+    last_session = (ap_offset + n_aps) * n_sessions_per_ap
+    sessions_per_batch = batch_size // max(1, n_records_per_session)
+    for start in range(first_session, last_session, sessions_per_batch):
+        session_idx = np.arange(start, min(start + sessions_per_batch, last_session), dtype=np.int64)
+        yield _session_batch(
+            rng,
+            session_idx,
+            base_time=base_time,
+            n_sessions_per_ap=n_sessions_per_ap,
+            n_records_per_session=n_records_per_session,
+        )
@@ -0,0 +1,147 @@
+import asyncio
+from typing import AsyncIterator, Optional
+
+import pyarrow as pa
+
+from src import queries
+from src.utils import clickhouse_client, get_questdb_pool, load_config
+
+
+class QueryEngine:
+    """
+    Store the API reads from. An engine runs SQL compiled with its dialect and
+    returns rows as mappings of column name to value, either all at once or
+    in chunks.
+    """
+
+    name = None
+    dialect = None
+
+    def __init__(self):
+        self.params = load_config().db[self.name].params
+
+    @property
+    def table_name(self) -> str:
+        return self.params.table_name
+
+    async def fetch(self, sql: str, params) -> list:
+        raise NotImplementedError
+
+    def stream(self, sql: str, params, chunk_rows: int, max_rows: Optional[int] = None) -> AsyncIterator[list]:
+        raise NotImplementedError
+
+
+class QuestDBEngine(QueryEngine):
+    """QuestDB over the PostgreSQL wire protocol, from the asyncpg pool of the running loop."""
+
+    name = "questdb"
+    dialect = queries.QUESTDB
+
+    async def fetch(self, sql: str, params: list) -> list:
+        pool = await get_questdb_pool()
+        async with pool.acquire() as conn:
+            return await conn.fetch(sql, *params)
+
+    async def stream(self, sql: str, params: list, chunk_rows: int, max_rows: Optional[int] = None):
+        """
+        Yield result rows in chunks from a server-side cursor, so only one chunk
+        is held in memory at a time. Stops after max_rows rows if given.
+        """
+        pool = await get_questdb_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(sql, *params)
+                remaining = max_rows
+                while remaining is None or remaining > 0:
+                    size = chunk_rows if remaining is None else min(chunk_rows, remaining)
+                    rows = await cursor.fetch(size)
+                    if not rows:
+                        return
+                    if remaining is not None:
+                        remaining -= len(rows)
+                    yield rows
+
+
+class ClickHouseEngine(QueryEngine):
+    """
+    ClickHouse over HTTP with query_arrow, from the process-wide client pool.
+    The client is synchronous, so calls run in worker threads.
+
+    Every query carries the time window on `timestamp`, which prunes
+    partitions (toYYYYMMDD) and granules (toStartOfHour primary key), and its
+    equality filters hit the bloom filter and set skip indexes of
+    db/clickhouse-schema.sql. `query_settings` from the config are sent with
+    every query, e.g. to make ClickHouse refuse queries that would not prune.
+    """
+
+    name = "clickhouse"
+    dialect = queries.CLICKHOUSE
+
+    def __init__(self):
+        super().__init__()
+        self.settings = dict(self.params.get("query_settings") or {})
+
+    def _query_arrow(self, sql: str, params: dict) -> pa.Table:
+        with clickhouse_client() as client:
+            return client.query_arrow(sql, parameters=params, settings=self.settings, use_strings=True)
+
+    def _batches(self, sql: str, params: dict):
+        with clickhouse_client() as client:
+            with client.query_arrow_stream(sql, parameters=params, settings=self.settings, use_strings=True) as batches:
+                yield from batches
+
+    async def fetch(self, sql: str, params: dict) -> list:
+        table = await asyncio.to_thread(self._query_arrow, sql, params)
+        return table.to_pylist()
+
+    async def stream(self, sql: str, params: dict, chunk_rows: int, max_rows: Optional[int] = None):
+        """
+        Yield result rows in chunks of at most chunk_rows, re-slicing the
+        blocks ClickHouse sends. Stops after max_rows rows if given.
+        """
+        batches = self._batches(sql, params)
+        remaining = max_rows
+        try:
+            while remaining is None or remaining > 0:
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    return
+                if remaining is not None:
+                    batch = batch.slice(0, remaining)
+                    remaining -= batch.num_rows
+                for offset in range(0, batch.num_rows, chunk_rows):
+                    yield batch.slice(offset, chunk_rows).to_pylist()
+        finally:
+            # returns the client to the pool even when the consumer stops early
+            await asyncio.to_thread(batches.close)
+
+
+ENGINES = {
+    "questdb": QuestDBEngine,
+    "clickhouse": ClickHouseEngine,
+}
+
+_engines = {}
+
+
+def check_engine(cfg) -> None:
+    """Raise if api.engine names a store that ingestion does not load, so the API would serve an empty table."""
+    engine, sinks = cfg.api.engine, list(cfg.ingestion.sinks)
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown query engine {engine!r} in api.engine; choose from {sorted(ENGINES)}")
+    if engine not in sinks:
+        raise ValueError(
+            f"api.engine is {engine!r} but ingestion.sinks is {sinks}, so the API would read a table "
+            f"ingestion never fills. Set api.engine to one of the sinks or add {engine!r} to ingestion.sinks."
+        )
+
+
+def get_engine(name: Optional[str] = None) -> QueryEngine:
+    """Engine by name, or the one configured under api.engine; one instance per process."""
+    if name is None:
+        name = load_config().api.engine
+    if name not in ENGINES:
+        raise ValueError(f"Unknown query engine {name!r}; choose from {sorted(ENGINES)}")
+    if name not in _engines:
+        _engines[name] = ENGINES[name]()
+    return _engines[name]
@@ -0,0 +1,106 @@
+import math
+from typing import List, Optional, Sequence, Tuple
+
+import h3
+import numpy as np
+import polars as pl
+
+KM_PER_DEGREE = 111.32
+
+
+def cell_column(resolution: int) -> str:
+    """Name of the column holding the H3 cell of each row at this resolution."""
+    return f"h3_r{resolution}"
+
+
+def cells(latitudes: np.ndarray, longitudes: np.ndarray, resolution: int) -> List[str]:
+    """H3 cell of every coordinate pair at one resolution."""
+    return [h3.latlng_to_cell(lat, lng, resolution) for lat, lng in zip(latitudes, longitudes)]
+
+
+def _cells(coords: pl.Series, resolution: int) -> pl.Series:
+    latitudes = coords.struct.field("latitude").to_numpy()
+    longitudes = coords.struct.field("longitude").to_numpy()
+    return pl.Series(cells(latitudes, longitudes, resolution), dtype=pl.String)
+
+
+def cell_expressions(resolutions: Sequence[int], lat: str = "latitude", lon: str = "longitude") -> List[pl.Expr]:
+    """
+    One H3 cell column per resolution, from the row's coordinates. This runs
+    h3 once per row; raw hours from the generator already carry the cells of
+    their access point, see data_generator.ensure_ap_store.
+    """
+    coords = pl.struct(pl.col(lat).alias("latitude"), pl.col(lon).alias("longitude"))
+    return [
+        coords.map_batches(
+            lambda batch, resolution=resolution: _cells(batch, resolution),
+            return_dtype=pl.String,
+            is_elementwise=True,
+        ).alias(cell_column(resolution))
+        for resolution in resolutions
+    ]
+
+
+def bbox_polygon(bbox: Sequence[float]) -> h3.LatLngPoly:
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return h3.LatLngPoly([(min_lat, min_lon), (min_lat, max_lon), (max_lat, max_lon), (max_lat, min_lon)])
+
+
+def circle_bbox(lon: float, lat: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """Bounding box of a circle, on a locally flat earth."""
+    dlat = radius_km / KM_PER_DEGREE
+    dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    return lon - dlon, lat - dlat, lon + dlon, lat + dlat
+
+
+def circle_polygon(lon: float, lat: float, radius_km: float, n_vertices: int = 32) -> h3.LatLngPoly:
+    """Polygon circumscribing a circle, so covering it never misses an edge of the circle."""
+    min_lon, min_lat, max_lon, max_lat = circle_bbox(lon, lat, radius_km)
+    # vertices of a regular polygon sit at radius / cos(pi / n) from the centre
+    stretch = 1 / math.cos(math.pi / n_vertices)
+    angles = np.linspace(0, 2 * math.pi, n_vertices, endpoint=False)
+    return h3.LatLngPoly([
+        (lat + (max_lat - lat) * stretch * math.sin(a), lon + (max_lon - lon) * stretch * math.cos(a))
+        for a in angles
+    ])
+
+
+def _area_km2(bbox: Sequence[float]) -> float:
+    min_lon, min_lat, max_lon, max_lat = bbox
+    mid_lat = math.radians((min_lat + max_lat) / 2)
+    return (max_lon - min_lon) * (max_lat - min_lat) * KM_PER_DEGREE ** 2 * math.cos(mid_lat)
+
+
+def cover(
+    bbox: Optional[Sequence[float]],
+    point: Optional[Sequence[float]],
+    radius_km: Optional[float],
+    resolutions: Sequence[int],
+    max_cells: int,
+) -> Tuple[int, List[str], Tuple[float, float, float, float]]:
+    """
+    H3 cells covering a bounding box (min_lon, min_lat, max_lon, max_lat) or
+    a circle around point (lon, lat), at the finest of the given resolutions
+    that needs at most max_cells cells. Every cell that overlaps the area is
+    included. Returns the resolution, the cells, and the area's bounding
+    box. Raises ValueError if even the coarsest resolution needs too many.
+    """
+    if bbox is not None:
+        area_bbox = tuple(bbox)
+        polygon = bbox_polygon(bbox)
+    else:
+        area_bbox = circle_bbox(point[0], point[1], radius_km)
+        polygon = circle_polygon(point[0], point[1], radius_km)
+    area = _area_km2(area_bbox)
+    for resolution in sorted(resolutions, reverse=True):
+        # skip resolutions that would clearly need too many cells before computing them
+        if area / h3.average_hexagon_area(resolution, unit="km^2") > max_cells:
+            continue
+        # 'overlap' keeps cells that only partly intersect the area
+        cells = h3.h3shape_to_cells_experimental(polygon, resolution, contain="overlap")
+        if len(cells) <= max_cells:
+            return resolution, sorted(cells), area_bbox
+    raise ValueError(
+        f"The area needs more than {max_cells} H3 cells at resolutions {sorted(resolutions)}; "
+        "narrow it or filter by state or region instead."
+    )
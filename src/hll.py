@@ -0,0 +1,47 @@
+import math
+
+import polars as pl
+
+# fixed, so estimates are reproducible across runs and processes
+HASH_SEED = 0x5EED
+
+
+def relative_error(precision: int) -> float:
+    """Standard error of a HyperLogLog estimate with 2**precision registers."""
+    return 1.04 / math.sqrt(1 << precision)
+
+
+def register(column: str, precision: int) -> pl.Expr:
+    """Register of each value of column: the top precision bits of its 64-bit hash."""
+    return (pl.col(column).hash(seed=HASH_SEED) // (1 << (64 - precision))).cast(pl.UInt32)
+
+
+def rank(column: str, precision: int) -> pl.Expr:
+    """
+    Rank of each value of column: the position of the first set bit in the
+    hash bits below its register, or all of them plus one if none is set.
+    """
+    tail_bits = 64 - precision
+    tail = pl.col(column).hash(seed=HASH_SEED) & ((1 << tail_bits) - 1)
+    return (tail.bitwise_leading_zeros() - precision + 1).cast(pl.UInt8)
+
+
+def estimate(ranks: pl.Expr, precision: int) -> pl.Expr:
+    """
+    Aggregation of a group's register array, one highest rank per filled
+    register, into its distinct count. Small counts use linear counting on
+    the empty registers, which is close to exact for the few sessions an
+    access point sees in an hour.
+    """
+    m = 1 << precision
+    alpha = 0.7213 / (1 + 1.079 / m)
+    zeros = m - ranks.count()
+    harmonic = pl.lit(2.0).pow(-ranks.cast(pl.Float64)).sum() + zeros
+    raw_estimate = alpha * m * m / harmonic
+    return (
+        pl.when((raw_estimate <= 2.5 * m) & (zeros > 0))
+        .then(m * (m / zeros.cast(pl.Float64)).log())
+        .otherwise(raw_estimate)
+        .round()
+        .cast(pl.UInt32)
+    )
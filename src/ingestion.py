@@ -1,17 +1,33 @@
+import argparse
+import hashlib
+import multiprocessing
+import queue
 import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import polars as pl
+from datetime import datetime
 from pathlib import Path
+from typing import Iterable, Optional, Tuple
 import logging
 
+import numpy as np
 import pandas as pd
-import pandas as pd
-from questdb.ingress import Sender
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from questdb.ingress import IngressError
+from clickhouse_connect.driver.exceptions import DatabaseError
 import omegaconf
 
 import src.utils as utils
+from src import geo, hll, instrumentation
 
 
-@utils.timed
+@instrumentation.timed
 def csv_to_parquet(input_path: str, output_path: str, delete_csv: bool = False) -> None:
     """
     Stream-convert a large CSV file to Parquet using Polars lazy API.
@@ -21,11 +37,255 @@ def csv_to_parquet(input_path: str, output_path: str, delete_csv: bool = False)
         compression="zstd",  # options: 'snappy', 'gzip', 'zstd', 'lz4', 'brotli', etc.
         compression_level=9, # optional, higher = more compression
     )
+    instrumentation.add_rows(pq.ParquetFile(output_path).metadata.num_rows)
+    instrumentation.add_bytes(Path(input_path).stat().st_size)
     # delete csv
     if delete_csv:
         Path(input_path).unlink()
 
-@utils.timed
+def scan_raw(input_path: str) -> pl.LazyFrame:
+    """
+    Lazily scan one raw hour: a CSV file, a Parquet file, or a directory of
+    Parquet part files written by sharded generation.
+    """
+    path = Path(input_path)
+    if path.is_dir():
+        return pl.scan_parquet(str(path / "*.parquet"))
+    if path.suffix == ".csv":
+        return pl.scan_csv(input_path)
+    return pl.scan_parquet(input_path)
+
+def count_raw(input_path: str) -> None:
+    """
+    Report the rows and bytes of a raw hour to the current timed stage. Rows
+    come from Parquet footers; CSV inputs only report their size.
+    """
+    path = Path(input_path)
+    parts = sorted(path.glob("*.parquet")) if path.is_dir() else [path]
+    instrumentation.add_bytes(sum(part.stat().st_size for part in parts))
+    if path.suffix != ".csv":
+        instrumentation.add_rows(sum(pq.ParquetFile(part).metadata.num_rows for part in parts))
+
+def delete_path(input_path: str) -> None:
+    path = Path(input_path)
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+
+def aggregate_lazy(raw: pl.LazyFrame, cfg: omegaconf.dictconfig.DictConfig) -> pl.LazyFrame:
+    """
+    Hourly per access point aggregation of a raw scan, with the H3 cell of
+    each access point at every resolution in geo.h3_resolutions. The cells
+    are taken from the raw rows, which carry them from the access point
+    store, and only computed from the coordinates for inputs without them.
+
+    With ingestion.aggregation.distinct_sessions set to hll, unique_sessions
+    is a HyperLogLog estimate: the rows are also grouped by access point and
+    register, keeping each register's highest rank, so an access point holds
+    at most 2**hll_precision registers rather than every session id. Both
+    group_bys read one shared scan.
+    """
+    ap_id = cfg.colnames.ap_id
+    raw_columns = raw.collect_schema().names()
+    cell_columns = [geo.cell_column(resolution) for resolution in cfg.geo.h3_resolutions]
+    carried_cells = all(column in raw_columns for column in cell_columns)
+    aggregations = [
+        pl.col("rssi").mean().alias("avg_rssi"),
+        pl.col("session_id").n_unique().alias("unique_sessions"),
+        pl.col("noise_floor").max().alias("max_noise_floor"),
+        pl.col("noise_floor").mean().alias("avg_noise_floor"),
+        pl.col("snr").mean().alias("avg_snr"),
+        pl.col("bytes_in").sum().alias("total_bytes_in"),
+        pl.col("bytes_out").sum().alias("total_bytes_out"),
+        pl.col("packets_in").sum().alias("total_packets_in"),
+        pl.col("packets_out").sum().alias("total_packets_out"),
+        pl.col("throughput_mbps").mean().alias("avg_throughput_mbps"),
+        pl.col("retries").sum().alias("total_retries"),
+        pl.col("errors").sum().alias("total_errors"),
+        pl.col("tx_power").mean().alias("avg_tx_power"),
+        pl.col("rx_power").mean().alias("avg_rx_power"),
+        pl.col("tx_rate").mean().alias("avg_tx_rate"),
+        pl.col("rx_rate").mean().alias("avg_rx_rate"),
+        pl.col("mcs_tx").mean().alias("avg_mcs_tx"),
+        pl.col("mcs_rx").mean().alias("avg_mcs_rx"),
+        pl.col("assoc_clients").max().alias("max_assoc_clients"),
+        pl.col("roam_events").sum().alias("total_roam_events"),
+        pl.col("ap_temperature").mean().alias("avg_ap_temperature"),
+        pl.col("uptime_sec").max().alias("max_uptime_sec"),
+        pl.col("fw_version").first().alias("fw_version"),
+        pl.col(cfg.colnames.channel).first().alias("channel"),
+        pl.col("channel_width").first().alias("channel_width"),
+        pl.col(cfg.colnames.lon).first().alias("longitude"),
+        pl.col(cfg.colnames.lat).first().alias("latitude"),
+        pl.col(cfg.colnames.state).first().alias("state"),
+        pl.col(cfg.colnames.region).first().alias("region"),
+        *[pl.col(column).first() for column in cell_columns if carried_cells],
+        pl.col(cfg.colnames.band).first().alias("band"),
+        pl.col("vendor_source").first().alias("vendor_source"),
+        pl.col("vendor_name").first().alias("vendor_name"),
+        pl.col("model").first().alias("model"),
+        pl.col("ssid").first().alias("ssid"),
+    ]
+    settings = cfg.ingestion.aggregation
+    if settings.distinct_sessions == "exact":
+        aggregated = raw.group_by(ap_id).agg(aggregations)
+    elif settings.distinct_sessions == "hll":
+        precision = settings.hll_precision
+        # one scan feeds both group_bys
+        raw = raw.cache()
+        registers = (raw
+            .group_by(ap_id, hll.register("session_id", precision).alias("register"))
+            .agg(hll.rank("session_id", precision).max().alias("rank"))
+            .group_by(ap_id)
+            .agg(hll.estimate(pl.col("rank"), precision).alias("unique_sessions"))
+        )
+        columns = [ap_id] + [expr.meta.output_name() for expr in aggregations]
+        aggregated = (raw
+            .group_by(ap_id)
+            .agg([expr for expr in aggregations if expr.meta.output_name() != "unique_sessions"])
+            .join(registers, on=ap_id, how="left")
+            .select(columns)
+        )
+    else:
+        raise ValueError(f"Unknown ingestion.aggregation.distinct_sessions '{settings.distinct_sessions}'.")
+    if carried_cells:
+        return aggregated
+    return aggregated.with_columns(geo.cell_expressions(cfg.geo.h3_resolutions))
+
+def spill_buckets(input_path: str, memory_budget_mb: int) -> int:
+    """
+    Buckets a raw hour is split into so each holds at most the memory
+    budget, judged by the uncompressed size of the input.
+    """
+    path = Path(input_path)
+    parts = sorted(path.glob("*.parquet")) if path.is_dir() else [path]
+    if path.suffix == ".csv":
+        size = path.stat().st_size
+    else:
+        size = 0
+        for part in parts:
+            metadata = pq.ParquetFile(part).metadata
+            size += sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups))
+    return max(1, -(-size // (memory_budget_mb * 2 ** 20)))
+
+def iter_raw_batches(input_path: str, batch_size: int):
+    """Stream the Arrow batches of a raw hour, in any of the layouts scan_raw reads."""
+    path = Path(input_path)
+    if path.suffix == ".csv":
+        yield from pacsv.open_csv(path)
+        return
+    for part in sorted(path.glob("*.parquet")) if path.is_dir() else [path]:
+        yield from pq.ParquetFile(part).iter_batches(batch_size=batch_size)
+
+def spill_raw(input_path: str, spill_dir: str, n_buckets: int, ap_id: str, batch_size: int) -> list:
+    """
+    Split a raw hour into n_buckets Parquet files by a multiplicative hash of
+    ap_id, batch by batch, so memory stays bounded by the batch size. Returns
+    the bucket files written.
+    """
+    writers = {}
+    try:
+        for batch in iter_raw_batches(input_path, batch_size):
+            keys = batch.column(ap_id).to_numpy().astype(np.uint64)
+            buckets = ((keys * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)) % np.uint64(n_buckets)
+            counts = np.bincount(buckets.astype(np.int64), minlength=n_buckets)
+            batch = batch.take(np.argsort(buckets, kind="stable"))
+            offset = 0
+            for bucket, count in enumerate(counts):
+                if count == 0:
+                    continue
+                if bucket not in writers:
+                    writers[bucket] = pq.ParquetWriter(f"{spill_dir}/bucket-{bucket:04d}.parquet", batch.schema, compression="lz4")
+                writers[bucket].write_batch(batch.slice(offset, count))
+                offset += count
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return [f"{spill_dir}/bucket-{bucket:04d}.parquet" for bucket in sorted(writers)]
+
+def aggregate_buckets(input_path: str, cfg: omegaconf.dictconfig.DictConfig, spill_dir: str):
+    """
+    Yield the aggregate of a raw hour piece by piece within
+    ingestion.aggregation.memory_budget_mb. The raw rows are spilled to
+    spill_dir in buckets by hash of ap_id, so every access point falls in
+    exactly one bucket, and the buckets are aggregated one at a time.
+    """
+    n_buckets = spill_buckets(input_path, cfg.ingestion.aggregation.memory_budget_mb)
+    if n_buckets == 1:
+        yield aggregate_lazy(scan_raw(input_path), cfg).collect(engine="streaming")
+        return
+    logging.info(f"Spilling {input_path} into {n_buckets} buckets.")
+    for bucket_path in spill_raw(input_path, spill_dir, n_buckets, cfg.colnames.ap_id, cfg.ingestion.chunk_rows):
+        yield aggregate_lazy(pl.scan_parquet(bucket_path), cfg).collect(engine="streaming")
+        Path(bucket_path).unlink()
+
+def write_aggregate(
+    input_path: str,
+    output_path: str,
+    cfg: omegaconf.dictconfig.DictConfig,
+    compression: str,
+    compression_level: Optional[int] = None,
+) -> None:
+    """
+    Aggregate a raw hour into a Parquet file: in one streaming pass, or with
+    ingestion.aggregation.mode set to bucketed, bucket by bucket. Rows are
+    sorted by access point, within each bucket, as in iter_aggregate.
+    """
+    ap_id = cfg.colnames.ap_id
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    if cfg.ingestion.aggregation.mode == "exact":
+        aggregate_lazy(scan_raw(input_path), cfg).sort(ap_id).sink_parquet(
+            output_path, compression=compression, compression_level=compression_level,
+        )
+        return
+    writer = None
+    with tempfile.TemporaryDirectory(dir=Path(output_path).parent, prefix=".spill-") as spill_dir:
+        try:
+            for frame in aggregate_buckets(input_path, cfg, spill_dir):
+                table = frame.sort(ap_id).to_arrow()
+                if writer is None:
+                    writer = pq.ParquetWriter(
+                        output_path, table.schema, compression=compression, compression_level=compression_level,
+                    )
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+def iter_aggregate(input_path: str, cfg: omegaconf.dictconfig.DictConfig):
+    """
+    Stream the aggregate of a raw hour as Arrow batches of at most
+    ingestion.chunk_rows. In bucketed mode only one bucket's aggregate is
+    held at a time, the next bucket is aggregated once its batches are consumed.
+    Rows are sorted by access point, within each bucket, so an hour ingested
+    again yields the same batches, which the sinks' deduplication relies on.
+    """
+    ap_id = cfg.colnames.ap_id
+    if cfg.ingestion.aggregation.mode == "exact":
+        aggregated = aggregate_lazy(scan_raw(input_path), cfg).sort(ap_id).collect(engine="streaming")
+        yield from aggregated.to_arrow().to_batches(max_chunksize=cfg.ingestion.chunk_rows)
+        return
+    spill_root = Path("data/parquet")
+    spill_root.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=spill_root, prefix=".spill-") as spill_dir:
+        for frame in aggregate_buckets(input_path, cfg, spill_dir):
+            yield from frame.sort(ap_id).to_arrow().to_batches(max_chunksize=cfg.ingestion.chunk_rows)
+
+def _tee_parquet(batches: Iterable[pa.RecordBatch], output_path: Path):
+    """Pass batches through, also appending each one to a zstd Parquet file."""
+    writer = None
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, batch.schema, compression="zstd")
+            writer.write_batch(batch)
+            yield batch
+    finally:
+        if writer is not None:
+            writer.close()
+
+@instrumentation.timed
 def aggregate_parquet(
         input_path: str, 
         output_path: str, 
@@ -35,53 +295,104 @@ def aggregate_parquet(
     """
     Aggregate Parquet data by access point ID using Polars lazy API.
     """
-    (pl.scan_parquet(input_path)
-        .group_by(cfg.colnames.ap_id)
-        .agg(
-            [
-                pl.col("rssi").mean().alias("avg_rssi"),
-                pl.col("session_id").n_unique().alias("unique_sessions"),
-                pl.col("noise_floor").max().alias("max_noise_floor"),
-                pl.col("noise_floor").mean().alias("avg_noise_floor"),
-                pl.col("snr").mean().alias("avg_snr"),
-                pl.col("bytes_in").sum().alias("total_bytes_in"),
-                pl.col("bytes_out").sum().alias("total_bytes_out"),
-                pl.col("packets_in").sum().alias("total_packets_in"),
-                pl.col("packets_out").sum().alias("total_packets_out"),
-                pl.col("throughput_mbps").mean().alias("avg_throughput_mbps"),
-                pl.col("retries").sum().alias("total_retries"),
-                pl.col("errors").sum().alias("total_errors"),
-                pl.col("tx_power").mean().alias("avg_tx_power"),
-                pl.col("rx_power").mean().alias("avg_rx_power"),
-                pl.col("tx_rate").mean().alias("avg_tx_rate"),
-                pl.col("rx_rate").mean().alias("avg_rx_rate"),
-                pl.col("mcs_tx").mean().alias("avg_mcs_tx"),
-                pl.col("mcs_rx").mean().alias("avg_mcs_rx"),
-                pl.col("assoc_clients").max().alias("max_assoc_clients"),
-                pl.col("roam_events").sum().alias("total_roam_events"),
-                pl.col("ap_temperature").mean().alias("avg_ap_temperature"),
-                pl.col("uptime_sec").max().alias("max_uptime_sec"),
-                pl.col("fw_version").first().alias("fw_version"),
-                pl.col(cfg.colnames.channel).first().alias("channel"),
-                pl.col("channel_width").first().alias("channel_width"),
-                pl.col(cfg.colnames.lon).first().alias("longitude"),
-                pl.col(cfg.colnames.lat).first().alias("latitude"),
-                pl.col(cfg.colnames.state).first().alias("state"),
-                pl.col(cfg.colnames.region).first().alias("region"),
-                pl.col(cfg.colnames.band).first().alias("band"),
-                pl.col("vendor_source").first().alias("vendor_source"),
-                pl.col("vendor_name").first().alias("vendor_name"),
-                pl.col("model").first().alias("model"),
-                pl.col("ssid").first().alias("ssid"),
-            ]
-        )
-        .sink_parquet(output_path, compression="zstd", compression_level=9)
-    )
+    count_raw(input_path)
+    write_aggregate(input_path, output_path, cfg, compression="zstd", compression_level=9)
 
     if delete_input:
-        Path(input_path).unlink()
+        delete_path(input_path)
 
-@utils.timed
+def _questdb_sender_worker(
+    chunks: queue.Queue,
+    conf: str,
+    table_name: str,
+    hour: pd.Timestamp,
+    max_retries: int,
+) -> Tuple[int, list]:
+    """
+    Drain chunks from the queue, each through a sender borrowed from the
+    process-wide pool, which stays connected between hours. A chunk that fails
+    is retried on a fresh sender; rows an earlier attempt already flushed are
+    harmless because the table dedups on (timestamp, ap_id). Returns the rows
+    sent and the indices of chunks that exhausted their retries.
+    """
+    rows, failed = 0, []
+    while True:
+        item = chunks.get()
+        if item is None:
+            break
+        index, batch = item
+        try:
+            df = batch.to_pandas().assign(timestamp=hour)
+        except Exception:
+            # keep draining, or the producer blocks on the full queue once every worker is gone
+            logging.exception(f"Chunk {index} could not be converted.")
+            failed.append(index)
+            continue
+        for attempt in range(1, max_retries + 1):
+            try:
+                with utils.questdb_sender(conf) as sender:
+                    sender.dataframe(df, table_name=table_name, at="timestamp")
+                    sender.flush()
+                rows += len(df)
+                break
+            except IngressError as e:
+                logging.warning(f"Chunk {index} failed on attempt {attempt}/{max_retries}: {e}")
+                if attempt == max_retries:
+                    failed.append(index)
+                else:
+                    time.sleep(0.5 * 2 ** attempt)
+            except Exception:
+                logging.exception(f"Chunk {index} could not be sent.")
+                failed.append(index)
+                break
+    return rows, failed
+
+@instrumentation.timed
+def arrow_to_questdb(
+    batches: Iterable[pa.RecordBatch],
+    table_name: str,
+    timestamp: str,
+    senders: int,
+    max_retries: int,
+    auto_flush_rows: int,
+    auto_flush_bytes: int,
+) -> int:
+    """
+    Stream aggregated Arrow batches into a questDB table, fanned out over
+    several concurrent ILP senders with explicit auto-flush thresholds.
+    """
+    # create table if not exit
+    utils.ensure_questdb_table()
+
+    conf = utils.get_ingestion_config(
+        auto_flush_rows=auto_flush_rows,
+        auto_flush_bytes=auto_flush_bytes,
+    )
+    hour = pd.Timestamp(timestamp)
+    chunks = queue.Queue(maxsize=2 * senders)
+    with ThreadPoolExecutor(max_workers=senders) as pool:
+        workers = [
+            pool.submit(_questdb_sender_worker, chunks, conf, table_name, hour, max_retries)
+            for _ in range(senders)
+        ]
+        try:
+            for index, batch in enumerate(batches):
+                instrumentation.add_bytes(batch.nbytes)
+                chunks.put((index, batch))
+        finally:
+            for _ in workers:
+                chunks.put(None)
+        results = [worker.result() for worker in workers]
+
+    rows = sum(sent for sent, _ in results)
+    instrumentation.add_rows(rows)
+    failed = sorted(index for _, indices in results for index in indices)
+    if failed:
+        raise RuntimeError(f"Chunks {failed} of '{timestamp}' could not be sent to QuestDB.")
+    logging.info(f"Uploaded {rows} rows to QuestDB table '{table_name}' over {senders} senders.")
+    return rows
+
+@instrumentation.timed
 def parquet_to_questdb(
     input_path: str, 
     table_name: str,
@@ -89,105 +400,642 @@ def parquet_to_questdb(
     delete_input: bool = False,
 ) -> None:
     """
-    Load Parquet data into a questDB table.
+    Load Parquet data into a questDB table, streaming it chunk by chunk
+    (settings under db.questdb.params).
     """
-
-    # Read Parquet file into Pandas DataFrame
-    # apply type casting
-    df = (pd
-        .read_parquet(input_path)
+    params = utils.load_config().db.questdb.params
+    arrow_to_questdb(
+        pq.ParquetFile(input_path).iter_batches(batch_size=params.insert_chunk_rows),
+        table_name,
+        timestamp,
+        senders=params.senders,
+        max_retries=params.max_retries,
+        auto_flush_rows=params.auto_flush_rows,
+        auto_flush_bytes=params.auto_flush_bytes,
     )
-    
-    # create table if not exit
-    utils.create_questdb_table()
-
-    # add timestamp column
-    df = df.assign(timestamp=pd.to_datetime(timestamp))
-
-    # Create connection config
-    cfg = utils.get_ingestion_config()
-    logging.info(f"Uploading {len(df)} rows to QuestDB table '{table_name}' with config: {cfg}.")
-    with Sender.from_conf(cfg) as sender:
-        sender.dataframe(
-            df,
-            table_name=table_name,
-            at="timestamp",
-        )
 
     if delete_input:
         Path(input_path).unlink()
 
 
-@utils.timed
+def cast_to_schema(batch: pa.RecordBatch, schema: pa.Schema, timestamp: datetime) -> pa.Table:
+    """
+    Cast an aggregated batch to the table schema inside Arrow, adding the
+    hour's timestamp column. Dictionary columns keep their codes; plain
+    columns cast to a dictionary type are encoded here.
+    """
+    arrays = []
+    for field in schema:
+        if field.name == "timestamp":
+            arrays.append(pa.repeat(pa.scalar(timestamp, type=field.type), batch.num_rows))
+            continue
+        column = batch.column(field.name)
+        if pa.types.is_dictionary(field.type) and not pa.types.is_dictionary(column.type):
+            column = pc.cast(column, field.type.value_type)
+        arrays.append(pc.cast(column, field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def dedup_token(table_name: str, table: pa.Table) -> str:
+    """
+    Deduplication token of an insert: a digest of its rows, hashed with
+    dictionary columns decoded, so the same rows give the same token in any
+    process whatever their dictionary codes.
+    """
+    frame = pl.from_arrow(table).with_columns(pl.col(pl.Categorical).cast(pl.String))
+    digest = hashlib.blake2b(frame.hash_rows(seed=0).to_numpy().tobytes(), digest_size=16)
+    return f"{table_name}/{digest.hexdigest()}"
+
+@instrumentation.timed
+def arrow_to_clickhouse(
+    batches: Iterable[pa.RecordBatch],
+    table_name: str,
+    timestamp: str,
+    max_retries: int,
+) -> int:
+    """
+    Insert aggregated Arrow batches into a ClickHouse table, one insert per
+    batch, so memory is bounded by the batch size rather than the hour.
+
+    Every insert carries a deduplication token derived from the chunk's
+    rows, so an insert retried after a timeout, here or when the hour is
+    ingested again, is dropped by the server if the first attempt was stored,
+    while a regenerated hour with new rows is inserted. A chunk that fails is
+    retried up to max_retries times.
+    """
+    # create table if not exit
+    utils.ensure_clickhouse_table()
+
+    schema = utils.clickhouse_arrow_schema()
+    hour = datetime.fromisoformat(timestamp)
+    rows = 0
+    with utils.clickhouse_client() as client:
+        for index, batch in enumerate(batches):
+            table = cast_to_schema(batch, schema, hour)
+            settings = {"insert_deduplication_token": dedup_token(table_name, table)}
+            for attempt in range(1, max_retries + 1):
+                try:
+                    client.insert_arrow(table_name, table, settings=settings)
+                    break
+                except DatabaseError as e:
+                    logging.warning(f"Chunk {index} failed on attempt {attempt}/{max_retries}: {e}")
+                    if attempt == max_retries:
+                        raise RuntimeError(
+                            f"Chunk {index} of '{timestamp}' could not be inserted into ClickHouse."
+                        ) from e
+                    time.sleep(0.5 * 2 ** attempt)
+            rows += batch.num_rows
+            instrumentation.add_rows(batch.num_rows)
+            instrumentation.add_bytes(table.nbytes)
+    logging.info(f"Uploaded {rows} rows to ClickHouse table '{table_name}'.")
+    return rows
+
+@instrumentation.timed
 def parquet_to_clickhouse(
     input_path: str, 
     table_name: str,
     timestamp: str,
     delete_input: bool = False,
+    chunk_rows: Optional[int] = None,
 ) -> None:
     """
-    Load Parquet data into a ClickHouse table.
+    Load Parquet data into a ClickHouse table, streaming it in chunks of
+    chunk_rows rows (db.clickhouse.params.insert_chunk_rows by default).
     """
-
-    # Read Parquet file into Pandas DataFrame
-    df = (pd
-        .read_parquet(input_path)
-        .assign(
-            ap_id = lambda x: x['ap_id'].astype(str),
-            channel = lambda x: x['channel'].astype(str),
-            channel_width = lambda x: x['channel_width'].astype(str),
-        )
+    params = utils.load_config().db.clickhouse.params
+    if chunk_rows is None:
+        chunk_rows = params.insert_chunk_rows
+    arrow_to_clickhouse(
+        pq.ParquetFile(input_path).iter_batches(batch_size=chunk_rows),
+        table_name,
+        timestamp,
+        max_retries=params.max_retries,
     )
-    
-    # create table if not exit
-    utils.create_clickhouse_table()
 
-    # add timestamp column
-    df = df.assign(timestamp=pd.to_datetime(timestamp))
+    if delete_input:
+        Path(input_path).unlink()
+
+def load_clickhouse(
+    batches: Iterable[pa.RecordBatch],
+    timestamp: str,
+    cfg: omegaconf.dictconfig.DictConfig,
+) -> int:
+    params = cfg.db.clickhouse.params
+    return arrow_to_clickhouse(batches, params.table_name, timestamp, max_retries=params.max_retries)
 
-    # Create connection config
-    logging.info(f"Uploading {len(df)} rows to ClickHouse table '{table_name}'.")
-    client = utils.get_clickhouse_client()
-    client.insert_df(
-        table=table_name,
-        df=df,
+def load_questdb(
+    batches: Iterable[pa.RecordBatch],
+    timestamp: str,
+    cfg: omegaconf.dictconfig.DictConfig,
+) -> int:
+    params = cfg.db.questdb.params
+    rows = arrow_to_questdb(
+        batches,
+        params.table_name,
+        timestamp,
+        senders=params.senders,
+        max_retries=params.max_retries,
+        auto_flush_rows=params.auto_flush_rows,
+        auto_flush_bytes=params.auto_flush_bytes,
     )
+    # the hour counts as loaded, and may pass the watermark, only once queries see it
+    if params.visibility_timeout_seconds is not None:
+        utils.wait_questdb_visible(params.table_name, params.visibility_timeout_seconds)
+    return rows
+
+# sink name in ingestion.sinks -> loader consuming an iterable of Arrow batches
+SINKS = {
+    "clickhouse": load_clickhouse,
+    "questdb": load_questdb,
+}
+
+def _offer(chunks: queue.Queue, item, consumer: Future) -> None:
+    """Put item on a sink's queue unless that sink has already stopped."""
+    while not consumer.done():
+        try:
+            chunks.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+def _drain(chunks: queue.Queue):
+    while True:
+        item = chunks.get()
+        if item is None:
+            return
+        yield item
 
+@instrumentation.timed
+def fan_out(
+    batches: Iterable[pa.RecordBatch],
+    timestamp: str,
+    cfg: omegaconf.dictconfig.DictConfig,
+    sinks: Optional[list] = None,
+    backlog: Optional[int] = None,
+) -> dict:
+    """
+    Feed one read of the aggregated batches to several sinks concurrently.
+
+    Every sink drains its own queue of at most backlog batches in its own
+    thread, so a slow sink only holds up the reader, and through it the other
+    sinks, once it is backlog batches behind. A failed sink stops receiving
+    batches without affecting the others; the hour is reported as failed
+    once all sinks are done. Returns, per sink, the rows loaded and seconds taken.
+    Raises ValueError without reading a batch if there are no sinks, as the
+    caller would otherwise drop the hour as loaded.
+    """
+    sinks = list(sinks if sinks is not None else cfg.ingestion.sinks)
+    if not sinks:
+        raise ValueError(f"No sinks to load '{timestamp}' into; set ingestion.sinks.")
+    backlog = backlog or cfg.ingestion.sink_backlog
+    queues = {name: queue.Queue(maxsize=backlog) for name in sinks}
+
+    def run(name):
+        start = time.perf_counter()
+        rows = SINKS[name](_drain(queues[name]), timestamp, cfg)
+        return rows, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=len(sinks)) as pool:
+        consumers = {name: pool.submit(run, name) for name in sinks}
+        try:
+            for batch in batches:
+                instrumentation.add_rows(batch.num_rows)
+                for name in sinks:
+                    _offer(queues[name], batch, consumers[name])
+        finally:
+            for name in sinks:
+                _offer(queues[name], None, consumers[name])
+
+    results, failed = {}, []
+    for name, consumer in consumers.items():
+        try:
+            rows, seconds = consumer.result()
+        except Exception:
+            logging.exception(f"Sink {name} failed for '{timestamp}'.")
+            failed.append(name)
+            continue
+        results[name] = (rows, seconds)
+        logging.info(f"Sink {name}: {rows} rows in {seconds:.2f}s ({rows / max(seconds, 1e-9):.0f} rows/s)")
+    if failed:
+        raise RuntimeError(f"Sinks {failed} failed for '{timestamp}'.")
+    return results
+
+def parquet_to_sinks(
+    input_path: str,
+    timestamp: str,
+    cfg: omegaconf.dictconfig.DictConfig,
+    delete_input: bool = False,
+) -> dict:
+    """
+    Read an aggregated Parquet file once and load it into every configured sink.
+    """
+    results = fan_out(
+        pq.ParquetFile(input_path).iter_batches(batch_size=cfg.ingestion.chunk_rows),
+        timestamp,
+        cfg,
+    )
     if delete_input:
         Path(input_path).unlink()
+    return results
+
+def publish_loaded(filename: str) -> None:
+    """Record a loaded hour, named by its start, for the ingestion watermark."""
+    utils.publish_loaded_hour(datetime.fromisoformat(filename))
+
+def find_hourly_inputs() -> list:
+    """
+    List the raw hourly files waiting for ingestion.
+
+    These are CSV files in data/csv/, and typed Parquet files or directories
+    of Parquet part files written by the generator in data/raw/. The latter
+    skip the CSV to Parquet conversion. Directories still being written carry
+    a .tmp suffix and are left alone. Files are listed in time order, so
+    hours are loaded, and the watermark advances, oldest first.
+    """
+    raw_dir = Path("data/raw/")
+    raw = []
+    if raw_dir.exists():
+        raw = [
+            path for path in raw_dir.iterdir()
+            if path.suffix == ".parquet" or (path.is_dir() and path.suffix != ".tmp")
+        ]
+    return sorted(list(Path("data/csv/").glob("*.csv")) + raw, key=lambda path: path.stem)
+
+def staged_aggregate_path(filename: str) -> str:
+    """Where the staged path keeps the aggregate of the raw hour named filename."""
+    return f"data/parquet/aggregated/{filename}.parquet"
+
+def load_aggregated(filename: str, cfg: omegaconf.dictconfig.DictConfig) -> None:
+    """
+    Last step of the staged path: load the aggregate of an hour into the
+    sinks and record it as loaded. Also resumes an hour whose load failed
+    after its raw input was dropped.
+    """
+    parquet_to_sinks(
+        input_path=staged_aggregate_path(filename),
+        timestamp=filename,
+        cfg=cfg,
+    )
+    publish_loaded(filename)
+
+def find_stranded_aggregates() -> list:
+    """
+    List the hours whose aggregate was kept by a failed load after their raw
+    input was dropped, in time order. Hours whose raw input is still waiting
+    are left to find_hourly_inputs, which aggregates them again.
+    """
+    aggregated_dir = Path(staged_aggregate_path("")).parent
+    if not aggregated_dir.exists():
+        return []
+    waiting = {path.stem for path in find_hourly_inputs()}
+    return sorted(path.stem for path in aggregated_dir.glob("*.parquet") if path.stem not in waiting)
+
+def load_stranded_aggregates(cfg: omegaconf.dictconfig.DictConfig) -> list:
+    """
+    Load the hours find_stranded_aggregates lists, before new raw hours;
+    returns the names of those loaded. An hour that fails again keeps its
+    aggregate for the next run.
+    """
+    loaded = []
+    for filename in find_stranded_aggregates():
+        logging.info(f"Loading the aggregate of {filename}, kept by an earlier failed load.")
+        try:
+            load_aggregated(filename, cfg)
+        except Exception:
+            logging.exception(f"Loading {filename} failed again; its aggregate is kept for the next run.")
+            continue
+        loaded.append(filename)
+    return loaded
+
+@instrumentation.timed
+def ingest_staged(
+    input_path: Path,
+    cfg: omegaconf.dictconfig.DictConfig,
+    load: bool = True,
+) -> None:
+    """
+    Ingest one raw hour through intermediate zstd Parquet files:
+    CSV to Parquet, Parquet to aggregated Parquet, aggregated Parquet to the sinks.
+    """
+    filename = input_path.stem
+    count_raw(str(input_path))
+    if input_path.suffix == ".csv":
+        parquet_path = f"data/parquet/{filename}.parquet"
+        csv_to_parquet(
+            input_path=str(input_path), 
+            output_path=parquet_path,
+            delete_csv=load,
+        )
+    else:
+        parquet_path = str(input_path)
+    aggregated_path = staged_aggregate_path(filename)
+    aggregate_parquet(
+        input_path=str(parquet_path), 
+        output_path=str(aggregated_path), 
+        cfg=cfg,
+        delete_input=load or parquet_path != str(input_path),
+    )
+    if not load:
+        # read the aggregate back as the loader would, then discard it
+        for _ in pq.ParquetFile(aggregated_path).iter_batches(batch_size=cfg.ingestion.chunk_rows):
+            pass
+        Path(aggregated_path).unlink()
+        return
+    load_aggregated(filename, cfg)
+
+@instrumentation.timed
+def ingest_fused(
+    input_path: Path,
+    cfg: omegaconf.dictconfig.DictConfig,
+    load: bool = True,
+    debug_dir: Optional[str] = None,
+) -> None:
+    """
+    Ingest one raw hour in a single pass: the raw scan is streamed through the
+    aggregation and the aggregated batches go straight to the sinks, without
+    intermediate files; in bucketed mode, one bucket at a time. If debug_dir
+    is given, the aggregate is also written there for debugging or replay.
+    """
+    filename = input_path.stem
+    count_raw(str(input_path))
+    batches = iter_aggregate(str(input_path), cfg)
+    if debug_dir is not None:
+        Path(debug_dir).mkdir(parents=True, exist_ok=True)
+        batches = _tee_parquet(batches, Path(debug_dir) / f"{filename}.parquet")
+    if not load:
+        for _ in batches:
+            pass
+        return
+    fan_out(batches, timestamp=filename, cfg=cfg)
+    delete_path(str(input_path))
+    publish_loaded(filename)
+
+def compare_pipelines(input_path: Path, cfg: omegaconf.dictconfig.DictConfig) -> None:
+    """
+    Time the staged and fused paths on the same raw hour, up to but excluding
+    the sink, so the comparison does not load the hour twice. The input is
+    left in place.
+    """
+    start = time.perf_counter()
+    ingest_fused(input_path, cfg, load=False)
+    fused = time.perf_counter() - start
+    start = time.perf_counter()
+    ingest_staged(input_path, cfg, load=False)
+    staged = time.perf_counter() - start
+    logging.info(
+        f"{input_path.name}: staged {staged:.2f}s, fused {fused:.2f}s "
+        f"({staged / fused:.1f}x)"
+    )
+
+# name -> (ingestion.aggregation.mode, ingestion.aggregation.distinct_sessions)
+AGGREGATION_VARIANTS = {
+    "exact": ("exact", "exact"),
+    "bucketed": ("bucketed", "exact"),
+    "hll": ("exact", "hll"),
+    "bucketed_hll": ("bucketed", "hll"),
+}
+
+def _run_aggregation(input_path: str, output_path: str, mode: str, distinct_sessions: str) -> Tuple[float, int]:
+    """Aggregate one hour with the given settings; run in a fresh process so its peak RSS is its own."""
+    cfg = utils.with_overrides(
+        utils.load_config(),
+        {"ingestion": {"aggregation": {"mode": mode, "distinct_sessions": distinct_sessions}}},
+    )
+    start = time.perf_counter()
+    with instrumentation.stage(f"aggregate_{mode}_{distinct_sessions}") as record:
+        write_aggregate(input_path, output_path, cfg, compression="lz4")
+    return time.perf_counter() - start, record.peak_rss
+
+def compare_aggregations(input_path: Path, cfg: omegaconf.dictconfig.DictConfig) -> None:
+    """
+    Aggregate the same raw hour with every variant in AGGREGATION_VARIANTS
+    and log, against the exact variant, the time, peak RSS, and the error of
+    unique_sessions. The input is left in place.
+    """
+    spawn = multiprocessing.get_context("spawn")
+    Path("data/parquet").mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir="data/parquet", prefix=".compare-") as workdir:
+        outputs = {}
+        for name, (mode, distinct_sessions) in AGGREGATION_VARIANTS.items():
+            outputs[name] = f"{workdir}/{name}.parquet"
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                seconds, peak_rss = pool.submit(
+                    _run_aggregation, str(input_path), outputs[name], mode, distinct_sessions,
+                ).result()
+            ap_id = cfg.colnames.ap_id
+            exact = pl.scan_parquet(outputs["exact"]).select(ap_id, pl.col("unique_sessions").alias("exact"))
+            errors = (pl.scan_parquet(outputs[name])
+                .select(ap_id, "unique_sessions")
+                .join(exact, on=ap_id, how="full", coalesce=True)
+                .select(
+                    pl.len().alias("rows"),
+                    pl.col("unique_sessions").is_null().sum().alias("missing"),
+                    ((pl.col("unique_sessions").cast(pl.Float64) - pl.col("exact")).abs() / pl.col("exact"))
+                        .alias("error"),
+                )
+                .select("rows", "missing", pl.col("error").mean().alias("mean"), pl.col("error").max().alias("max"))
+                .collect()
+                .row(0, named=True)
+            )
+            logging.info(
+                f"{name}: {seconds:.2f}s, peak RSS {peak_rss / 2 ** 20:,.0f} MiB, {errors['rows']} APs "
+                f"({errors['missing']} missing), unique_sessions error mean {errors['mean']:.4%} "
+                f"max {errors['max']:.4%}"
+            )
+
+class StageStats:
+    """Running totals for one pipeline stage."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.files = 0
+        self.rows = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, rows: int, seconds: float) -> None:
+        with self._lock:
+            self.files += 1
+            self.rows += rows
+            self.busy += seconds
+
+    def log(self, wall: float) -> None:
+        logging.info(
+            f"Stage {self.name}: {self.files} files, {self.rows} rows, "
+            f"{self.busy:.2f}s busy, {self.files / wall:.3f} files/s, "
+            f"{self.rows / wall:.0f} rows/s over {wall:.2f}s"
+        )
+
+def prepare_hour(input_path: str, cfg: omegaconf.dictconfig.DictConfig) -> Tuple[str, str, int, float]:
+    """
+    CPU stage of the pipelined mode, run in a worker process: aggregate one raw
+    hour into a staging Parquet file for the load stage, and drop the input.
+    """
+    start = time.perf_counter()
+    filename = Path(input_path).stem
+    output_path = staged_aggregate_path(filename)
+    # staging files are short-lived, favour speed over ratio
+    write_aggregate(input_path, output_path, cfg, compression="lz4")
+    rows = pl.scan_parquet(output_path).select(pl.len()).collect().item()
+    delete_path(input_path)
+    return output_path, filename, rows, time.perf_counter() - start
+
+@instrumentation.timed
+def run_pipeline(
+    files: list,
+    cfg: omegaconf.dictconfig.DictConfig,
+    prepare_workers: int,
+    load_workers: int,
+    queue_size: int,
+) -> None:
+    """
+    Ingest many raw hours with the stages overlapped across files.
+
+    Aggregation runs in a process pool with at most prepare_workers hours in
+    flight. Aggregated hours wait in a queue of at most queue_size entries
+    for a pool of load_workers threads, which are network bound. A full
+    queue stops new hours from being scheduled until the loaders catch up.
+    """
+    ready = queue.Queue(maxsize=queue_size)
+    prepare_stats = StageStats("prepare")
+    load_stats = StageStats("load")
+    loaded = set()
+    loaded_lock = threading.Lock()
+
+    def load_worker():
+        while True:
+            item = ready.get()
+            if item is None:
+                return
+            aggregated_path, filename, rows = item
+            start = time.perf_counter()
+            try:
+                parquet_to_sinks(
+                    input_path=aggregated_path,
+                    timestamp=filename,
+                    cfg=cfg,
+                    delete_input=True,
+                )
+            except Exception:
+                logging.exception(
+                    f"Loading {filename} failed; its aggregate is kept at {aggregated_path} and loaded on the next run."
+                )
+                continue
+            load_stats.add(rows, time.perf_counter() - start)
+            with loaded_lock:
+                loaded.add(filename)
+
+    def put(item, loaders):
+        """Queue an aggregated hour, re-raising the error of a loader that died meanwhile."""
+        while True:
+            for loader in loaders:
+                if loader.done():
+                    # loaders only return on the end marker, so this one failed
+                    loader.result()
+                    raise RuntimeError("A load worker stopped before the end of the run.")
+            try:
+                ready.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def stop(loaders):
+        """Send every loader the end marker, unless all of them have already stopped."""
+        for _ in loaders:
+            while not all(loader.done() for loader in loaders):
+                try:
+                    ready.put(None, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def enqueue(done, loaders):
+        for future in done:
+            try:
+                aggregated_path, filename, rows, seconds = future.result()
+            except Exception:
+                logging.exception("Preparing an hour failed; its raw input is kept.")
+                continue
+            prepare_stats.add(rows, seconds)
+            put((aggregated_path, filename, rows), loaders)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=load_workers) as load_pool, \
+            ProcessPoolExecutor(max_workers=prepare_workers) as prepare_pool:
+        loaders = [load_pool.submit(load_worker) for _ in range(load_workers)]
+        pending = set()
+        try:
+            for file in files:
+                if len(pending) >= prepare_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    enqueue(done, loaders)
+                pending.add(prepare_pool.submit(prepare_hour, str(file), cfg))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                enqueue(done, loaders)
+        except BaseException:
+            # stop scheduling hours; ones already aggregated keep their staging files
+            for future in pending:
+                future.cancel()
+            prepare_pool.shutdown(wait=True, cancel_futures=True)
+            stop(loaders)
+            raise
+        stop(loaders)
+        for loader in loaders:
+            loader.result()
+    wall = time.perf_counter() - start
+    prepare_stats.log(wall)
+    load_stats.log(wall)
+    for filename in sorted(loaded):
+        publish_loaded(filename)
 
 if __name__ == "__main__":
     # log to stdout and append to log file
     utils.set_logging()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="staged",
+        choices=["staged", "fused", "compare", "pipelined", "compare_aggregation"],
+        help="staged writes intermediate Parquet files; fused streams scan, aggregation "
+             "and load in one pass; compare times both without loading; pipelined "
+             "overlaps aggregation and loading across hours; compare_aggregation reports "
+             "the time, peak RSS and unique_sessions error of every aggregation variant "
+             "on the first hour, without loading.",
+    )
+    parser.add_argument(
+        "--debug_dir",
+        type=str,
+        default=None,
+        help="In fused mode, also write aggregated hours here for debugging or replay.",
+    )
+    parser.add_argument("--prepare_workers", type=int, default=None, help="Overrides ingestion.prepare_workers.")
+    parser.add_argument("--load_workers", type=int, default=None, help="Overrides ingestion.load_workers.")
+    parser.add_argument("--queue_size", type=int, default=None, help="Overrides ingestion.queue_size.")
+    args = parser.parse_args()
     cfg = utils.load_config()
-    # find all csv files in data/csv/
-    files = list(Path("data/csv/").glob("*.csv"))
+    if args.mode in ("staged", "fused", "pipelined"):
+        load_stranded_aggregates(cfg)
+    files = find_hourly_inputs()
     if not files:
-        logging.info("No CSV files found in data/csv/. Exiting.")
-    for file in files:
-        filename = file.stem
-        parquet_path = f"data/parquet/{filename}.parquet"
-        csv_to_parquet(
-            input_path=str(file), 
-            output_path=parquet_path,
-            delete_csv=True,
-        )
-        aggregated_path = f"data/parquet/aggregated/{filename}.parquet"
-        aggregate_parquet(
-            input_path=str(parquet_path), 
-            output_path=str(aggregated_path), 
-            cfg=cfg,
-            delete_input=True,
+        logging.info("No raw files found in data/csv/ or data/raw/. Exiting.")
+    elif args.mode == "compare_aggregation":
+        compare_aggregations(files[0], cfg)
+    elif args.mode == "pipelined":
+        run_pipeline(
+            files,
+            cfg,
+            prepare_workers=args.prepare_workers or cfg.ingestion.prepare_workers,
+            load_workers=args.load_workers or cfg.ingestion.load_workers,
+            queue_size=args.queue_size or cfg.ingestion.queue_size,
         )
-        # parquet_to_questdb(
-        #     input_path=str(aggregated_path),
-        #     table_name=cfg.db.questdb.params.table_name,
-        #     timestamp=file.stem,
-        #     delete_input=False,
-        # )
-        parquet_to_clickhouse(
-            input_path=str(aggregated_path),
-            table_name=cfg.db.clickhouse.params.table_name,
-            timestamp=file.stem,
-            delete_input=False,
-        )
\ No newline at end of file
+    else:
+        for file in files:
+            if args.mode == "staged":
+                ingest_staged(file, cfg)
+            elif args.mode == "fused":
+                ingest_fused(file, cfg, debug_dir=args.debug_dir)
+            else:
+                compare_pipelines(file, cfg)
+    if cfg.ingestion.metrics_path:
+        instrumentation.write_metrics(cfg.ingestion.metrics_path)
@@ -0,0 +1,321 @@
+import bisect
+import collections
+import contextlib
+import contextvars
+import functools
+import inspect
+import logging
+import resource
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Sequence
+
+# ---------------------------------------------------------------------------
+# metrics in the Prometheus text format
+
+_registry = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _format_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values = collections.defaultdict(float)
+
+    def inc(self, value: float = 1, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] += value
+
+    def samples(self) -> list:
+        with self._lock:
+            return [f"{self.name}{self._format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = ()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (count per bucket, then +Inf), sum
+        self._values = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                    cumulative += count
+                    le = 'le="%s"' % bound
+                    lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """Every metric of this process, in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+def write_metrics(path: str) -> None:
+    """
+    Write the metrics to a file, e.g. for node_exporter's textfile collector,
+    since batch jobs are gone by the time a scraper would call them.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(render())
+    tmp_path.replace(path)
+
+
+STAGE_SECONDS = Histogram(
+    "wifi_stage_seconds", "Duration of timed pipeline stages.", ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600),
+)
+STAGE_ROWS = Counter("wifi_stage_rows_total", "Rows processed by timed stages.", ["stage"])
+STAGE_BYTES = Counter("wifi_stage_bytes_total", "Bytes processed by timed stages.", ["stage"])
+STAGE_PEAK_RSS = Gauge("wifi_stage_peak_rss_bytes", "Peak resident memory during the last run of a stage.", ["stage"])
+
+_REQUEST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+REQUEST_SECONDS = Histogram(
+    "wifi_request_seconds", "API request latency, to the first byte of the response.", ["endpoint", "status"],
+    buckets=_REQUEST_BUCKETS,
+)
+DB_SECONDS = Histogram("wifi_db_seconds", "Time API requests wait on the database.", ["endpoint"], buckets=_REQUEST_BUCKETS)
+SERIALIZE_SECONDS = Histogram(
+    "wifi_serialize_seconds", "Time API requests spend encoding results.", ["endpoint"], buckets=_REQUEST_BUCKETS,
+)
+
+# ---------------------------------------------------------------------------
+# timed stages
+
+_PAGE_SIZE = resource.getpagesize()
+
+
+def current_rss() -> Optional[int]:
+    """Resident memory of this process in bytes, or None where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return None
+
+
+class _Stage:
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = 0
+        self.bytes = 0
+        self.peak_rss = current_rss() or 0
+
+
+class _MemorySampler:
+    """Background thread raising the peak RSS of every open stage; stages may nest and overlap."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self._stages = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, stage: _Stage) -> None:
+        with self._lock:
+            self._stages.add(stage)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+                self._thread.start()
+
+    def remove(self, stage: _Stage) -> None:
+        self.sample()
+        with self._lock:
+            self._stages.discard(stage)
+
+    def sample(self) -> None:
+        rss = current_rss()
+        if rss is None:
+            return
+        with self._lock:
+            for stage in self._stages:
+                stage.peak_rss = max(stage.peak_rss, rss)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+
+_sampler = _MemorySampler()
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+
+
+def add_rows(rows: int) -> None:
+    """Count rows towards the innermost timed stage of the calling thread."""
+    stage = _current_stage.get()
+    if stage is not None:
+        stage.rows += rows
+
+
+def add_bytes(n_bytes: int) -> None:
+    """Count bytes towards the innermost timed stage of the calling thread."""
+    stage = _current_stage.get()
+    if stage is not None:
+        stage.bytes += n_bytes
+
+
+@contextlib.contextmanager
+def stage(name: str, current: bool = True):
+    """
+    Measure a block as a pipeline stage: duration, rows and bytes reported
+    with add_rows/add_bytes, and peak RSS. The results go to the stage
+    metrics and to one log line. With current=False, add_rows and add_bytes
+    keep counting towards the enclosing stage.
+    """
+    record = _Stage(name)
+    token = _current_stage.set(record) if current else None
+    _sampler.add(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        _sampler.remove(record)
+        if token is not None:
+            _current_stage.reset(token)
+        STAGE_SECONDS.observe(seconds, stage=name)
+        STAGE_ROWS.inc(record.rows, stage=name)
+        STAGE_BYTES.inc(record.bytes, stage=name)
+        STAGE_PEAK_RSS.set(record.peak_rss, stage=name)
+        message = f"Function {name} took {seconds:.2f} seconds"
+        if record.rows:
+            message += f", {record.rows} rows ({record.rows / max(seconds, 1e-9):,.0f} rows/s)"
+        if record.bytes:
+            message += f", {record.bytes / 2 ** 20:,.1f} MiB"
+        if record.peak_rss:
+            message += f", peak RSS {record.peak_rss / 2 ** 20:,.0f} MiB"
+        logging.info(message)
+
+
+def timed(func):
+    """
+    Decorator measuring every call of func as a stage named after it. For
+    generator functions the stage spans the whole iteration, and the length
+    of every yielded batch is counted as rows.
+    """
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            # the caller runs between yields, so this stage must not capture its rows
+            with stage(func.__name__, current=False) as record:
+                for item in func(*args, **kwargs):
+                    if hasattr(item, "__len__"):
+                        record.rows += len(item)
+                    yield item
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+# ---------------------------------------------------------------------------
+# sampling profiler
+
+
+class SamplingProfiler:
+    """
+    Samples thread stacks at a fixed interval from a background thread, and
+    counts identical stacks. Cheap enough to run per request. All threads
+    are sampled unless thread_ids is given, so work handed to executor
+    threads shows up, along with other requests running concurrently.
+    """
+
+    def __init__(self, thread_ids: Optional[Sequence[int]] = None, interval: float = 0.005):
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+
+    def start(self) -> "SamplingProfiler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path: str) -> None:
+        """Write the samples as folded stacks, the input format of flamegraph.pl and speedscope."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()))
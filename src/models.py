@@ -35,6 +35,9 @@ class WiFi(Base):
     channel_width = Column(String)
     longitude = Column(Float)
     latitude = Column(Float)
+    h3_r4 = Column(String, index=True)
+    h3_r6 = Column(String, index=True)
+    h3_r8 = Column(String, index=True)
     state = Column(String, index=True)
     region = Column(String, index=True)
     band = Column(String, index=True)
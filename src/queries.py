@@ -0,0 +1,260 @@
+import base64
+import re
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import orjson
+import pyarrow as pa
+from sqlalchemy import BigInteger, DateTime, Float, Integer, String
+
+from src import geo
+from src.models import WiFi
+
+# qualifiers of SearchRequest that map one-to-one to equality filters on indexed columns
+SEARCH_FILTERS = ("ap_id", "channel", "band", "state", "region")
+
+# primary key of the wifi table, which orders pages
+KEY_COLUMNS = ("timestamp", "ap_id")
+
+COLUMNS = [column.name for column in WiFi.__table__.columns]
+
+_ARROW_TYPES = {
+    DateTime: pa.timestamp("us"),
+    String: pa.string(),
+    Float: pa.float64(),
+    Integer: pa.int32(),
+    BigInteger: pa.int64(),
+}
+
+
+def arrow_schema(columns: List[str]) -> pa.Schema:
+    """Arrow schema of result rows with the given columns of the wifi table."""
+    table_columns = WiFi.__table__.columns
+    return pa.schema([
+        (name, _ARROW_TYPES[type(table_columns[name].type)]) for name in columns
+    ])
+
+
+def naive_utc(ts: datetime) -> datetime:
+    """Timestamps are stored as naive UTC; drop the offset of aware inputs."""
+    if ts.tzinfo is None:
+        return ts
+    return ts.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def encode_cursor(timestamp: datetime, ap_id: str) -> str:
+    """Opaque continuation token for the page after the row with this key."""
+    return base64.urlsafe_b64encode(orjson.dumps([timestamp, ap_id])).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Inverse of encode_cursor; raises ValueError on malformed tokens."""
+    try:
+        timestamp, ap_id = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(timestamp), str(ap_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def projection(fields: Optional[List[str]]) -> List[str]:
+    """
+    Columns to select for the requested fields, in table order. The key
+    columns are always included so rows stay identifiable and pageable.
+    None selects every column.
+    """
+    if fields is None:
+        return COLUMNS
+    wanted = set(fields) | set(KEY_COLUMNS)
+    return [name for name in COLUMNS if name in wanted]
+
+
+class Dialect:
+    """
+    SQL differences between the stores the API reads from. A dialect turns a
+    bound value into a placeholder and collects the values in the shape its
+    driver expects.
+    """
+
+    name = None
+
+    def new_params(self):
+        raise NotImplementedError
+
+    def bind(self, params, value, column: str) -> str:
+        raise NotImplementedError
+
+    def bind_in(self, params, values, column: str) -> str:
+        return f"({', '.join(self.bind(params, value, column) for value in values)})"
+
+
+class QuestDBDialect(Dialect):
+    """QuestDB over the PostgreSQL wire protocol: $n placeholders, positional values."""
+
+    name = "questdb"
+
+    def new_params(self) -> list:
+        return []
+
+    def bind(self, params: list, value, column: str) -> str:
+        params.append(value)
+        return f"${len(params)}"
+
+
+class ClickHouseDialect(Dialect):
+    """ClickHouse server-side binding: {name:Type} placeholders, values by name."""
+
+    name = "clickhouse"
+    # types of bound columns other than strings
+    types = {"timestamp": "DateTime64(6)", "longitude": "Float64", "latitude": "Float64"}
+
+    def new_params(self) -> dict:
+        return {}
+
+    def bind(self, params: dict, value, column: str) -> str:
+        name = f"p{len(params)}"
+        params[name] = value
+        ch_type = self.types.get(column, "String")
+        return f"{{{name}:{ch_type}}}"
+
+
+QUESTDB = QuestDBDialect()
+CLICKHOUSE = ClickHouseDialect()
+
+
+def where_clause(request, dialect: Dialect, params) -> str:
+    """
+    Time window, indexed equality filters and area filter shared by every
+    endpoint. An area is selected through the indexed IN filter on its H3
+    cells; the coordinate ranges then only trim rows of the boundary cells.
+    """
+    clauses = [
+        f"timestamp >= {dialect.bind(params, naive_utc(request.from_ts), 'timestamp')}",
+        f"timestamp < {dialect.bind(params, naive_utc(request.to_ts), 'timestamp')}",
+    ]
+    for name in SEARCH_FILTERS:
+        value = getattr(request, name)
+        if value is not None:
+            clauses.append(f"{name} = {dialect.bind(params, value, name)}")
+    if request.area is not None:
+        resolution, cells, (min_lon, min_lat, max_lon, max_lat) = request.area
+        column = geo.cell_column(resolution)
+        clauses += [
+            f"{column} IN {dialect.bind_in(params, cells, column)}",
+            f"longitude >= {dialect.bind(params, min_lon, 'longitude')}",
+            f"longitude <= {dialect.bind(params, max_lon, 'longitude')}",
+            f"latitude >= {dialect.bind(params, min_lat, 'latitude')}",
+            f"latitude <= {dialect.bind(params, max_lat, 'latitude')}",
+        ]
+    return " AND ".join(clauses)
+
+
+def search_query(request, table_name: str, dialect: Dialect = QUESTDB) -> Tuple[str, object]:
+    """
+    Compile a search request into parameterized SQL for the given dialect.
+
+    Paged requests (with a limit) are ordered by the (timestamp, ap_id) key and
+    fetch one row more than the limit, which tells whether a next page exists.
+    The cursor resumes strictly after a key, and bounds the timestamp from
+    below, so every page is an interval scan starting at the cursor rather
+    than an OFFSET scan. Only the projected columns are selected.
+    """
+    params = dialect.new_params()
+    where = where_clause(request, dialect, params)
+    if request.cursor is not None:
+        after_ts, after_ap_id = decode_cursor(request.cursor)
+        ts = dialect.bind(params, after_ts, "timestamp")
+        ap_id = dialect.bind(params, after_ap_id, "ap_id")
+        # the AND-ed lower bound lets both engines narrow the scan to the
+        # partitions and granules from the cursor on; neither can from the OR alone
+        where += f" AND timestamp >= {ts} AND (timestamp > {ts} OR (timestamp = {ts} AND ap_id > {ap_id}))"
+    columns = projection(request.fields)
+    sql = f"SELECT {', '.join(columns)} FROM {table_name} WHERE {where}"
+    if request.limit is not None:
+        sql += f" ORDER BY {', '.join(KEY_COLUMNS)} LIMIT {int(request.limit) + 1}"
+    return sql, params
+
+
+# /aggregate: group-by keys, aggregate functions, and time bucket units
+GROUP_KEYS = ("region", "state", "band", "channel", "vendor_name", "model")
+AGGREGATE_FUNCTIONS = ("avg", "min", "max", "sum", "count")
+BUCKET_UNITS = {"m": "MINUTE", "h": "HOUR", "d": "DAY"}
+BUCKET_PATTERN = r"^([1-9][0-9]*)([mhd])$"
+
+METRIC_COLUMNS = [
+    column.name for column in WiFi.__table__.columns
+    if isinstance(column.type, (Float, Integer, BigInteger))
+]
+
+
+def rollup_metric(func: str, column: str) -> str:
+    """Aggregate over a rollup table (see src/rollups.py) equal to func(column) over the rows it covers."""
+    return {
+        "avg": f"CAST(sum({column}__sum) AS DOUBLE) / sum(row_count)",
+        "sum": f"sum({column}__sum)",
+        "min": f"min({column}__min)",
+        "max": f"max({column}__max)",
+        "count": "sum(row_count)",
+    }[func]
+
+
+def aggregate_query(
+    request,
+    table_name: str,
+    dialect: Dialect = QUESTDB,
+    rollup: bool = False,
+) -> Tuple[str, object]:
+    """
+    Compile an aggregate request into time-bucketed SQL: SAMPLE BY on QuestDB,
+    GROUP BY toStartOfInterval on ClickHouse. Each result row holds the bucket
+    start as `timestamp`, the group-by keys, and one `{func}_{column}` value per
+    requested aggregate. With rollup, table_name is a rollup table and the
+    aggregates are recombined from its partial sums, minima, maxima and counts.
+    """
+    params = dialect.new_params()
+    where = where_clause(request, dialect, params)
+    amount, unit = re.match(BUCKET_PATTERN, request.bucket).groups()
+    metrics = [
+        f"{rollup_metric(func, column) if rollup else f'{func}({column})'} AS {func}_{column}"
+        for column, funcs in request.metrics.items()
+        for func in funcs
+    ]
+    keys = list(request.group_by)
+    if dialect is CLICKHOUSE:
+        # the bucket cannot be aliased as timestamp, or the WHERE clause would
+        # filter on the alias instead of the column; buckets are aligned in UTC,
+        # as SAMPLE BY does, whatever the server's timezone
+        bucket = f"toStartOfInterval(timestamp, INTERVAL {amount} {BUCKET_UNITS[unit]}, 'UTC')"
+        sql = (
+            f"SELECT {bucket} AS bucket, {', '.join(keys + metrics)} FROM {table_name} "
+            f"WHERE {where} GROUP BY {', '.join(['bucket'] + keys)} "
+            f"ORDER BY {', '.join(['bucket'] + keys)}"
+        )
+    else:
+        sql = (
+            f"SELECT {', '.join(['timestamp'] + keys + metrics)} FROM {table_name} "
+            f"WHERE {where} SAMPLE BY {amount}{unit} ALIGN TO CALENDAR"
+        )
+    return sql, params
+
+
+def aggregate_rows(rows: list) -> list:
+    """Aggregate result rows as dicts, with the bucket start under `timestamp`."""
+    data = []
+    for row in rows:
+        row = dict(row)
+        if "bucket" in row:
+            row = {"timestamp": row.pop("bucket"), **row}
+        data.append(row)
+    return data
+
+
+def next_page(rows: list, limit: Optional[int]) -> Tuple[list, Optional[str]]:
+    """
+    Trim the extra row fetched by a paged query; return the page and the
+    cursor of the next one, or None if this is the last page.
+    """
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last["timestamp"], last["ap_id"])
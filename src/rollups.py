@@ -0,0 +1,145 @@
+import re
+from typing import List, Optional, Tuple
+
+from sqlalchemy import BigInteger, Float, Integer
+
+from src import geo, queries
+from src.models import WiFi
+
+# metrics kept in every rollup: the sum, min and max of each, plus the row
+# count, from which any aggregate of /aggregate can be recomputed exactly
+ROLLUP_METRICS = [name for name in queries.METRIC_COLUMNS if name not in ("longitude", "latitude")]
+
+# attributes of an access point that never change, so a per-AP rollup can
+# filter and group by them
+AP_ATTRIBUTES = ("state", "region", "band", "vendor_name", "model", "longitude", "latitude")
+
+_CLICKHOUSE_TYPES = {Float: "Float64", Integer: "Int32", BigInteger: "Int64"}
+_LOW_CARDINALITY = {"state", "region", "band", "vendor_name", "model"}
+# bucket of a row at each grain, in UTC like the QuestDB views and answers()
+_GRAIN_BUCKETS = {"1h": "toStartOfHour(timestamp, 'UTC')", "1d": "toStartOfDay(timestamp, 'UTC')"}
+_GRAIN_MINUTES = {"1h": 60, "1d": 24 * 60}
+_BUCKET_MINUTES = {"m": 1, "h": 60, "d": 24 * 60}
+
+
+class Rollup:
+    """
+    Pre-aggregated copy of the wifi table at a coarser time grain, grouped by
+    keys. Each row holds `<metric>__sum`, `<metric>__min`, `<metric>__max`
+    and `row_count` over the hourly rows it covers.
+    """
+
+    def __init__(self, name: str, grain: str, keys: Tuple[str, ...]):
+        self.name = name
+        self.grain = grain
+        self.keys = keys
+
+    @property
+    def grain_minutes(self) -> int:
+        return _GRAIN_MINUTES[self.grain]
+
+    def answers(self, request) -> bool:
+        """
+        Whether this rollup gives the same result as the wifi table: whole
+        grains in the window and each bucket, and every filter, group key and
+        metric available.
+        """
+        amount, unit = re.match(queries.BUCKET_PATTERN, request.bucket).groups()
+        if int(amount) * _BUCKET_MINUTES[unit] % self.grain_minutes != 0:
+            return False
+        for ts in (queries.naive_utc(request.from_ts), queries.naive_utc(request.to_ts)):
+            minutes = ts.hour * 60 + ts.minute
+            if minutes % self.grain_minutes != 0 or ts.second or ts.microsecond:
+                return False
+        used = set(request.group_by)
+        used |= {name for name in queries.SEARCH_FILTERS if getattr(request, name) is not None}
+        if request.area is not None:
+            used |= {geo.cell_column(request.area[0]), "longitude", "latitude"}
+        return used <= set(self.keys) and set(request.metrics) <= set(ROLLUP_METRICS)
+
+    def _aggregates(self) -> List[str]:
+        columns = []
+        for name in ROLLUP_METRICS:
+            columns += [
+                f"sum({name}) AS {name}__sum",
+                f"min({name}) AS {name}__min",
+                f"max({name}) AS {name}__max",
+            ]
+        return columns + ["count() AS row_count"]
+
+    def questdb_ddl(self, table_name: str) -> List[str]:
+        """A materialized view, refreshed incrementally as rows land in the wifi table."""
+        return [
+            f"CREATE MATERIALIZED VIEW IF NOT EXISTS {self.name} AS ("
+            f"SELECT timestamp, {', '.join(list(self.keys) + self._aggregates())} "
+            f"FROM {table_name} SAMPLE BY {self.grain}"
+            f") PARTITION BY {'DAY' if self.grain == '1h' else 'MONTH'};"
+        ]
+
+    def clickhouse_ddl(self, table_name: str) -> List[str]:
+        """
+        An AggregatingMergeTree table and the materialized view feeding it on
+        every insert into the wifi table; background merges combine the
+        partial rows of each insert.
+        """
+        table_columns = WiFi.__table__.columns
+        columns = ["timestamp DateTime64(6)"]
+        for key in self.keys:
+            kind = table_columns[key].type
+            if isinstance(kind, Float):
+                columns.append(f"{key} Float64")
+            elif key in _LOW_CARDINALITY:
+                columns.append(f"{key} LowCardinality(String)")
+            else:
+                columns.append(f"{key} String")
+        for name in ROLLUP_METRICS:
+            ch_type = _CLICKHOUSE_TYPES[type(table_columns[name].type)]
+            sum_type = "Float64" if ch_type == "Float64" else "Int64"
+            columns += [
+                f"{name}__sum SimpleAggregateFunction(sum, {sum_type})",
+                f"{name}__min SimpleAggregateFunction(min, {ch_type})",
+                f"{name}__max SimpleAggregateFunction(max, {ch_type})",
+            ]
+        columns.append("row_count SimpleAggregateFunction(sum, UInt64)")
+        keys = ", ".join(self.keys)
+        return [
+            f"CREATE TABLE IF NOT EXISTS {self.name} ({', '.join(columns)}) "
+            f"ENGINE = AggregatingMergeTree() PARTITION BY toYYYYMM(timestamp) "
+            f"ORDER BY (timestamp, {keys})",
+            # the bucket is computed in a subquery, since aliasing it as
+            # timestamp next to the column it is derived from is ambiguous
+            f"CREATE MATERIALIZED VIEW IF NOT EXISTS {self.name}_mv TO {self.name} AS "
+            f"SELECT bucket AS timestamp, * EXCEPT (bucket) FROM ("
+            f"SELECT {_GRAIN_BUCKETS[self.grain]} AS bucket, "
+            f"{', '.join(list(self.keys) + self._aggregates())} "
+            f"FROM {table_name} GROUP BY bucket, {keys})",
+        ]
+
+    def clickhouse_backfill(self, table_name: str) -> str:
+        """Fill a new rollup from rows loaded before its view existed."""
+        return (
+            f"INSERT INTO {self.name} SELECT bucket AS timestamp, * EXCEPT (bucket) FROM ("
+            f"SELECT {_GRAIN_BUCKETS[self.grain]} AS bucket, "
+            f"{', '.join(list(self.keys) + self._aggregates())} "
+            f"FROM {table_name} GROUP BY bucket, {', '.join(self.keys)})"
+        )
+
+
+def get_rollups(cfg) -> List[Rollup]:
+    """Rollups maintained for the wifi table, coarsest first."""
+    dims = ("state", "region", "band", "vendor_name")
+    cells = tuple(geo.cell_column(resolution) for resolution in cfg.geo.h3_resolutions)
+    return [
+        Rollup("wifi_dims_1d", "1d", dims),
+        Rollup("wifi_dims_1h", "1h", dims),
+        Rollup("wifi_ap_1d", "1d", ("ap_id",) + AP_ATTRIBUTES + cells),
+    ]
+
+
+def route(request, cfg) -> Optional[Rollup]:
+    """Coarsest rollup that answers an aggregate request exactly, or None for the wifi table."""
+    for rollup in get_rollups(cfg):
+        if rollup.answers(request):
+            return rollup
+    return None
+
@@ -0,0 +1,247 @@
+import argparse
+import logging
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import omegaconf
+
+import src.data.data_generator as data_gen
+import src.utils as utils
+from src import ingestion, instrumentation
+
+HOUR = timedelta(hours=1)
+
+# scheduler.ingestion_mode -> function ingesting one raw hour in-process
+INGEST = {
+    "fused": ingestion.ingest_fused,
+    "staged": ingestion.ingest_staged,
+}
+
+# sink name in ingestion.sinks -> table setup, run once at start-up
+SINK_SETUP = {
+    "clickhouse": utils.ensure_clickhouse_table,
+    "questdb": utils.ensure_questdb_table,
+}
+
+
+def _warm_worker() -> None:
+    """
+    Pool initializer: pay the imports and map the access point store once per
+    worker. data_generator keeps the mapping, and generate_data reuses it for
+    every hour the worker generates.
+    """
+    utils.set_logging()
+    data_gen.open_access_points()
+
+
+def generate_hour(base_time: datetime, params: dict, seed: Optional[np.random.SeedSequence]) -> Tuple[str, float]:
+    """Write the raw hour starting at base_time; run in a warm worker process."""
+    start = time.perf_counter()
+    path = data_gen.persist_hour(base_time, output_format="parquet", seed=seed, **params)
+    return str(path), time.perf_counter() - start
+
+
+def tick_seed(seed: Optional[int], base_time: datetime) -> Optional[np.random.SeedSequence]:
+    """Seed of one hour, so a seeded run generates the same data for an hour whenever it runs."""
+    if seed is None:
+        return None
+    return np.random.SeedSequence([seed, (base_time - datetime(1970, 1, 1)) // HOUR])
+
+
+def warm_up(cfg: omegaconf.dictconfig.DictConfig, n_aps: int) -> None:
+    """Everything the Makefile loops paid on every hour: access points, store and tables."""
+    data_gen.ensure_access_points(n_aps)
+    data_gen.ensure_ap_store()
+    for sink in cfg.ingestion.sinks:
+        SINK_SETUP[sink]()
+
+
+def ingest_waiting(cfg: omegaconf.dictconfig.DictConfig, ingest) -> set:
+    """
+    Ingest the hours left behind by an interrupted run, the aggregates of
+    failed loads first, then raw hours; returns the start times of those
+    ingested. A raw hour that fails is generated again in turn.
+    """
+    hours = {datetime.fromisoformat(filename) for filename in ingestion.load_stranded_aggregates(cfg)}
+    for path in ingestion.find_hourly_inputs():
+        logging.info(f"Ingesting {path.name}, left by an earlier run.")
+        try:
+            ingest(path, cfg)
+        except Exception:
+            logging.exception(f"Ingesting {path} failed; the hour will be generated again.")
+            continue
+        hours.add(datetime.fromisoformat(path.stem))
+    return hours
+
+
+def retry_ingest(path: Path, cfg: omegaconf.dictconfig.DictConfig, ingest) -> None:
+    """Ingest an hour again after a failure; the staged path may have left only its aggregate."""
+    if path.exists():
+        ingest(path, cfg)
+    else:
+        ingestion.load_aggregated(path.stem, cfg)
+
+
+def _can_retry(path: Path) -> bool:
+    return path.exists() or Path(ingestion.staged_aggregate_path(path.stem)).exists()
+
+
+def run(
+    cfg: omegaconf.dictconfig.DictConfig,
+    params: dict,
+    ticks: Optional[int],
+    interval_seconds: float,
+    catch_up_workers: int,
+    seed: Optional[int] = None,
+    ingestion_mode: str = "fused",
+    retry_seconds: float = 5.0,
+    max_retry_seconds: float = 300.0,
+) -> None:
+    """
+    Generate and ingest one hour per tick, starting at the clock in
+    data/.metadata/config.toml, which advances after every ingested hour.
+
+    Tick k is due interval_seconds * k after start-up. Hours are generated in
+    a pool of catch_up_workers processes, which stay warm across ticks, so
+    when ticks fall behind schedule (or interval_seconds is 0) up to that
+    many hours are generated ahead while the previous one is ingested here.
+    Hours are always ingested in order. Runs forever if ticks is None.
+
+    A tick that fails, in generation or ingestion, is logged and retried
+    after a backoff doubling from retry_seconds up to max_retry_seconds, and
+    the hours after it wait their turn. A failed ingestion is retried from
+    the files the hour left behind, or the hour is generated again if none
+    are left.
+    """
+    ingest = INGEST[ingestion_mode]
+    start = time.perf_counter()
+    warm_up(cfg, params["n_aps"])
+    ingested = ingest_waiting(cfg, ingest)
+    logging.info(f"Warm-up took {time.perf_counter() - start:.2f}s; it is not paid again per tick.")
+
+    spawn = multiprocessing.get_context("spawn")
+
+    def new_pool() -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=catch_up_workers, mp_context=spawn, initializer=_warm_worker)
+
+    def generate(base_time: datetime) -> Future:
+        return pool.submit(generate_hour, base_time, params, tick_seed(seed, base_time))
+
+    next_hour = data_gen.get_current_time()
+    in_flight = deque()
+    submitted = done = failures = 0
+    last_done = start = time.perf_counter()
+    pool = new_pool()
+    try:
+        while ticks is None or done < ticks:
+            # submit every due tick, with at most catch_up_workers hours in flight
+            while (
+                (ticks is None or submitted < ticks)
+                and len(in_flight) < catch_up_workers
+                and start + submitted * interval_seconds <= time.perf_counter()
+            ):
+                while next_hour in ingested:
+                    next_hour += HOUR
+                in_flight.append((next_hour, start + submitted * interval_seconds, generate(next_hour)))
+                next_hour += HOUR
+                submitted += 1
+            if not in_flight:
+                time.sleep(max(0.0, start + submitted * interval_seconds - time.perf_counter()))
+                continue
+
+            base_time, due, future = in_flight[0]
+            tick_start = max(due, last_done)
+            path = None
+            try:
+                with instrumentation.stage("scheduler_tick"):
+                    wait_start = time.perf_counter()
+                    path, generate_seconds = future.result()
+                    path = Path(path)
+                    waited = time.perf_counter() - wait_start
+                    ingest_start = time.perf_counter()
+                    if failures:
+                        retry_ingest(path, cfg, ingest)
+                    else:
+                        ingest(path, cfg)
+                    ingest_seconds = time.perf_counter() - ingest_start
+                    data_gen.set_current_time(base_time + HOUR)
+            except Exception as e:
+                failures += 1
+                delay = min(retry_seconds * 2 ** (failures - 1), max_retry_seconds)
+                if path is None:
+                    logging.exception(f"Generating the hour {base_time} failed; retrying in {delay:g}s.")
+                else:
+                    logging.exception(f"Ingesting {path} failed; retrying in {delay:g}s.")
+                if isinstance(e, BrokenProcessPool):
+                    # a worker died, e.g. killed for memory; every hour in flight is lost
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = new_pool()
+                    in_flight = deque((hour, hour_due, generate(hour)) for hour, hour_due, _ in in_flight)
+                elif path is None or not _can_retry(path):
+                    in_flight[0] = (base_time, due, generate(base_time))
+                time.sleep(delay)
+                # the tick's timings cover its last attempt only
+                last_done = time.perf_counter()
+                continue
+            in_flight.popleft()
+            failures = 0
+            if cfg.ingestion.metrics_path:
+                try:
+                    instrumentation.write_metrics(cfg.ingestion.metrics_path)
+                except OSError:
+                    logging.exception("Writing the metrics failed.")
+            last_done = time.perf_counter()
+            done += 1
+            wall = last_done - tick_start
+            logging.info(
+                f"Tick {done} ({base_time}): generate {generate_seconds:.2f}s, waited {waited:.2f}s, "
+                f"ingest {ingest_seconds:.2f}s, wall {wall:.2f}s, overhead {wall - waited - ingest_seconds:.3f}s, "
+                f"{len(in_flight)} hours in flight, {last_done - due:.2f}s after due"
+            )
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    utils.set_logging()
+    cfg = utils.load_config()
+    settings = cfg.scheduler
+    parser = argparse.ArgumentParser(
+        description="Resident generator and ingestion loop, one hour per tick, in place of "
+                    "restarting both every hour.",
+    )
+    parser.add_argument("--ticks", type=int, default=None, help="Hours to run; forever by default.")
+    parser.add_argument("--interval_seconds", type=float, default=None, help="Overrides scheduler.interval_seconds.")
+    parser.add_argument("--catch_up_workers", type=int, default=None, help="Overrides scheduler.catch_up_workers.")
+    parser.add_argument("--n_aps", type=int, default=None, help="Overrides scheduler.n_aps.")
+    parser.add_argument("--n_sessions_per_ap", type=int, default=None, help="Overrides scheduler.n_sessions_per_ap.")
+    parser.add_argument(
+        "--n_records_per_session", type=int, default=None, help="Overrides scheduler.n_records_per_session.",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the generated hours; omit for a non-reproducible run.")
+    parser.add_argument(
+        "--ingestion_mode", type=str, default=None, choices=list(INGEST), help="Overrides scheduler.ingestion_mode.",
+    )
+    args = parser.parse_args()
+    run(
+        cfg,
+        params={
+            "n_aps": args.n_aps or settings.n_aps,
+            "n_sessions_per_ap": args.n_sessions_per_ap or settings.n_sessions_per_ap,
+            "n_records_per_session": args.n_records_per_session or settings.n_records_per_session,
+        },
+        ticks=args.ticks,
+        interval_seconds=args.interval_seconds if args.interval_seconds is not None else settings.interval_seconds,
+        catch_up_workers=args.catch_up_workers or settings.catch_up_workers,
+        seed=args.seed,
+        ingestion_mode=args.ingestion_mode or settings.ingestion_mode,
+        retry_seconds=settings.retry_seconds,
+        max_retry_seconds=settings.max_retry_seconds,
+    )
@@ -1,7 +1,13 @@
+import contextlib
+import functools
 import logging
-import time
+import queue
+import re
 import asyncio
+import threading
+from datetime import datetime, timedelta
 from pathlib import Path
+from typing import Optional, Tuple
 
 import dotenv
 from hydra import compose, initialize_config_dir
@@ -9,15 +15,11 @@ import asyncpg as pg
 from omegaconf import OmegaConf
 import clickhouse_connect
 import pandas as pd
+import pyarrow as pa
+import toml
+from questdb.ingress import Sender
 
-def timed(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        logging.info(f"Function {func.__name__} took {end_time - start_time:.2f} seconds")
-        return result
-    return wrapper
+from src import rollups
 
 def set_logging():
     logging.basicConfig(
@@ -29,96 +31,471 @@ def set_logging():
         ]
     )
 
-def load_config(path: str = "config/main.yaml"):
+# Hydra keeps global state, so concurrent loader threads must compose one at a time
+_config_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def _compose_config(absolute_path: Path):
     dotenv.load_dotenv()
-    absolute_path = Path(path).resolve()
-    absolute_parent_folder = absolute_path.parent
-    with initialize_config_dir(version_base=None, config_dir=str(absolute_parent_folder)):
-            cfg = compose(config_name=Path(path).stem)
+    with _config_lock, initialize_config_dir(version_base=None, config_dir=str(absolute_path.parent)):
+            cfg = compose(config_name=absolute_path.stem)
             OmegaConf.resolve(cfg)  # apply interpolatations
+    # shared by every caller in the process; writes raise ReadonlyConfigError
+    OmegaConf.set_readonly(cfg, True)
     return cfg
 
-def get_ingestion_config():
+# path -> configuration merged with the overrides of override_config()
+_overridden_configs = {}
+
+def load_config(path: str = "config/main.yaml"):
+    """
+    Load the configuration. It is composed once per process and path; later
+    calls return the same read-only object. Use with_overrides() for a
+    modified copy.
+    """
+    absolute_path = Path(path).resolve()
+    if absolute_path in _overridden_configs:
+        return _overridden_configs[absolute_path]
+    return _compose_config(absolute_path)
+
+def with_overrides(cfg, overrides: dict):
+    """Read-only copy of cfg with the nested overrides merged in; cfg is left as is."""
+    merged = OmegaConf.merge(cfg, overrides)
+    OmegaConf.set_readonly(merged, True)
+    return merged
+
+def override_config(overrides: dict, path: str = "config/main.yaml") -> None:
+    """
+    Apply overrides to what load_config() returns for the rest of the process,
+    for processes dedicated to one job, such as a benchmark stage pointed at
+    stand-ins. Elsewhere, pass a with_overrides() copy down instead.
+    """
+    absolute_path = Path(path).resolve()
+    _overridden_configs[absolute_path] = with_overrides(load_config(path), overrides)
+
+def get_ingestion_config(**options):
+    """
+    QuestDB client configuration string; extra options such as
+    auto_flush_rows are appended as key=value pairs.
+    """
     cfg = load_config()
     username = cfg.db.questdb.auth.username
     password = cfg.db.questdb.auth.password
     host = cfg.db.questdb.auth.host
     port = cfg.db.questdb.params.ingestion_port
     protocol = cfg.db.questdb.params.ingestion_protocol
-    return f"{protocol}::addr={host}:{port};username={username};password={password};"
+    extra = "".join(f"{key}={value};" for key, value in options.items())
+    return f"{protocol}::addr={host}:{port};username={username};password={password};{extra}"
 
 
-async def query_questdb(query: str):
+# end of the contiguous run of loaded hours; hours before it are immutable.
+# Kept apart from the generator clock in config.toml, so the two processes
+# never rewrite each other's file. Hours loaded past a gap wait in the file,
+# under "loaded", until the gap is filled.
+WATERMARK_PATH = Path("data/.metadata/watermark.toml")
+_watermark = (None, None)  # (mtime_ns, value) of the last read
+_watermark_lock = threading.Lock()
+
+def _read_watermark_file() -> dict:
+    with open(WATERMARK_PATH, "r") as f:
+        return toml.load(f)["ingestion"]
+
+def get_watermark() -> Optional[datetime]:
+    """Ingestion watermark, or None if nothing was loaded yet. Re-read only when the file changes."""
+    global _watermark
+    try:
+        mtime = WATERMARK_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _watermark[0] != mtime:
+        value = datetime.fromisoformat(_read_watermark_file()["watermark"])
+        _watermark = (mtime, value)
+    return _watermark[1]
+
+def publish_loaded_hour(hour: datetime) -> None:
+    """
+    Record the hour starting at hour as loaded and visible, and advance the
+    watermark over the contiguous run of loaded hours that follows it. It
+    never passes an hour that is not loaded yet, and never moves back. The
+    first hour ever published starts the run.
+    """
+    with _watermark_lock:
+        watermark, loaded = None, set()
+        if WATERMARK_PATH.exists():
+            state = _read_watermark_file()
+            watermark = datetime.fromisoformat(state["watermark"])
+            loaded = {datetime.fromisoformat(value) for value in state.get("loaded", [])}
+        previous = watermark
+        loaded.add(hour)
+        if watermark is None:
+            watermark = hour
+        while watermark in loaded:
+            loaded.discard(watermark)
+            watermark += timedelta(hours=1)
+        loaded = sorted(value for value in loaded if value > watermark)
+
+        WATERMARK_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = WATERMARK_PATH.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            toml.dump(
+                {"ingestion": {"watermark": watermark.isoformat(), "loaded": [value.isoformat() for value in loaded]}},
+                f,
+            )
+        tmp_path.replace(WATERMARK_PATH)
+    if watermark != previous:
+        logging.info(f"Ingestion watermark is now {watermark}")
+    else:
+        logging.info(f"Hour {hour} loaded; the watermark waits at {watermark} for the hours before it.")
+
+
+# process-wide registry of warm resources: an asyncpg pool per event loop,
+# the loop synchronous callers run QuestDB queries on, pools of ILP senders
+# and ClickHouse clients, and the schemas already ensured
+_questdb_pools = {}
+_questdb_loop = None
+_questdb_loop_lock = threading.Lock()
+_questdb_sender_pools = {}
+_questdb_sender_pools_lock = threading.Lock()
+_clickhouse_pool = None
+_clickhouse_pool_lock = threading.Lock()
+_ensured = set()
+_ensure_lock = threading.Lock()
+
+async def _connect_questdb():
     cfg = load_config()
-    conn = await pg.connect(
+    return await pg.connect(
         host=cfg.db.questdb.auth.host,
         port=cfg.db.questdb.params.query_port,
         user=cfg.db.questdb.auth.username,
         password=cfg.db.questdb.auth.password,
         database=cfg.db.questdb.auth.db
     )
-    results = await conn.fetch(query)
-    await conn.close()
-    return results
 
-def create_questdb_table() -> None:
+async def get_questdb_pool() -> pg.Pool:
+    """
+    asyncpg pool for the running event loop, created on first use. A pool
+    that fails to open, e.g. while QuestDB is down, is not kept, so the next
+    call tries again.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _questdb_pools:
+        for stale in [other for other in _questdb_pools if other.is_closed()]:
+            del _questdb_pools[stale]
+        cfg = load_config()
+        _questdb_pools[loop] = asyncio.ensure_future(pg.create_pool(
+            host=cfg.db.questdb.auth.host,
+            port=cfg.db.questdb.params.query_port,
+            user=cfg.db.questdb.auth.username,
+            password=cfg.db.questdb.auth.password,
+            database=cfg.db.questdb.auth.db,
+            min_size=1,
+            max_size=cfg.db.questdb.params.pool_size,
+        ))
+    task = _questdb_pools[loop]
+    try:
+        # shielded, so a cancelled request does not cancel the pool the others wait on
+        return await asyncio.shield(task)
+    except Exception:
+        if _questdb_pools.get(loop) is task:
+            del _questdb_pools[loop]
+        raise
+
+def run_questdb(coroutine):
+    """
+    Run a coroutine from synchronous code on the process-wide QuestDB loop, a
+    daemon thread started on first use. The asyncpg pool of that loop (see
+    get_questdb_pool) stays open between calls, so a long-running process
+    such as the scheduler does not reconnect every hour.
+    """
+    global _questdb_loop
+    with _questdb_loop_lock:
+        if _questdb_loop is None:
+            _questdb_loop = asyncio.new_event_loop()
+            threading.Thread(target=_questdb_loop.run_forever, name="questdb-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _questdb_loop).result()
+
+async def query_questdb(query: str):
+    pool = await get_questdb_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetch(query)
+
+def schema_definitions(schema_sql: str) -> Tuple[dict, dict]:
+    """
+    Column and index definitions of the CREATE TABLE statement in a
+    db/*-schema.sql file, as name -> definition. Setup adds those missing
+    from a table created by an older schema.
+    """
+    body = schema_sql[schema_sql.index("(") + 1:schema_sql.index("\n)")]
+    columns, indexes = {}, {}
+    for line in body.splitlines():
+        line = line.strip().rstrip(",")
+        if not line:
+            continue
+        name, definition = line.split(None, 1)
+        if name.upper() == "INDEX":
+            name, definition = definition.split(None, 1)
+            indexes[name] = definition
+        else:
+            columns[name] = definition
+    return columns, indexes
+
+async def _create_questdb_table() -> None:
     cfg = load_config()
+    table_name = cfg.db.questdb.params.table_name
     to_index = cfg.db.questdb.params.indexes
     with open("db/questdb-schema.sql", "r") as f:
         schema_sql = f.read()
 
-    # idempotent table creation
-    _ = asyncio.run(query_questdb(schema_sql))
+    conn = await _connect_questdb()
+    try:
+        # idempotent table creation
+        await conn.execute(schema_sql)
+
+        # columns added to the schema since the table was created
+        columns, _ = schema_definitions(schema_sql)
+        existing = {row["column"] for row in await conn.fetch(f"SELECT \"column\" FROM table_columns('{table_name}');")}
+        for name, definition in columns.items():
+            if name not in existing:
+                await conn.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {name} {definition};")
+                logging.info(f"Added column {name} to QuestDB table {table_name}.")
 
-    # create indexes if not exist
-    query = f"""
-    SELECT "column"
-    FROM table_columns('{cfg.db.questdb.params.table_name}')
-    WHERE indexed = true;
+        # create indexes if not exist
+        query = f"""
+        SELECT "column"
+        FROM table_columns('{cfg.db.questdb.params.table_name}')
+        WHERE indexed = true;
+        """
+        indexed = await conn.fetch(query)
+        not_yet_indexed = set(to_index) - {row["column"] for row in indexed}
+        for col in not_yet_indexed:
+            index_sql = f"ALTER TABLE {cfg.db.questdb.params.table_name} ALTER COLUMN {col} ADD INDEX;"
+            await conn.execute(index_sql)
+            logging.info(f"Created index on column {col}.")
+
+        # rollups are materialized views; QuestDB fills them from existing
+        # rows and then refreshes them incrementally on every commit
+        for rollup in rollups.get_rollups(cfg):
+            for statement in rollup.questdb_ddl(cfg.db.questdb.params.table_name):
+                await conn.execute(statement)
+    finally:
+        await conn.close()
+
+def create_questdb_table() -> None:
+    asyncio.run(_create_questdb_table())
+
+async def _wait_questdb_visible(table_name: str, timeout: float, poll: float) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    pool = await get_questdb_pool()
+    async with pool.acquire() as conn:
+        while True:
+            table = await conn.fetchrow(
+                f"SELECT suspended, writerTxn, sequencerTxn FROM wal_tables() WHERE name = '{table_name}';"
+            )
+            if table is not None and table["suspended"]:
+                raise RuntimeError(f"WAL apply of QuestDB table '{table_name}' is suspended.")
+            stale_views = await conn.fetch(
+                f"""
+                SELECT view_name FROM materialized_views()
+                WHERE base_table_name = '{table_name}'
+                AND view_status <> 'invalid'
+                AND refresh_base_table_txn < base_table_txn;
+                """
+            )
+            if (table is None or table["writerTxn"] >= table["sequencerTxn"]) and not stale_views:
+                return
+            if loop.time() > deadline:
+                raise TimeoutError(f"Rows sent to QuestDB table '{table_name}' were not visible after {timeout}s.")
+            await asyncio.sleep(poll)
+
+def wait_questdb_visible(table_name: str, timeout: float, poll: float = 0.2) -> None:
     """
-    indexed = asyncio.run(query_questdb(query))
-    not_yet_indexed = set(to_index) - {row["column"] for row in indexed}
-    for col in not_yet_indexed:
-        index_sql = f"ALTER TABLE {cfg.db.questdb.params.table_name} ALTER COLUMN {col} ADD INDEX;"
-        _ = asyncio.run(query_questdb(index_sql))
-        logging.info(f"Created index on column {col}.")
+    Block until QuestDB has applied every committed WAL transaction of the
+    table, and refreshed the materialized views built on it, so that the
+    rows sent so far are visible to queries.
+    """
+    run_questdb(_wait_questdb_visible(table_name, timeout, poll))
 
 def create_clickhouse_table() -> None:
-    cfg = load_config()
     with open("db/clickhouse-schema.sql", "r") as f:
         schema_sql = f.read()
 
-    client = clickhouse_connect.get_client(
-        host=cfg.db.clickhouse.auth.host,
-        port=cfg.db.clickhouse.auth.port, 
-        user=cfg.db.clickhouse.auth.username, 
-        password=cfg.db.clickhouse.auth.password
-    )
+    cfg = load_config()
+    table_name = cfg.db.clickhouse.params.table_name
+    with clickhouse_client() as client:
+        client.command(schema_sql)
+        # columns and skip indexes added to the schema since the table was created
+        columns, indexes = schema_definitions(schema_sql)
+        for kind, system_table, definitions in (
+            ("COLUMN", "system.columns", columns),
+            ("INDEX", "system.data_skipping_indices", indexes),
+        ):
+            existing = {row[0] for row in client.query(
+                f"SELECT name FROM {system_table} WHERE database = currentDatabase() AND table = {{table:String}}",
+                parameters={"table": table_name},
+            ).result_rows}
+            for name, definition in definitions.items():
+                if name not in existing:
+                    client.command(f"ALTER TABLE {table_name} ADD {kind} IF NOT EXISTS {name} {definition}")
+                    logging.info(f"Added {kind.lower()} {name} to ClickHouse table {table_name}.")
+        # deduplication window of tables created before the schema set it;
+        # without it insert_deduplication_token is ignored on a plain MergeTree
+        window = re.search(r"non_replicated_deduplication_window = \d+", schema_sql)
+        if window:
+            client.command(f"ALTER TABLE {table_name} MODIFY SETTING {window.group(0)}")
+        for rollup in rollups.get_rollups(cfg):
+            existed = client.command(f"EXISTS TABLE {rollup.name}") == 1
+            table_ddl, view_ddl = rollup.clickhouse_ddl(table_name)
+            client.command(table_ddl)
+            client.command(view_ddl)
+            if not existed:
+                # the view only sees new inserts; fill the rollup from the rows already loaded
+                client.command(rollup.clickhouse_backfill(table_name))
+                logging.info(f"Created and backfilled rollup {rollup.name}.")
+
+def ensure_once(key: str, setup) -> None:
+    """
+    Run setup the first time key is seen in this process. Concurrent callers
+    wait for the first one to finish, so the setup is done when this returns.
+    """
+    with _ensure_lock:
+        if key in _ensured:
+            return
+        setup()
+        _ensured.add(key)
+
+def ensure_questdb_table() -> None:
+    ensure_once("questdb", create_questdb_table)
+
+def ensure_clickhouse_table() -> None:
+    ensure_once("clickhouse", create_clickhouse_table)
+
+_CLICKHOUSE_ARROW_TYPES = {
+    "String": pa.string(),
+    "Float64": pa.float64(),
+    "Int32": pa.int32(),
+    "Int64": pa.int64(),
+    "UInt64": pa.uint64(),
+    "DateTime64(6)": pa.timestamp("us"),
+}
 
-    client.command(schema_sql)
+def clickhouse_arrow_schema(path: str = "db/clickhouse-schema.sql") -> pa.Schema:
+    """
+    Arrow schema matching the columns of the ClickHouse table definition.
+    LowCardinality columns are dictionary-encoded, so inserts pass codes
+    rather than strings.
+    """
+    with open(path, "r") as f:
+        schema_sql = f.read()
+    fields = []
+    for line in schema_sql.splitlines():
+        match = re.match(r"^\s*(\w+)\s+([\w()]+),?$", line)
+        if match is None or match.group(1) in ("CREATE", "ENGINE", "INDEX"):
+            continue
+        name, ch_type = match.groups()
+        low_cardinality = re.fullmatch(r"LowCardinality\((.+)\)", ch_type)
+        if low_cardinality is not None:
+            fields.append(pa.field(name, pa.dictionary(pa.int32(), _CLICKHOUSE_ARROW_TYPES[low_cardinality.group(1)])))
+        else:
+            fields.append(pa.field(name, _CLICKHOUSE_ARROW_TYPES[ch_type]))
+    return pa.schema(fields)
 
 
 def query_clickhouse(query: str) -> pd.DataFrame:
-    cfg = load_config()
-    client = clickhouse_connect.get_client(
-        host=cfg.db.clickhouse.auth.host,
-        port=cfg.db.clickhouse.auth.port, 
-        user=cfg.db.clickhouse.auth.username, 
-        password=cfg.db.clickhouse.auth.password
-    )
-    results = client.query_df(query)
-    return results
+    with clickhouse_client() as client:
+        return client.query_df(query)
 
 def get_clickhouse_client():
+    """Open a new ClickHouse client; prefer clickhouse_client() to reuse a pooled one."""
     cfg = load_config()
     client = clickhouse_connect.get_client(
         host=cfg.db.clickhouse.auth.host,
         port=cfg.db.clickhouse.auth.port, 
         user=cfg.db.clickhouse.auth.username, 
-        password=cfg.db.clickhouse.auth.password
+        password=cfg.db.clickhouse.auth.password,
+        # pooled clients are shared between threads, so no server-side session
+        autogenerate_session_id=False,
     )
     return client
 
+class ClientPool:
+    """
+    Bounded pool of reusable clients. Clients are created lazily up to size;
+    beyond that, borrowers wait for a client to be returned. A borrower that
+    fails with one of discard_on closes its client, which may be broken, and
+    the next borrower of the slot opens a fresh one.
+    """
+
+    def __init__(self, factory, size: int, close=None, discard_on: tuple = ()):
+        self._factory = factory
+        self._size = size
+        self._close = close
+        self._discard_on = discard_on
+        self._created = 0
+        # idle clients, and None for each slot left without one
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def client(self):
+        try:
+            client = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self._size
+                if create:
+                    self._created += 1
+            client = None if create else self._idle.get()
+        if client is None:
+            try:
+                client = self._factory()
+            except Exception:
+                # hand the slot on, so a waiting borrower tries in turn
+                self._idle.put(None)
+                raise
+        try:
+            yield client
+        except self._discard_on:
+            if self._close is not None:
+                with contextlib.suppress(Exception):
+                    self._close(client)
+            client = None
+            raise
+        finally:
+            self._idle.put(client)
+
+def clickhouse_client():
+    """Borrow a client from the process-wide ClickHouse pool."""
+    global _clickhouse_pool
+    with _clickhouse_pool_lock:
+        if _clickhouse_pool is None:
+            size = load_config().db.clickhouse.params.pool_size
+            _clickhouse_pool = ClientPool(get_clickhouse_client, size)
+    return _clickhouse_pool.client()
+
+def _open_questdb_sender(conf: str) -> Sender:
+    sender = Sender.from_conf(conf)
+    sender.establish()
+    return sender
+
+def questdb_sender(conf: str):
+    """
+    Borrow an established ILP sender for a client configuration (see
+    get_ingestion_config) from a process-wide pool, sized for the senders of
+    every hour the pipelined loaders send at once. Return it flushed; a
+    sender whose borrower fails is closed unflushed and replaced.
+    """
+    with _questdb_sender_pools_lock:
+        if conf not in _questdb_sender_pools:
+            cfg = load_config()
+            _questdb_sender_pools[conf] = ClientPool(
+                functools.partial(_open_questdb_sender, conf),
+                cfg.db.questdb.params.senders * cfg.ingestion.load_workers,
+                close=lambda sender: sender.close(flush=False),
+                discard_on=(Exception,),
+            )
+    return _questdb_sender_pools[conf].client()
+
 class Pipe:
     def __init__(self, value):
         self.value = value
@@ -0,0 +1,46 @@
+from datetime import datetime
+
+from src.backend import SearchRequest
+from src.cache import ResultCache, cache_key
+
+TO_TS = datetime(2025, 11, 17, 6)
+
+
+def test_key_ignores_offset_and_field_order():
+    utc = SearchRequest(**{"from": "2025-11-17T00:00:00", "to": "2025-11-17T06:00:00", "fields": ["avg_rssi", "avg_snr"]})
+    shifted = SearchRequest(**{"from": "2025-11-17T02:00:00+02:00", "to": "2025-11-17T08:00:00+02:00", "fields": ["avg_snr", "avg_rssi"]})
+    assert cache_key("search", "questdb", utc) == cache_key("search", "questdb", shifted)
+    assert cache_key("search", "questdb", utc) != cache_key("search", "clickhouse", utc)
+
+
+def test_window_before_watermark_never_expires():
+    cache = ResultCache(max_bytes=1024, open_ttl=0)
+    cache.put(b"closed", b"body", TO_TS, watermark=TO_TS)
+    assert cache.get(b"closed") == b"body"
+
+
+def test_window_past_watermark_expires_after_open_ttl():
+    cache = ResultCache(max_bytes=1024, open_ttl=0)
+    cache.put(b"open", b"body", TO_TS, watermark=datetime(2025, 11, 17, 5))
+    cache.put(b"unloaded", b"body", TO_TS, watermark=None)
+    assert cache.get(b"open") is None
+    assert cache.get(b"unloaded") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    cache = ResultCache(max_bytes=8, open_ttl=60)
+    cache.put(b"a", b"aaaa", TO_TS, watermark=TO_TS)
+    cache.put(b"b", b"bbbb", TO_TS, watermark=TO_TS)
+    assert cache.get(b"a") == b"aaaa"
+    cache.put(b"c", b"cccc", TO_TS, watermark=TO_TS)
+    assert cache.get(b"b") is None
+    assert cache.get(b"a") == b"aaaa" and cache.get(b"c") == b"cccc"
+    assert cache.stats()["bytes"] == 8
+
+
+def test_body_larger_than_the_cache_is_not_stored():
+    cache = ResultCache(max_bytes=4, open_ttl=60)
+    cache.put(b"big", b"too big", TO_TS, watermark=TO_TS)
+    assert cache.get(b"big") is None
+    assert cache.stats()["bytes"] == 0
@@ -0,0 +1,42 @@
+import polars as pl
+import pytest
+
+from src import hll
+
+
+def estimate(values: list, precision: int) -> int:
+    return (pl.DataFrame({"value": values})
+        .group_by(hll.register("value", precision).alias("register"))
+        .agg(hll.rank("value", precision).max().alias("rank"))
+        .select(hll.estimate(pl.col("rank"), precision))
+        .item()
+    )
+
+
+def test_relative_error():
+    assert hll.relative_error(12) == pytest.approx(1.04 / 64)
+
+
+def test_registers_and_ranks_stay_in_range():
+    precision = 6
+    frame = pl.DataFrame({"value": [f"s{i}" for i in range(10_000)]}).select(
+        hll.register("value", precision).alias("register"),
+        hll.rank("value", precision).alias("rank"),
+    )
+    assert frame["register"].max() < 2 ** precision
+    assert frame["rank"].min() >= 1 and frame["rank"].max() <= 64 - precision + 1
+
+
+def test_small_counts_are_close_to_exact():
+    assert estimate(["a", "b", "c", "a", "b"], 12) == 3
+
+
+@pytest.mark.parametrize("n", [10_000, 200_000])
+def test_large_counts_within_four_standard_errors(n):
+    precision = 10
+    assert abs(estimate([f"s{i}" for i in range(n)], precision) - n) <= 4 * hll.relative_error(precision) * n
+
+
+def test_estimate_is_reproducible():
+    values = [f"s{i}" for i in range(50_000)]
+    assert estimate(values, 8) == estimate(list(reversed(values)), 8)
@@ -0,0 +1,98 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from src import geo, ingestion, utils
+from src.data.record_generator import generate_records
+
+N_APS = 60
+
+
+@pytest.fixture(scope="module")
+def raw_path(tmp_path_factory):
+    """A raw hour as the generator writes it: records joined with their access point."""
+    records = pd.concat(generate_records(
+        n_aps=N_APS, base_time=datetime(2025, 11, 17), n_sessions_per_ap=3, n_records_per_session=4,
+        rng=np.random.default_rng(7),
+    ))
+    rng = np.random.default_rng(8)
+    longitudes = rng.uniform(-120, -75, N_APS)
+    latitudes = rng.uniform(30, 45, N_APS)
+    access_points = pl.DataFrame({
+        "ap_id": np.arange(N_APS),
+        "longitude": longitudes,
+        "latitude": latitudes,
+        "state": rng.choice(["CA", "NY", "TX"], N_APS),
+        "region": rng.choice(["West", "Northeast", "South"], N_APS),
+        "band": rng.choice(["2.4GHz", "5GHz"], N_APS),
+        "vendor_source": "oui",
+        "vendor_name": rng.choice(["Cisco", "Aruba"], N_APS),
+        "model": rng.choice(["A1", "B2"], N_APS),
+        "ssid": "guest",
+        **{geo.cell_column(r): geo.cells(latitudes, longitudes, r) for r in utils.load_config().geo.h3_resolutions},
+    })
+    path = tmp_path_factory.mktemp("raw") / "2025-11-17T00:00:00.parquet"
+    pl.from_pandas(records).join(access_points, on="ap_id").write_parquet(path)
+    return path
+
+
+def config(mode: str, distinct_sessions: str = "exact"):
+    return utils.with_overrides(utils.load_config(), {
+        "ingestion": {"aggregation": {"mode": mode, "distinct_sessions": distinct_sessions}},
+    })
+
+
+def aggregate(raw_path, output_dir, mode: str, distinct_sessions: str = "exact") -> pl.DataFrame:
+    """The written aggregate; bucketed mode sorts by access point within each bucket only."""
+    output_path = output_dir / f"{mode}-{distinct_sessions}.parquet"
+    ingestion.write_aggregate(str(raw_path), str(output_path), config(mode, distinct_sessions), compression="zstd")
+    return pl.read_parquet(output_path)
+
+
+@pytest.fixture
+def spilled(monkeypatch):
+    """Split every hour into several buckets, however small."""
+    monkeypatch.setattr(ingestion, "spill_buckets", lambda input_path, memory_budget_mb: 4)
+
+
+def test_exact_aggregate(raw_path, tmp_path):
+    exact = aggregate(raw_path, tmp_path, "exact")
+    assert exact["ap_id"].to_list() == list(range(N_APS))
+    assert exact["unique_sessions"].unique().to_list() == [3]
+
+
+def test_bucketed_equals_exact(raw_path, tmp_path, spilled):
+    bucketed = aggregate(raw_path, tmp_path, "bucketed")
+    assert not bucketed["ap_id"].is_sorted()
+    assert_frame_equal(bucketed.sort("ap_id"), aggregate(raw_path, tmp_path, "exact"))
+    assert not list(tmp_path.glob(".spill-*"))
+
+
+def test_bucketed_order_is_reproducible(raw_path, tmp_path, spilled):
+    assert_frame_equal(aggregate(raw_path, tmp_path / "a", "bucketed"), aggregate(raw_path, tmp_path / "b", "bucketed"))
+
+
+def test_hll_changes_only_unique_sessions(raw_path, tmp_path):
+    exact = aggregate(raw_path, tmp_path, "exact")
+    sketched = aggregate(raw_path, tmp_path, "exact", "hll")
+    # a few sessions per access point are counted by linear counting, which is exact here
+    assert_frame_equal(sketched, exact, check_dtypes=False)
+    assert sketched.schema["unique_sessions"] == pl.UInt32
+
+
+def test_bucketed_hll_equals_hll(raw_path, tmp_path, spilled):
+    assert_frame_equal(
+        aggregate(raw_path, tmp_path, "bucketed", "hll").sort("ap_id"), aggregate(raw_path, tmp_path, "exact", "hll"),
+    )
+
+
+def test_iter_aggregate_yields_the_written_rows(raw_path, tmp_path, monkeypatch, spilled):
+    written = aggregate(raw_path, tmp_path, "bucketed")
+    cfg = config("bucketed")
+    # spills under data/parquet of the working directory
+    monkeypatch.chdir(tmp_path)
+    assert_frame_equal(pl.from_arrow(list(ingestion.iter_aggregate(str(raw_path), cfg))), written)
@@ -0,0 +1,59 @@
+import base64
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from src import queries
+from src.backend import SearchRequest
+
+
+def search_request(**kwargs) -> SearchRequest:
+    return SearchRequest(**{"from": "2025-11-17T00:00:00", "to": "2025-11-17T06:00:00", **kwargs})
+
+
+def test_cursor_round_trip():
+    ts = datetime(2025, 11, 17, 3, 15, 0, 250)
+    assert queries.decode_cursor(queries.encode_cursor(ts, "42")) == (ts, "42")
+
+
+@pytest.mark.parametrize("payload", [b"", b"[]", b'["7"]', b'["yesterday", "7"]'])
+def test_malformed_cursor_raises_value_error(payload):
+    with pytest.raises(ValueError):
+        queries.decode_cursor(base64.urlsafe_b64encode(payload).decode())
+
+
+def test_naive_utc_drops_offset():
+    aware = datetime(2025, 11, 17, 2, tzinfo=timezone(timedelta(hours=2)))
+    assert queries.naive_utc(aware) == datetime(2025, 11, 17)
+
+
+def test_projection_keeps_key_columns_in_table_order():
+    assert queries.projection(["avg_snr", "avg_rssi"]) == ["timestamp", "ap_id", "avg_rssi", "avg_snr"]
+    assert queries.projection(None) == queries.COLUMNS
+
+
+def test_paged_search_fetches_one_row_more_in_key_order():
+    sql, params = queries.search_query(search_request(limit=10), "wifi")
+    assert sql.endswith("ORDER BY timestamp, ap_id LIMIT 11")
+    assert params == [datetime(2025, 11, 17), datetime(2025, 11, 17, 6)]
+
+
+def test_cursor_resumes_strictly_after_its_key():
+    ts = datetime(2025, 11, 17, 1)
+    cursor = queries.encode_cursor(ts, "7")
+    sql, params = queries.search_query(search_request(limit=10, cursor=cursor), "wifi")
+    assert "timestamp >= $3 AND (timestamp > $3 OR (timestamp = $3 AND ap_id > $4))" in sql
+    assert params[2:] == [ts, "7"]
+
+    sql, params = queries.search_query(search_request(limit=10, cursor=cursor), "wifi", queries.CLICKHOUSE)
+    assert "(timestamp > {p2:DateTime64(6)} OR (timestamp = {p2:DateTime64(6)} AND ap_id > {p3:String}))" in sql
+    assert params["p2"] == ts and params["p3"] == "7"
+
+
+def test_next_page_returns_cursor_of_last_row_kept():
+    rows = [{"timestamp": datetime(2025, 11, 17, hour), "ap_id": str(hour)} for hour in range(3)]
+    page, cursor = queries.next_page(rows, 2)
+    assert page == rows[:2]
+    assert queries.decode_cursor(cursor) == (rows[1]["timestamp"], "1")
+    assert queries.next_page(rows, 3) == (rows, None)
+    assert queries.next_page(rows, None) == (rows, None)
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.record_generator import COLUMNS, generate_records
+
+BASE_TIME = datetime(2025, 11, 17)
+
+
+def records(seed, **kwargs) -> pd.DataFrame:
+    params = dict(n_aps=20, base_time=BASE_TIME, n_sessions_per_ap=3, n_records_per_session=4, batch_size=30)
+    params.update(kwargs)
+    return pd.concat(generate_records(rng=np.random.default_rng(seed), **params), ignore_index=True)
+
+
+def test_same_seed_generates_same_records():
+    pd.testing.assert_frame_equal(records(7), records(7))
+
+
+def test_different_seeds_generate_different_records():
+    assert not records(7).equals(records(8))
+
+
+def test_counts_and_columns():
+    df = records(7)
+    assert list(df.columns) == COLUMNS
+    assert len(df) == 20 * 3 * 4
+    assert df["session_id"].nunique() == 20 * 3
+    assert df.groupby("ap_id")["session_id"].nunique().eq(3).all()
+
+
+def test_batches_hold_whole_sessions():
+    batches = list(generate_records(
+        n_aps=20, base_time=BASE_TIME, n_sessions_per_ap=3, n_records_per_session=4,
+        batch_size=30, rng=np.random.default_rng(7),
+    ))
+    assert all(len(batch) <= 30 and len(batch) % 4 == 0 for batch in batches)
+    sessions = [set(batch["session_id"]) for batch in batches]
+    assert all(a.isdisjoint(b) for i, a in enumerate(sessions) for b in sessions[i + 1:])
+
+
+def test_ap_offset_covers_a_disjoint_range():
+    assert set(records(7, n_aps=5, ap_offset=10)["ap_id"]) == set(range(10, 15))
+
+
+def test_batch_smaller_than_a_session_is_rejected():
+    with pytest.raises(ValueError):
+        next(generate_records(n_aps=1, base_time=BASE_TIME, n_records_per_session=4, batch_size=3))
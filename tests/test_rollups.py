@@ -0,0 +1,49 @@
+import pytest
+
+from src import rollups
+from src.backend import AggregateRequest
+from src.utils import load_config
+
+
+def aggregate_request(**kwargs) -> AggregateRequest:
+    values = {"from": "2025-11-17T00:00:00", "to": "2025-11-19T00:00:00", "bucket": "1d", "metrics": {"avg_rssi": ["avg"]}}
+    values.update(kwargs)
+    return AggregateRequest(**values)
+
+
+def routed(**kwargs):
+    rollup = rollups.route(aggregate_request(**kwargs), load_config())
+    return None if rollup is None else rollup.name
+
+
+@pytest.mark.parametrize("kwargs, expected", [
+    ({}, "wifi_dims_1d"),
+    ({"bucket": "2d", "group_by": ["state"]}, "wifi_dims_1d"),
+    ({"bucket": "1h"}, "wifi_dims_1h"),
+    ({"bucket": "6h", "from": "2025-11-17T03:00:00"}, "wifi_dims_1h"),
+    ({"group_by": ["model"]}, "wifi_ap_1d"),
+    ({"ap_id": "42"}, "wifi_ap_1d"),
+])
+def test_routes_to_the_coarsest_rollup_that_answers(kwargs, expected):
+    assert routed(**kwargs) == expected
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"bucket": "30m"},
+    {"bucket": "1h", "from": "2025-11-17T00:30:00"},
+    {"channel": "36"},
+    {"group_by": ["channel"]},
+    {"metrics": {"longitude": ["avg"]}},
+])
+def test_falls_back_to_the_wifi_table(kwargs):
+    assert routed(**kwargs) is None
+
+
+def test_grains_are_aligned_in_utc():
+    assert routed(**{"from": "2025-11-17T02:00:00+02:00", "to": "2025-11-19T02:00:00+02:00"}) == "wifi_dims_1d"
+    assert routed(**{"from": "2025-11-17T00:00:00+02:00"}) == "wifi_dims_1h"
+
+
+def test_clickhouse_buckets_in_utc():
+    table_ddl, view_ddl = rollups.Rollup("wifi_dims_1d", "1d", ("state",)).clickhouse_ddl("wifi")
+    assert "toStartOfDay(timestamp, 'UTC')" in view_ddl
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import pytest
+import toml
+
+from src import utils
+
+
+def hour(h: int) -> datetime:
+    return datetime(2025, 11, 17, h)
+
+
+@pytest.fixture(autouse=True)
+def watermark_path(tmp_path, monkeypatch):
+    path = tmp_path / "watermark.toml"
+    monkeypatch.setattr(utils, "WATERMARK_PATH", path)
+    monkeypatch.setattr(utils, "_watermark", (None, None))
+    return path
+
+
+def loaded(path) -> list:
+    return toml.load(path)["ingestion"]["loaded"]
+
+
+def test_no_watermark_before_the_first_hour():
+    assert utils.get_watermark() is None
+
+
+def test_first_hour_starts_the_run():
+    utils.publish_loaded_hour(hour(3))
+    assert utils.get_watermark() == hour(4)
+
+
+def test_watermark_waits_at_a_gap_until_it_is_filled(watermark_path):
+    utils.publish_loaded_hour(hour(0))
+    utils.publish_loaded_hour(hour(2))
+    utils.publish_loaded_hour(hour(3))
+    assert utils.get_watermark() == hour(1)
+    assert loaded(watermark_path) == [hour(2).isoformat(), hour(3).isoformat()]
+
+    utils.publish_loaded_hour(hour(1))
+    assert utils.get_watermark() == hour(4)
+    assert loaded(watermark_path) == []
+
+
+def test_watermark_never_moves_back(watermark_path):
+    utils.publish_loaded_hour(hour(5))
+    utils.publish_loaded_hour(hour(2))
+    assert utils.get_watermark() == hour(6)
+    assert loaded(watermark_path) == []